@@ -14,11 +14,24 @@ import glob
 import shutil
 import subprocess
 from layout_builder import layout_builder
+from thumbnails import PAGE_WIDTH
 from datetime import datetime
-from helpers import find_and_copy_file
+from helpers import find_and_copy_file, outputs_are_current, record_inputs
+from trace_events import span, start_trace, stop_trace
 from PIL import Image                      # for BrainSprite
 from re import split
 from math import sqrt
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy as np                     # optional mosaic backend
+except ImportError:
+    np = None
+
+
+class PreprocError(Exception):
+    # Raised by interface when some of the preprocessing failed. The page is
+    # still written, with the images that were made.
+    pass
 
 
 def generate_parser():
@@ -75,11 +88,98 @@ def generate_parser():
             'executivesummary preprocessor, so the image data is ready. This '
             'calls only the layout_builder to get the latest layout. '
             )
+    parser.add_argument(
+            '--jobs', '-j', dest='jobs', type=int, default=1,
+            metavar='N',
+            help='Optional. Number of jobs to run at the same time: wb_command '
+            'renders of the T1/T2 pngs and BrainSprite frames, and task '
+            'registrations, in the preprocessor; and worker processes making '
+            'the mosaics. Default: 1 (serial).'
+            )
+    parser.add_argument(
+            '--mosaic-backend', dest='mosaic_backend', choices=['pil', 'numpy'],
+            default='pil',
+            help='Optional. How to assemble the BrainSprite mosaics: "pil" '
+            'pastes PIL thumbnails one at a time; "numpy" shrinks each frame '
+            'with a box filter and builds all of the tiles in one array, '
+            'which is faster (see bench_mosaic.py). Default: pil.'
+            )
+    parser.add_argument(
+            '--sprite-resolution', dest='sprite_resolution', action='store_true',
+            help='Optional. Render the BrainSprite frames at the size of a '
+            'mosaic tile instead of 900x800, so make_mosaic does not have to '
+            'shrink them.'
+            )
+    parser.add_argument(
+            '--native-sprite', dest='native_sprite', action='store_true',
+            help='Optional. Make the BrainSprite mosaics by slicing '
+            'T1w_restore.nii.gz and T2w_restore.nii.gz directly, instead of '
+            'rendering frames with wb_command. These mosaics do not show the '
+            'surfaces. Needs nibabel.'
+            )
+    parser.add_argument(
+            '--native-render', dest='native_render', action='store_true',
+            help='Optional. Draw the atlas, subcortical and task registration '
+            'images, and the BOLD and reference previews, with '
+            'slice_renderer.py instead of slicesdir and slicer. Needs nibabel.'
+            )
+    parser.add_argument(
+            '--incremental', dest='incremental', action='store_true',
+            help='Optional. Keep the images from the last run, and make only '
+            'the ones whose inputs (files, templates, atlas or options) have '
+            'changed since. The inputs of each image are kept in '
+            'executivesummary/manifest.'
+            )
+    parser.add_argument(
+            '--dag', dest='dag', action='store_true',
+            help='Optional. Run the preprocessing as a graph of tasks in '
+            'Python (preproc_dag.py) instead of executivesummary_preproc.sh: '
+            'independent images are made side by side (up to --jobs at a '
+            'time), a failure skips only the images that depend on it, and '
+            'the status of every step is reported. Needs FSL and $CARET7DIR '
+            'in the environment.'
+            )
+    parser.add_argument(
+            '--trace', dest='trace', metavar='TRACE_PATH',
+            help='Optional. Write a Chrome trace-event JSON file of the run: '
+            'the start, duration and exit status of every wb_command, flirt, '
+            'slicesdir, slicer, fslmaths and pngappend call, each mosaic, '
+            'and the layout phases. Load it in chrome://tracing or '
+            'ui.perfetto.dev.'
+            )
+    parser.add_argument(
+            '--offline', dest='offline', action='store_true',
+            help='Optional. Put the stylesheet (the parts of w3.css that the '
+            'page uses, and its icons) in the page, instead of linking w3.css '
+            'and Font Awesome from their CDNs, so the page makes no network '
+            'requests.'
+            )
+    parser.add_argument(
+            '--assets-dir', dest='assets_dir', metavar='ASSETS_DIR',
+            help='Optional. Like --offline, but write the stylesheet once, '
+            'under a name made from its content, into ASSETS_DIR (e.g. one '
+            'directory for the whole study) and link it from the page.'
+            )
+    parser.add_argument(
+            '--tiled-sprite', dest='tiled_sprite', action='store_true',
+            help='Optional. Split each BrainSprite mosaic into a band per row '
+            'of slices (in img/tiles), and have the viewer load the bands '
+            'nearest the slice it shows first, so it draws before the whole '
+            'mosaic has loaded.'
+            )
+    parser.add_argument(
+            '--preview-width', dest='page_width', type=int, default=PAGE_WIDTH,
+            metavar='PIXELS',
+            help='Optional. Width of the page, in pixels, that the previews '
+            'in the rows are made for: each is as wide as its column on a '
+            'page this wide. 0 shows the full-size images in the rows. '
+            'Default: %s.' % PAGE_WIDTH
+            )
 
     return parser
 
 
-def init_summary(proc_files, summary_dir=None, layout_only=False):
+def init_summary(proc_files, summary_dir=None, layout_only=False, incremental=False):
 
     summary_path = None
     html_path = None
@@ -94,8 +194,9 @@ def init_summary(proc_files, summary_dir=None, layout_only=False):
         # This also ensures we can write to the path.
         html_path = os.path.join(summary_path, 'executivesummary')
 
-        # If we are going to create the files, need to clean up old files.
-        if path.exists(html_path) and not layout_only:
+        # If we are going to create the files, need to clean up old files
+        # (unless the ones still up to date are to be reused).
+        if path.exists(html_path) and not (layout_only or incremental):
                 shutil.rmtree(html_path)
 
         if not path.exists(html_path):
@@ -130,19 +231,55 @@ def init_summary(proc_files, summary_dir=None, layout_only=False):
     return summary_path, html_path, images_path
 
 
-def make_mosaic(png_path, mosaic_path):
+def natural_sort(l):
+    # Need this function so frames sort in correct order.
+    convert = lambda text: int(text) if text.isdigit() else text.lower()
+    alphanum_key = lambda key: [ convert(c) for c in split('([0-9]+)', key) ]
+    return sorted(l, key = alphanum_key)
+
+
+def make_tile(frame_path, image_dim):
+    # Opens one brainsprite frame, flips it and shrinks it to fit in a tile
+    # of the mosaic. Kept at module level so worker processes can use it.
+    img = Image.open(frame_path)
+    img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    img.thumbnail((image_dim, image_dim), resample=Image.LANCZOS)
+    return img
+
+
+def make_tile_array(frame_path, image_dim):
+    # Array version of make_tile: shrinks the frame to fit in a tile of the
+    # mosaic with a box filter (each new pixel is the average of the old
+    # pixels it covers), loads it as uint8, and flips it with a view.
+    # (Averaging treats left and right the same, so flipping last gives the
+    # same tile.)
+    with Image.open(frame_path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        width, height = img.size
+        scale = min(1.0, image_dim / max(width, height))
+        tile_size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        if tile_size != img.size:
+            img = img.resize(tile_size, resample=Image.BOX)
+        frame = np.asarray(img)
+
+    return frame[:, ::-1]
+
+
+def make_mosaic(png_path, mosaic_path, workers=1, backend='pil'):
     # Takes path to .png anatomical slices, creates a mosaic that can be
     # used in a BrainSprite viewer, and saves to a specified filename.
-
-    # Get the cwd so we can get back; then change directory.
-    cwd = os.getcwd()
-    os.chdir(png_path)
-
-    # Need this function so frames sort in correct order.
-    def natural_sort(l):
-        convert = lambda text: int(text) if text.isdigit() else text.lower()
-        alphanum_key = lambda key: [ convert(c) for c in split('([0-9]+)', key) ]
-        return sorted(l, key = alphanum_key)
+    # When workers is more than 1, the frames are decoded and shrunk in a
+    # pool of that many processes; the tiles are still pasted in order, so
+    # the mosaic is the same as the one made serially.
+    # The 'numpy' backend builds the tiles in one preallocated array and
+    # reshapes it into the sprite. It averages pixels (a box filter) instead
+    # of using PIL's Lanczos filter, so its JPEG is close to, but not the
+    # same as, the 'pil' one.
+
+    if backend == 'numpy' and np is None:
+        print('The numpy mosaic backend needs numpy. Using PIL instead.')
+        backend = 'pil'
 
     files = os.listdir(png_path)
     files = natural_sort(files)
@@ -151,36 +288,94 @@ def make_mosaic(png_path, mosaic_path):
     image_dim = 218
     images_per_side = int(sqrt(len(files)))
     square_dim = image_dim * images_per_side
-    result = Image.new("RGB", (square_dim, square_dim))
 
-    for index, file in enumerate(files):
-        path = os.path.expanduser(file)
-        img = Image.open(path)
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        img.thumbnail((image_dim, image_dim), resample=Image.ANTIALIAS)
-        x = index % images_per_side * image_dim
-        y = index // images_per_side * image_dim
-        w, h = img.size
-        result.paste(img, (x, y, x + w, y + h))
+    if backend == 'numpy':
+        # Only the frames that fit in the square are shown.
+        files = files[:images_per_side * images_per_side]
+        tile_func = make_tile_array
+        tiles_array = np.zeros((images_per_side, images_per_side,
+                image_dim, image_dim, 3), dtype=np.uint8)
+    else:
+        tile_func = make_tile
+        result = Image.new("RGB", (square_dim, square_dim))
+
+    frame_paths = [os.path.join(png_path, file) for file in files]
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        tiles = executor.map(tile_func, frame_paths,
+                [image_dim] * len(frame_paths), chunksize=8)
+    else:
+        executor = None
+        tiles = (tile_func(frame_path, image_dim) for frame_path in frame_paths)
+
+    for index, tile in enumerate(tiles):
+        if backend == 'numpy':
+            h, w = tile.shape[:2]
+            tiles_array[index // images_per_side, index % images_per_side, :h, :w] = tile
+        else:
+            paste_tile(result, tile, index, images_per_side, image_dim)
 
-    # Back to original working dir.
-    os.chdir(cwd)
+    if executor is not None:
+        executor.shutdown()
+
+    if backend == 'numpy':
+        # (row, col, y, x, rgb) -> (row, y, col, x, rgb) is the sprite layout.
+        sprite = tiles_array.transpose(0, 2, 1, 3, 4).reshape(
+                square_dim, square_dim, 3)
+        result = Image.fromarray(sprite, 'RGB')
 
     quality_val = 95
     dest = os.path.join(mosaic_path)
     result.save(dest, 'JPEG', quality=quality_val)
 
-def preprocess_tx (tx, files_path, images_path):
+
+def paste_tile(result, img, index, images_per_side, image_dim):
+    # Pastes the tile for frame number index into its place in the mosaic.
+    x = index % images_per_side * image_dim
+    y = index // images_per_side * image_dim
+    w, h = img.size
+    result.paste(img, (x, y, x + w, y + h))
+
+def preprocess_tx (tx, files_path, images_path, jobs=1, mosaic_backend='pil', native_sprite=False, incremental=False):
     # If there are pngs for tx, make the mosaic file for the brainsprite.
     # If not, no problem. Layout will use the mosaic if it is there.
+    # With incremental, a mosaic made from the same inputs is kept.
+    mosaic = tx + '_mosaic.jpg'
+    mosaic_path = os.path.join(images_path, mosaic)
+    manifest_dir = os.path.join(os.path.dirname(images_path), 'manifest')
+
+    if native_sprite:
+        # Slice the volume itself; there are no pngs.
+        volume = os.path.join(files_path, 'MNINonLinear', tx + 'w_restore.nii.gz')
+        if os.path.isfile(volume):
+            import volume_sprite
+            outputs = [ mosaic_path, volume_sprite.sprite_params_path(mosaic_path) ]
+            inputs = [ volume, volume_sprite.__file__ ]
+            if incremental and outputs_are_current(manifest_dir, outputs, inputs):
+                print('Reuse %s' % mosaic_path)
+            else:
+                with span('make_sprite_from_volume', 'mosaic', mosaic=mosaic_path):
+                    volume_sprite.make_sprite_from_volume(volume, mosaic_path)
+                record_inputs(manifest_dir, outputs, inputs)
+        else:
+            print('There is no file: %s.' % volume)
+        return
+
     pngs = tx + '_pngs'
     pngs_dir = os.path.join(files_path, pngs)
 
     if os.path.isdir(pngs_dir):
+        outputs = [ mosaic_path ]
+        inputs = [ os.path.join(pngs_dir, frame) for frame in natural_sort(os.listdir(pngs_dir)) ]
+        inputs += [ os.path.abspath(__file__), 'backend=' + mosaic_backend ]
+        if incremental and outputs_are_current(manifest_dir, outputs, inputs):
+            print('Reuse %s' % mosaic_path)
+            return
         # Call the program to make the mosaic from the pngs. and write
-        mosaic = tx + '_mosaic.jpg'
-        mosaic_path = os.path.join(images_path, mosaic)
-        make_mosaic(pngs_dir, mosaic_path)
+        with span('make_mosaic', 'mosaic', mosaic=mosaic_path, frames=len(inputs) - 2,
+                  backend=mosaic_backend, workers=jobs):
+            make_mosaic(pngs_dir, mosaic_path, workers=jobs, backend=mosaic_backend)
+        record_inputs(manifest_dir, outputs, inputs)
     else:
         print('There is no path: %s.' % pngs_dir)
 
@@ -195,6 +390,7 @@ def _cli():
     print('Executive Summary was called at %s with:' % date_stamp)
     print('\tOutput directory:      %s' % args.output_dir)
     print('\tSubject:               %s' % args.subject_id)
+    print('\tJobs:                  %s' % args.jobs)
 
     # output_dir is required, and the parser would have squawked if there was
     # not a value for output_dir. Just make sure it's a real directory.
@@ -203,7 +399,18 @@ def _cli():
     kwargs = {
         'files_path'   : args.output_dir,
         'subject_id'   : args.subject_id,
-        'layout_only'  : args.layout_only
+        'layout_only'  : args.layout_only,
+        'jobs'         : args.jobs,
+        'mosaic_backend' : args.mosaic_backend,
+        'sprite_resolution' : args.sprite_resolution,
+        'native_sprite' : args.native_sprite,
+        'native_render' : args.native_render,
+        'incremental'   : args.incremental,
+        'dag'           : args.dag,
+        'offline'       : args.offline,
+        'assets_dir'    : args.assets_dir,
+        'tiled_sprite'  : args.tiled_sprite,
+        'page_width'    : args.page_width
         }
 
     # If the caller specifies an arg is None, python is treating it as a string.
@@ -232,23 +439,50 @@ def _cli():
         assert os.path.exists(args.atlas), args.atlas + ' does not exist!'
         kwargs['atlas'] = args.atlas
 
-    # Call the interface.
-    interface(**kwargs)
+    # Call the interface, tracing it if asked.
+    if args.trace is not None:
+        start_trace(args.trace)
+    try:
+        interface(**kwargs)
+    except PreprocError as err:
+        raise SystemExit('ERROR: %s' % err)
+    finally:
+        if args.trace is not None:
+            stop_trace(args.trace)
 
-def interface(files_path, subject_id, summary_dir=None, func_path=None, session_id=None, atlas=None, layout_only=False):
+def interface(files_path, subject_id, summary_dir=None, func_path=None, session_id=None, atlas=None, layout_only=False, jobs=1, mosaic_backend='pil', sprite_resolution=False, native_sprite=False, native_render=False, incremental=False, dag=False, offline=False, assets_dir=None, tiled_sprite=False, page_width=PAGE_WIDTH):
 
     # Most of the data needed is in the summary directory. Also, it is where the
     # preprocessor will make the images and where the layout_builder will write
     # the HTML. We must be able to write to the path.
     if summary_dir is not None:
         print ('summary_dir is %s' % summary_dir)
-    summary_path, html_path, images_path = init_summary(files_path, summary_dir, layout_only)
+    summary_path, html_path, images_path = init_summary(files_path, summary_dir, layout_only, incremental)
     if summary_path is None:
         # We were not able to find and/or write to the path.
         print('Exiting.')
         return
 
-    if not layout_only:
+    # What failed in the preprocessing, if anything. The layout is still
+    # made from the images there are, and then the failure is raised.
+    preproc_error = None
+
+    if not layout_only and dag:
+        # Run the preprocessing (mosaics included) as a graph of tasks.
+        from preproc_dag import run_preproc
+        with span('preproc_dag', 'stage'):
+            statuses = run_preproc(jobs=jobs, files_path=files_path, html_path=html_path,
+                        subject_id=subject_id, session_id=session_id,
+                        func_path=func_path, atlas=atlas,
+                        sprite_resolution=sprite_resolution,
+                        native_sprite=native_sprite, native_render=native_render,
+                        mosaic_backend=mosaic_backend, incremental=incremental)
+        failed = sorted(name for name, status in statuses.items() if status == 'failed')
+        if failed:
+            preproc_error = 'preprocessing failed: %s' % ', '.join(failed)
+        print('Finished with preprocessing.')
+
+    elif not layout_only:
         preproc_cmd = os.path.dirname(os.path.abspath(__file__)) + '/executivesummary_preproc.sh '
         preproc_cmd += '--output-dir %s ' % files_path
         preproc_cmd += '--html-path %s ' % html_path
@@ -259,14 +493,27 @@ def interface(files_path, subject_id, summary_dir=None, func_path=None, session_
             preproc_cmd += '--bids-input %s ' % func_path
         if atlas is not None:
             preproc_cmd += '--atlas %s ' % atlas
-
-        subprocess.call(preproc_cmd, shell=True)
+        if jobs > 1:
+            preproc_cmd += '--jobs %s ' % jobs
+        if sprite_resolution:
+            preproc_cmd += '--sprite-resolution '
+        if native_sprite:
+            preproc_cmd += '--native-sprite '
+        if native_render:
+            preproc_cmd += '--native-render '
+        if incremental:
+            preproc_cmd += '--incremental '
+
+        with span('executivesummary_preproc.sh', 'stage'):
+            status = subprocess.call(preproc_cmd, shell=True)
+        if status != 0:
+            preproc_error = 'executivesummary_preproc.sh exited with status %s' % status
 
         # Make mosaic(s) for brainsprite(s).
         print('Making mosaic for T1 BrainSprite.')
-        preprocess_tx('T1', files_path, images_path)
+        preprocess_tx('T1', files_path, images_path, jobs, mosaic_backend, native_sprite, incremental)
         print('Making mosaic for T2 BrainSprite.')
-        preprocess_tx('T2', files_path, images_path)
+        preprocess_tx('T2', files_path, images_path, jobs, mosaic_backend, native_sprite, incremental)
         print('Finished with preprocessing.')
 
     # Done with preproc (or skipped it). Call the page layout to make the page.
@@ -278,10 +525,21 @@ def interface(files_path, subject_id, summary_dir=None, func_path=None, session_
         'html_path'     : html_path,
         'images_path'   : images_path,
         'subject_id'    : subject_id,
-        'session_id'    : session_id
+        'session_id'    : session_id,
+        'offline'       : offline,
+        'assets_dir'    : assets_dir,
+        'tiled_sprite'  : tiled_sprite,
+        'page_width'    : page_width
         }
 
-    layout_builder(**kwargs)
+    with span('layout_builder', 'layout'):
+        builder = layout_builder(**kwargs)
+
+    if preproc_error is not None:
+        raise PreprocError(preproc_error)
+
+    # The path of the page, or None if it could not be written.
+    return builder.page_path
 
 if __name__ == '__main__':
 
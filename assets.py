@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+
+__doc__ = """
+The stylesheets of the executive summary pages, for pages that must render
+with no network requests (e.g. on air-gapped QC workstations).
+
+By default the pages link w3.css and Font Awesome from their CDNs. Instead,
+the pages can use STYLESHEET: the rules of w3.css that the pages use, and
+text glyphs for the three icons. It is either inlined into each page, or
+written once into a shared assets directory (e.g. one per study) under a
+name made from its hash, so every page links the same file, browsers cache
+it, and a changed stylesheet never replaces the one older pages link.
+"""
+
+import os
+import argparse
+import hashlib
+import tempfile
+from constants import CDN_STYLESHEETS
+
+
+# The w3.css (4.x) rules for the classes used in constants.py, and the icons
+# as characters, minified.
+STYLESHEET = (
+    r'html{box-sizing:border-box}*,*:before,*:after{box-sizing:inherit}'
+    r'html,body{font-family:Verdana,sans-serif;font-size:15px;line-height:1.5}body{margin:0}'
+    r'h1{font-size:36px}h2{font-size:30px}h3{font-size:24px}'
+    r'h1,h2,h3{font-family:"Segoe UI",Arial,sans-serif;font-weight:400;margin:10px 0}'
+    r'img{vertical-align:middle}'
+    r'button{font:inherit;margin:0;overflow:visible;text-transform:none}'
+    r'.w3-btn,.w3-button{border:none;display:inline-block;padding:8px 16px;vertical-align:middle;'
+    r'overflow:hidden;text-decoration:none;color:inherit;background-color:inherit;text-align:center;'
+    r'cursor:pointer;white-space:nowrap;-webkit-user-select:none;user-select:none}'
+    r'.w3-btn:hover{box-shadow:0 8px 16px 0 rgba(0,0,0,0.2),0 6px 20px 0 rgba(0,0,0,0.19)}'
+    r'.w3-button:hover{color:#000!important;background-color:#ccc!important}'
+    r'.w3-modal{z-index:3;display:none;padding-top:100px;position:fixed;left:0;top:0;width:100%;'
+    r'height:100%;overflow:auto;background-color:rgba(0,0,0,0.4)}'
+    r'.w3-modal-content{margin:auto;background-color:#fff;position:relative;padding:0;outline:0;width:600px}'
+    r'.w3-content{max-width:980px;margin:auto}'
+    r'.w3-display-container{position:relative}'
+    r'.w3-display-topleft{position:absolute;left:0;top:0}'
+    r'.w3-display-topright{position:absolute;right:0;top:0}'
+    r'.w3-display-bottomleft{position:absolute;left:0;bottom:0}'
+    r'.w3-display-bottomright{position:absolute;right:0;bottom:0}'
+    r'.w3-container{padding:0.01em 16px}'
+    r'.w3-container:after,.w3-container:before,.w3-row:after,.w3-row:before,'
+    r'.w3-row-padding:after,.w3-row-padding:before{content:"";display:table;clear:both}'
+    r'.w3-row-padding,.w3-row-padding>.w3-half,.w3-row-padding>.w3-quarter,'
+    r'.w3-row-padding>.w3-col{padding:0 8px}'
+    r'.w3-col,.w3-half,.w3-quarter{float:left;width:100%}'
+    r'.w3-cell{display:table-cell}'
+    r'.w3-left{float:left!important}.w3-right{float:right!important}'
+    r'.w3-center{text-align:center!important}'
+    r'.w3-large{font-size:18px!important}.w3-xxlarge{font-size:36px!important}'
+    r'.w3-black{color:#fff!important;background-color:#000!important}'
+    r'.w3-red{color:#fff!important;background-color:#f44336!important}'
+    r'.w3-teal{color:#fff!important;background-color:#009688!important}'
+    r'.w3-pale-red{color:#000!important;background-color:#ffdddd!important}'
+    r'@media (min-width:601px){.w3-half{width:49.99999%}}'
+    r'@media (min-width:993px){.w3-modal-content{width:900px}.w3-quarter{width:24.99999%}'
+    r'.w3-col.l1{width:8.33333%}.w3-col.l2{width:16.66666%}'
+    r'.w3-col.l9{width:74.99999%}.w3-col.l11{width:91.66666%}}'
+    r'@media (max-width:600px){.w3-modal-content{margin:0 10px;width:auto!important}'
+    r'.w3-modal{padding-top:30px}.w3-hide-small{display:none!important}}'
+    r'.fa,.fas{display:inline-block;font-style:normal;line-height:1}'
+    r'.fa-angle-left:before{content:"\2039"}.fa-angle-right:before{content:"\203A"}'
+    r'.fa-close:before{content:"\00D7"}'
+    )
+
+
+def stylesheet_name(css=STYLESHEET):
+    # Name the file after its content, so that a changed stylesheet gets a
+    # new file.
+    return 'executivesummary.%s.css' % hashlib.sha256(css.encode('utf-8')).hexdigest()[:16]
+
+
+def bundle_assets(assets_dir):
+    """
+    Writes the stylesheet into the shared assets directory, unless a page
+    written earlier already put it there.
+
+    :parameter: assets_dir: directory of the assets shared by the pages.
+    :return: path to the stylesheet.
+    """
+    os.makedirs(assets_dir, exist_ok=True)
+
+    css_path = os.path.join(assets_dir, stylesheet_name())
+    if os.path.exists(css_path):
+        return css_path
+
+    # Pages may be laid out side by side: write a temporary file and rename
+    # it, so that no page sees part of the stylesheet.
+    fd, tmp_path = tempfile.mkstemp(suffix='.css', dir=assets_dir)
+    with os.fdopen(fd, 'w') as css_file:
+        css_file.write(STYLESHEET)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, css_path)
+
+    return css_path
+
+
+def stylesheet_html(html_dir, offline=False, assets_dir=None):
+    """
+    Gets the HTML that gives a page its stylesheets.
+
+    :parameter: html_dir: directory the page is written to.
+    :parameter: offline: inline the stylesheet into the page.
+    :parameter: assets_dir: link the stylesheet in this shared directory.
+                Takes precedence over offline.
+    :return: the HTML for the head of the page.
+    """
+    if assets_dir is not None:
+        css_path = bundle_assets(assets_dir)
+        href = os.path.relpath(css_path, html_dir).replace(os.sep, '/')
+        return '<link rel="stylesheet" href="%s">\n' % href
+
+    if offline:
+        return '<style type="text/css">%s</style>\n' % STYLESHEET
+
+    return CDN_STYLESHEETS
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='assets',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('assets_dir', metavar='ASSETS_DIR',
+            help='directory of the assets shared by the pages.')
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    print(bundle_assets(args.assets_dir))
+
+
+if __name__ == '__main__':
+
+    _cli()
@@ -0,0 +1,472 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Makes the executive summaries of many sessions from one process: the
+preprocessing and layout of each session run in a pool of worker processes,
+up to --workers sessions at a time.
+
+The sessions are read from a list, or found under the study root: each
+sub-<label>/ses-<label>/files (or sub-<label>/files, for a study without
+sessions) is a session. A session that fails does not stop the others. The
+output of each session goes to its own log, and the status and duration of
+every session are written to batch_summary.tsv and batch_summary.json in the
+log directory.
+"""
+
+import os
+import sys
+import argparse
+import json
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from ExecutiveSummary import interface
+from study_index import update_index
+from thumbnails import PAGE_WIDTH
+
+
+def strip_prefix(label, prefix):
+    # Labels may be given with or without 'sub-' or 'ses-'.
+    if label and label.startswith(prefix):
+        return label[len(prefix):]
+    return label
+
+
+def session_name(subject_id, session_id):
+    # sub-01_ses-A, or sub-01 for a study without sessions.
+    if session_id is None:
+        return 'sub-%s' % subject_id
+    return 'sub-%s_ses-%s' % (subject_id, session_id)
+
+
+def session_files_path(study_root, subject_id, session_id):
+    # Where the pipeline's files are for a session, under the study root.
+    if session_id is None:
+        return os.path.join(study_root, 'sub-' + subject_id, 'files')
+    return os.path.join(study_root, 'sub-' + subject_id, 'ses-' + session_id, 'files')
+
+
+def session_func_path(bids_root, subject_id, session_id):
+    # The session's func directory in the BIDS input, or None.
+    func_path = os.path.join(bids_root, 'sub-' + subject_id)
+    if session_id is not None:
+        func_path = os.path.join(func_path, 'ses-' + session_id)
+    func_path = os.path.abspath(os.path.join(func_path, 'func'))
+    if os.path.isdir(func_path):
+        return func_path
+    return None
+
+
+def discover_sessions(study_root):
+    """
+    Finds the sessions under a study root.
+
+    :parameter: study_root: directory with a sub-<label> directory per subject.
+    :return: list of (subject_id, session_id, files_path), sorted; session_id
+             is None for a subject without sessions.
+    """
+    sessions = []
+    for sub_entry in sorted(os.scandir(study_root), key=lambda entry: entry.name):
+        if not (sub_entry.name.startswith('sub-') and sub_entry.is_dir()):
+            continue
+        subject_id = strip_prefix(sub_entry.name, 'sub-')
+
+        found = False
+        for ses_entry in sorted(os.scandir(sub_entry.path), key=lambda entry: entry.name):
+            if not (ses_entry.name.startswith('ses-') and ses_entry.is_dir()):
+                continue
+            files_path = os.path.join(ses_entry.path, 'files')
+            if os.path.isdir(files_path):
+                sessions.append((subject_id, strip_prefix(ses_entry.name, 'ses-'), files_path))
+                found = True
+
+        files_path = os.path.join(sub_entry.path, 'files')
+        if not found and os.path.isdir(files_path):
+            sessions.append((subject_id, None, files_path))
+
+    return sessions
+
+
+def read_sessions(list_path, study_root=None):
+    """
+    Reads a list of sessions: one per line, with the participant label, then
+    (optionally) the session id, then (optionally) the path to the files
+    directory, separated by white space. A session id of NONE means the
+    subject has no sessions. Blank lines, and lines starting with #, are
+    skipped.
+
+    :parameter: list_path: path to the list.
+    :parameter: study_root: where to find the files directory of a session
+                whose line does not give it.
+    :return: list of (subject_id, session_id, files_path).
+    """
+    sessions = []
+    with open(list_path) as fd:
+        for line_num, line in enumerate(fd, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+
+            subject_id = strip_prefix(fields[0], 'sub-')
+            session_id = None
+            if len(fields) > 1 and fields[1].upper() != 'NONE':
+                session_id = strip_prefix(fields[1], 'ses-')
+
+            if len(fields) > 2:
+                files_path = fields[2]
+            elif study_root is not None:
+                files_path = session_files_path(study_root, subject_id, session_id)
+            else:
+                raise ValueError('%s, line %s: no files path, and no --study-root to find it in.'
+                                 % (list_path, line_num))
+
+            sessions.append((subject_id, session_id, files_path))
+
+    return sessions
+
+
+def make_summary(subject_id, session_id, files_path, options):
+    # Runs interface for the session. Returns the session's status, page
+    # and error; an exception fails only this session.
+    result = { 'status': 'failed', 'page': None, 'error': None }
+    try:
+        kwargs = dict(options, files_path=files_path, subject_id=subject_id, session_id=session_id)
+        page = interface(**kwargs)
+        if page is None:
+            result['error'] = 'no page was written; see the log.'
+        else:
+            result['status'] = 'ok'
+            result['page'] = page
+    except Exception as err:
+        traceback.print_exc()
+        result['error'] = str(err) or repr(err)
+    return result
+
+
+def run_session(subject_id, session_id, files_path, options, log_path):
+    """
+    Makes the executive summary of one session, with its output sent to a
+    log. Runs in a worker process.
+
+    :parameter: subject_id: participant label, without 'sub-'.
+    :parameter: session_id: session id, without 'ses-', or None.
+    :parameter: files_path: the session's files directory.
+    :parameter: options: dict of the other arguments to interface.
+    :parameter: log_path: file for the session's output.
+    :return: dict of the session's status ('ok' or 'failed'), seconds,
+             page and error.
+    """
+    start = time.time()
+
+    # Send this process's output, and that of the preprocessor it starts,
+    # to the log. Workers are reused, so put the output back afterwards.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(log_fd)
+    try:
+        result = make_summary(subject_id, session_id, files_path, options)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        os.close(saved_fds[0])
+        os.close(saved_fds[1])
+
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+class ThreadLogs(object):
+    # Stands in for sys.stdout (or sys.stderr), and sends what each thread
+    # writes to that thread's log, if it has one; anything else goes to the
+    # stream it replaced. (Threads share their file descriptors, so dup2
+    # cannot give each its own log.)
+    #
+    def __init__ (self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def set_log(self, log):
+        self.local.log = log
+
+    def current(self):
+        return getattr(self.local, 'log', None) or self.stream
+
+    def write(self, text):
+        return self.current().write(text)
+
+    def flush(self):
+        self.current().flush()
+
+    def __getattr__(self, name):
+        # Anything else (encoding, isatty, ...) is the current stream's.
+        return getattr(self.current(), name)
+
+
+def run_session_thread(subject_id, session_id, files_path, options, log_path):
+    # As run_session, for a layout built in a thread: the thread's output
+    # is sent to the log by the ThreadLogs that run_batch puts in place.
+    start = time.time()
+    with open(log_path, 'w') as log:
+        sys.stdout.set_log(log)
+        sys.stderr.set_log(log)
+        try:
+            result = make_summary(subject_id, session_id, files_path, options)
+        finally:
+            sys.stdout.set_log(None)
+            sys.stderr.set_log(None)
+
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def run_batch(sessions, options, log_dir, workers=1, bids_root=None, threads=False):
+    """
+    Makes the executive summaries of the sessions, up to workers at a time.
+
+    :parameter: sessions: list of (subject_id, session_id, files_path).
+    :parameter: options: dict of the other arguments to interface.
+    :parameter: log_dir: directory for the logs and the batch summary.
+    :parameter: workers: number of sessions to run at the same time.
+    :parameter: bids_root: BIDS input, in which to find each session's
+                func directory.
+    :parameter: threads: run the sessions in threads of this process instead
+                of in worker processes. For layouts only: the output of the
+                preprocessor could not be sent to each session's log.
+    :return: list of dicts, one per session, in the order of sessions.
+    """
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    if threads:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        run_func = run_session_thread
+        saved_streams = (sys.stdout, sys.stderr)
+        sys.stdout = ThreadLogs(sys.stdout)
+        sys.stderr = ThreadLogs(sys.stderr)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        run_func = run_session
+
+    results = [ None ] * len(sessions)
+    try:
+        futures = {}
+        for idx, (subject_id, session_id, files_path) in enumerate(sessions):
+            name = session_name(subject_id, session_id)
+            log_path = os.path.abspath(os.path.join(log_dir, name + '.log'))
+            results[idx] = { 'subject': subject_id, 'session': session_id,
+                             'files_path': files_path, 'log': log_path }
+            if not os.path.isdir(files_path):
+                results[idx].update(status='failed', seconds=0, page=None,
+                                    error='no directory %s' % files_path)
+                print('failed %s: no directory %s' % (name, files_path))
+                continue
+
+            session_options = options
+            if bids_root is not None:
+                session_options = dict(options, func_path=session_func_path(bids_root, subject_id, session_id))
+            future = executor.submit(run_func, subject_id, session_id,
+                                     os.path.abspath(files_path), session_options, log_path)
+            futures[future] = idx
+
+        done = len(sessions) - len(futures)
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                results[idx].update(future.result())
+            except Exception as err:
+                # The worker itself died (e.g. it was killed).
+                results[idx].update(status='failed', seconds=None, page=None,
+                                    error=str(err) or repr(err))
+            done += 1
+            result = results[idx]
+            print('[%s/%s] %-6s %s (%ss)' % (done, len(sessions), result['status'],
+                    session_name(result['subject'], result['session']), result['seconds']))
+    finally:
+        executor.shutdown()
+        if threads:
+            sys.stdout, sys.stderr = saved_streams
+
+    return results
+
+
+def write_summary(results, log_dir):
+    # The status of every session, as a table and as JSON.
+    columns = [ 'subject', 'session', 'status', 'seconds', 'page', 'error', 'log' ]
+    tsv_path = os.path.join(log_dir, 'batch_summary.tsv')
+    with open(tsv_path, 'w') as fd:
+        fd.write('\t'.join(columns) + '\n')
+        for result in results:
+            values = [ result.get(column) for column in columns ]
+            fd.write('\t'.join('' if value is None else str(value).replace('\t', ' ').replace('\n', ' ')
+                               for value in values) + '\n')
+
+    json_path = os.path.join(log_dir, 'batch_summary.json')
+    with open(json_path, 'w') as fd:
+        json.dump(results, fd, indent=1)
+
+    return tsv_path
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='batch_summary',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument(
+            '--study-root', dest='study_root', metavar='STUDY_ROOT',
+            help='directory with a sub-<label> directory per subject. The '
+            'sessions are found under it, unless --sessions is given.'
+            )
+    parser.add_argument(
+            '--sessions', dest='sessions', metavar='SESSIONS_LIST',
+            help='file listing the sessions: one per line, with the '
+            'participant label, then (optionally) the session id, then '
+            '(optionally) the path to the files directory. Without a path, '
+            'the session is looked for under --study-root.'
+            )
+    parser.add_argument(
+            '--bids-root', dest='bids_root', metavar='BIDS_ROOT',
+            help='Optional. The BIDS dataset used as input to the pipeline. '
+            'Each session is given its sub-<label>[/ses-<label>]/func '
+            'directory, if there is one.'
+            )
+    parser.add_argument(
+            '--log-dir', dest='log_dir', metavar='LOG_DIR', default='executivesummary_batch',
+            help='Optional. Directory for the log of each session and the '
+            'batch summary. Default: executivesummary_batch.'
+            )
+    parser.add_argument(
+            '--workers', '-w', dest='workers', metavar='N', type=int, default=1,
+            help='Optional. Number of sessions to run at the same time. '
+            'Default: 1.'
+            )
+    parser.add_argument(
+            '--threads', dest='threads', action='store_true',
+            help='Optional. With --layout-only, build the layouts in --workers '
+            'threads of this process, instead of in worker processes.'
+            )
+    parser.add_argument(
+            '--jobs', '-j', dest='jobs', metavar='N', type=int, default=1,
+            help='Optional. Number of jobs each session runs at the same '
+            'time (see ExecutiveSummary.py --jobs). Default: 1.'
+            )
+    parser.add_argument(
+            '--dcan-summary', '-d', dest='summary_dir',
+            default='summary_DCANBOLDProc_v4.0.0',
+            help='Optional. Name of the subdirectory used for the summary '
+            'data. Default: summary_DCANBOLDProc_v4.0.0'
+            )
+    parser.add_argument(
+            '--atlas', '-a', dest='atlas', metavar='ATLAS_PATH',
+            help='Optional. Path to the atlas to register to the images.'
+            )
+    parser.add_argument(
+            '--mosaic-backend', dest='mosaic_backend', choices=['pil', 'numpy'], default='pil',
+            help='Optional. See ExecutiveSummary.py. Default: pil.'
+            )
+    for flag, dest in [ ('--layout-only', 'layout_only'),
+                        ('--sprite-resolution', 'sprite_resolution'),
+                        ('--native-sprite', 'native_sprite'),
+                        ('--native-render', 'native_render'),
+                        ('--incremental', 'incremental'),
+                        ('--dag', 'dag'),
+                        ('--offline', 'offline'),
+                        ('--tiled-sprite', 'tiled_sprite') ]:
+        parser.add_argument(flag, dest=dest, action='store_true',
+                help='Optional. See ExecutiveSummary.py.')
+    parser.add_argument(
+            '--preview-width', dest='page_width', metavar='PIXELS', type=int, default=PAGE_WIDTH,
+            help='Optional. See ExecutiveSummary.py. Default: %s.' % PAGE_WIDTH
+            )
+    parser.add_argument(
+            '--study-index', dest='study_index', action='store_true',
+            help='Optional. After the batch, update the study index '
+            '(STUDY_ROOT/study_index.html; see study_index.py) with the '
+            'pages written.'
+            )
+    parser.add_argument(
+            '--assets-dir', dest='assets_dir', metavar='ASSETS_DIR',
+            help='Optional. See ExecutiveSummary.py. One directory serves '
+            'every session of the batch.'
+            )
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    if args.sessions is not None:
+        sessions = read_sessions(args.sessions, args.study_root)
+    elif args.study_root is not None:
+        sessions = discover_sessions(args.study_root)
+    else:
+        parser.error('give --sessions or --study-root.')
+
+    if args.study_index and args.study_root is None:
+        parser.error('--study-index needs --study-root.')
+
+    if args.threads and not args.layout_only:
+        parser.error('--threads builds only layouts; add --layout-only.')
+
+    if not sessions:
+        print('No sessions found.')
+        return 1
+
+    # As for ExecutiveSummary.py, NONE means the summary data are in files.
+    summary_dir = args.summary_dir
+    if summary_dir is not None and summary_dir.upper() == 'NONE':
+        summary_dir = None
+
+    options = {
+        'summary_dir'       : summary_dir,
+        'layout_only'       : args.layout_only,
+        'jobs'              : args.jobs,
+        'mosaic_backend'    : args.mosaic_backend,
+        'sprite_resolution' : args.sprite_resolution,
+        'native_sprite'     : args.native_sprite,
+        'native_render'     : args.native_render,
+        'incremental'       : args.incremental,
+        'dag'               : args.dag,
+        'offline'           : args.offline,
+        'tiled_sprite'      : args.tiled_sprite,
+        'page_width'        : args.page_width
+        }
+    if args.atlas is not None:
+        assert os.path.exists(args.atlas), args.atlas + ' does not exist!'
+        options['atlas'] = os.path.abspath(args.atlas)
+    if args.assets_dir is not None:
+        options['assets_dir'] = os.path.abspath(args.assets_dir)
+
+    print('Executive summary batch of %s sessions, %s at a time.' % (len(sessions), args.workers))
+    print('\tLogs and summary:      %s' % os.path.abspath(args.log_dir))
+
+    start = time.time()
+    results = run_batch(sessions, options, args.log_dir, args.workers, args.bids_root, args.threads)
+    tsv_path = write_summary(results, args.log_dir)
+
+    if args.study_index:
+        pages = [ result['page'] for result in results if result['status'] == 'ok' ]
+        count = update_index(args.study_root, pages=pages)
+        print('Study index of %s sessions: %s' % (count, os.path.join(args.study_root, 'study_index.html')))
+
+    failed = [ result for result in results if result['status'] != 'ok' ]
+    print('\n%s sessions ok, %s failed, in %.1fs. Summary: %s' % (
+            len(results) - len(failed), len(failed), time.time() - start, tsv_path))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(_cli())
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Times make_mosaic with the PIL and numpy backends on a directory of
+brainsprite frames. If no directory is given, makes a set of synthetic
+900x800 frames (the size wb_command renders) in a temporary directory.
+"""
+
+import os
+import argparse
+import shutil
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from ExecutiveSummary import make_mosaic
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='bench_mosaic',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument(
+            '--pngs-dir', dest='pngs_dir',
+            metavar='PNGS_PATH',
+            help='Optional. Directory of brainsprite frames, e.g. files/T1_pngs. '
+            'Default: synthetic frames.'
+            )
+    parser.add_argument(
+            '--frames', dest='frames', type=int, default=169,
+            help='Number of synthetic frames to make. Default: 169.'
+            )
+    parser.add_argument(
+            '--repeat', dest='repeat', type=int, default=3,
+            help='Number of times to run each backend. Default: 3.'
+            )
+    parser.add_argument(
+            '--jobs', '-j', dest='jobs', type=int, default=1,
+            help='Number of worker processes passed to make_mosaic. Default: 1.'
+            )
+
+    return parser
+
+
+def make_frames(pngs_dir, count, size=(900, 800)):
+    # Each frame is a gray ellipse with some noise on a black background,
+    # which compresses and resamples about like a real brainsprite frame.
+    width, height = size
+    yy, xx = np.mgrid[0:height, 0:width]
+    rng = np.random.RandomState(0)
+    for i in range(1, count + 1):
+        radius = 0.2 + 0.2 * np.sin(np.pi * i / count)
+        inside = ((xx - width / 2) / width) ** 2 + ((yy - height / 2) / height) ** 2 < radius ** 2
+        frame = np.where(inside, 128 + rng.randint(-40, 40, size=inside.shape), 0)
+        frame = np.repeat(frame[:, :, np.newaxis], 3, axis=2).astype(np.uint8)
+        Image.fromarray(frame, 'RGB').save(os.path.join(pngs_dir, 'P_T1_frame_%d.png' % i))
+
+
+def time_backend(pngs_dir, mosaic_path, backend, repeat, jobs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        make_mosaic(pngs_dir, mosaic_path, workers=jobs, backend=backend)
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_mosaic_')
+    try:
+        pngs_dir = args.pngs_dir
+        if pngs_dir is None:
+            pngs_dir = os.path.join(work_dir, 'T1_pngs')
+            os.makedirs(pngs_dir)
+            print('Making %s synthetic frames in %s.' % (args.frames, pngs_dir))
+            make_frames(pngs_dir, args.frames)
+        pngs_dir = os.path.abspath(pngs_dir)
+
+        results = {}
+        for backend in [ 'pil', 'numpy' ]:
+            mosaic_path = os.path.join(work_dir, 'mosaic_%s.jpg' % backend)
+            results[backend] = time_backend(pngs_dir, mosaic_path, backend,
+                    args.repeat, args.jobs)
+            print('%-6s best %.3fs  mean %.3fs' % ((backend,) + results[backend]))
+
+        # Report how far apart the two mosaics are, so a speedup is not
+        # bought with a different-looking sprite.
+        pil = np.asarray(Image.open(os.path.join(work_dir, 'mosaic_pil.jpg')), dtype=np.int16)
+        vec = np.asarray(Image.open(os.path.join(work_dir, 'mosaic_numpy.jpg')), dtype=np.int16)
+        print('speedup %.2fx  mean abs pixel difference %.2f' % (
+                results['pil'][0] / results['numpy'][0], np.abs(pil - vec).mean()))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+
+    _cli()
@@ -55,11 +55,18 @@ HTML_START = """
 <!DOCTYPE html>
 <html>
 <meta name="viewport" content="width=device-width, initial-scale=1">
-<link rel="stylesheet" href="https://www.w3schools.com/w3css/4/w3.css">
+"""
+
+# The stylesheets from their CDNs. (assets.py has the stylesheet to use
+# instead, for pages that must not make network requests.)
+CDN_STYLESHEETS = """<link rel="stylesheet" href="https://www.w3schools.com/w3css/4/w3.css">
 <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/4.7.0/css/font-awesome.min.css">
 <link rel="stylesheet" href="https://use.fontawesome.com/releases/v5.7.0/css/all.css"
     integrity="sha384-lZN37f5QGtY3VHgisS14W3ExzMWZxybE1SJSEsQp9S+oqd12jhcu+A56Ebc1zFSJ" crossorigin="anonymous">
-<style type="text/css">
+"""
+
+# The page's own styles; follows the stylesheets.
+PAGE_STYLE = """<style type="text/css">
     header, footer, section, article, nav, aside { display: block; }
     h1, h2, h3, body, button, p, w3-btn { font-family: Verdana, Helvetica, Arial, Bookman, sans-serif; }
     h1 { text-align: center; font-size: 2.5em; }
@@ -74,9 +81,7 @@ HTML_START = """
     .label3 { font-size: 1.25em; text-align: left; }
     .label4 { font-size: 1.00em; text-align: center; }
     .grid-container { grid-gap: 2px; padding: 2px; }
-    .T1pngs, .T2pngs, .Registrations, .Images { display: none; }
     .modal { vertical-align: top; margin-top:0; border-top-style:none; padding-top:0; top:0; height: 100%; width: auto; }
-    .Images{ height: 100%; width: auto; }
 </style>
 <body>
 """
@@ -125,21 +130,21 @@ TX_SECTION = """
 LAYOUT_ROW = """
         <div  class="w3-row-padding">
             <div class="w3-col l1 label2">{row_label}</div>
-            <div class="w3-col l11"><img src="{row_img}" onclick="open_{row_modal}_to_index({row_idx})"></div>
+            <div class="w3-col l11"><img src="{row_img}" onclick="open_slides('{row_modal}', {row_idx})"></div>
         </div>
         """
 
 LAYOUT_HALF_ROW = """
         <div  class="w3-row-padding">
             <div class="w3-col l2 label2">{row_label}</div>
-            <div class="w3-col l9"><img src="{row_img}" onclick="open_{row_modal}_to_index({row_idx})"></div>
+            <div class="w3-col l9"><img src="{row_img}" onclick="open_slides('{row_modal}', {row_idx})"></div>
         </div>
         """
 
 LAYOUT_QUARTER_ROW = """
             <div class="w3-quarter">
                 <div class="w3-row w3-center label1">{row_label}</div>
-                <div class="w3-row"><img src="{row_img}" onclick="open_{row_modal}_to_index({row_idx})"></div>
+                <div class="w3-row"><img src="{row_img}" onclick="open_slides('{row_modal}', {row_idx})"></div>
             </div>
             """
 
@@ -270,19 +275,33 @@ MODAL_START = """
 # Needs the following values:
 #    modal_id, btn_label
 DISPLAY_MODAL_BUTTON = """
-            <button class="w3-btn w3-teal" onclick="open_{modal_id}_to_index(1)">{btn_label}</button>
+            <button class="w3-btn w3-teal" onclick="open_slides('{modal_id}', 1)">{btn_label}</button>
             """
 
+# The one image in a modal container, with the filename of the image being
+# shown in the upper left corner. The filename is 'w3-black' so that the
+# text will be white and show up against the fMRI image without being too
+# obtrusive. SLIDES_SCRIPTS sets the image and its name from the container's
+# list of slides when the container is opened, or the slide is changed.
+# Needs the following values:
+#    modal_id
+SLIDE_IMAGE = """
+                <div class="w3-display-container">
+                    <img id="{modal_id}-img" alt="">
+                    <div class="w3-display-topleft w3-black"><p id="{modal_id}-label"></p></div>
+                </div>
+                """
+
 # Add the containers' buttons at the end, so that they don't
 # get covered by the images. Every slider needs a left and
 # right button.
 # Needs the following values:
-#    image_class
+#    modal_id
 SLIDER_END = """
                 <button class="w3-button w3-black w3-display-bottomleft w3-xxlarge"
-                    onclick="change_{image_class}(-1)"><i class="fas fa-angle-left"></i></button>
+                    onclick="change_slide('{modal_id}', -1)"><i class="fas fa-angle-left"></i></button>
                 <button class="w3-button w3-black w3-display-bottomright w3-xxlarge"
-                    onclick="change_{image_class}(1)"><i class="fas fa-angle-right"></i></button>
+                    onclick="change_slide('{modal_id}', 1)"><i class="fas fa-angle-right"></i></button>
                     """
 # The modal window needs a close button; then, close up the
 # elements.
@@ -296,75 +315,86 @@ MODAL_END = """
     </div>
 """
 
-
-# Add an image in a container with its filename displayed in the
-# upper left corner. The filename is 'w3-black' so that the text
-# will be white and show up against the fMRI image without being
-# too obtrusive.
-# We assign a specific class so that scripts can find the images
-# by calling getElementsByClassName().
+# The slides of a modal container, as JSON: {"slider": true or false,
+# "slides": [{"src": path, "label": name}, ...]}, in the order they were added.
 # Needs the following values:
-#    image_class, image_file, display_name.
-IMAGE_WITH_CLASS = """
-                <div class="w3-display-container {image_class}">
-                    <img src="{image_file}">
-                    <div class="w3-display-topleft w3-black"><p>{display_name}</p></div>
-                </div>
-                """
+#    modal_id, slides_json
+SLIDES_MANIFEST = """
+<script type="application/json" id="%(modal_id)s-slides">%(slides_json)s</script>
+"""
 
-# The modal scripts that will show the chosen image.
-# Needs the following values:
-#    modal_id, image_class.
-MODAL_SCRIPTS = """
+# The images in the modal containers and sliders are not loaded with the
+# page: only the containers' manifests (SLIDES_MANIFEST) name them, and
+# these load each one when it is shown (and, for sliders, the ones either
+# side of it, so the next click does not wait). Slides are items of a
+# manifest's list, and idx is 0-based. Include once, before SLIDES_SCRIPTS.
+LAZY_IMAGE_SCRIPTS = """
 <script>
-    var %(image_class)sIdx = 1;
-    show_%(image_class)s(%(image_class)sIdx)
-
-    function show_%(image_class)s(n) {
-        var i;
-        var x = document.getElementsByClassName("%(image_class)s");
-        if (n > x.length) { %(image_class)sIdx = 1 }
-        if (n < 1) { %(image_class)sIdx = x.length }
-        for (i = 0; i < x.length; i++) {
-            x[i].style.display = "none";
-        }
-        x[%(image_class)sIdx-1].style.display = "block";
+    function load_deferred(slide) {
+        if (!slide || slide.loaded) { return }
+        new Image().src = slide.src;
+        slide.loaded = true;
     }
 
-    function open_%(modal_id)s_to_index(idx) {
-        show_%(image_class)s(%(image_class)sIdx = idx)
-        document.getElementById("%(modal_id)s").style.display='block'
+    function load_deferred_around(slides, idx) {
+        if (slides.length == 0) { return }
+        load_deferred(slides[idx]);
+        load_deferred(slides[(idx + 1) % slides.length]);
+        load_deferred(slides[(idx - 1 + slides.length) % slides.length]);
     }
 </script>
 """
 
-# The slider scripts that will show the next or previous image
-# in a given class.
-# Needs the following values:
-#    modal_id, image_class.
-SLIDER_SCRIPTS = """
+# The scripts that show the slides of every modal container and slider.
+# Include once, after LAZY_IMAGE_SCRIPTS. A container's slides are read from
+# its manifest the first time it is opened; showing a slide only sets the
+# src of its one image. Sliders then load the slides either side of it with
+# load_deferred_around; the image modal loads just the image clicked.
+# Indices are 1-based, as in the rows' onclick.
+SLIDES_SCRIPTS = """
 <script>
-    var %(image_class)sIdx = 1;
-    show_%(image_class)s(%(image_class)sIdx)
-
-    function change_%(image_class)s(n) {
-        show_%(image_class)s(%(image_class)sIdx += n)
+    var slide_sets = {};
+
+    function get_slides(modal_id) {
+        if (!(modal_id in slide_sets)) {
+            var manifest = document.getElementById(modal_id + "-slides");
+            var data = manifest ? JSON.parse(manifest.textContent) : {};
+            slide_sets[modal_id] = {
+                slides: data.slides || [],
+                slider: data.slider,
+                idx: 1,
+                img: document.getElementById(modal_id + "-img"),
+                label: document.getElementById(modal_id + "-label") };
+        }
+        return slide_sets[modal_id];
     }
 
-    function show_%(image_class)s(n) {
-        var i;
-        var x = document.getElementsByClassName("%(image_class)s");
-        if (n > x.length) { %(image_class)sIdx = 1 }
-        if (n < 1) { %(image_class)sIdx = x.length }
-        for (i = 0; i < x.length; i++) {
-            x[i].style.display = "none";
+    function show_slide(modal_id, n) {
+        var set = get_slides(modal_id);
+        var count = set.slides.length;
+        if (count == 0) { return }
+        if (n > count) { n = 1 }
+        if (n < 1) { n = count }
+        set.idx = n;
+
+        var slide = set.slides[n - 1];
+        slide.loaded = true;
+        set.img.src = slide.src;
+        set.img.alt = slide.label;
+        set.label.textContent = slide.label;
+
+        if (set.slider) {
+            load_deferred_around(set.slides, n - 1);
         }
-        x[%(image_class)sIdx-1].style.display = "block";
     }
 
-    function open_%(modal_id)s_to_index(idx) {
-        show_%(image_class)s(%(image_class)sIdx = idx)
-        document.getElementById("%(modal_id)s").style.display='block'
+    function change_slide(modal_id, n) {
+        show_slide(modal_id, get_slides(modal_id).idx + n);
+    }
+
+    function open_slides(modal_id, idx) {
+        show_slide(modal_id, idx);
+        document.getElementById(modal_id).style.display='block'
     }
 </script>
 """
@@ -385,20 +415,123 @@ SPRITE_VIEWER_HTML = """
 # The loader script to be run when then window loads. Put this
 # with other scripts.
 # Needs the following values:
-#    tx, viewer, spriteImg.
+#    tx, viewer, spriteImg, nb_slice_y, nb_slice_z, voxel_size, origin.
 SPRITE_LOAD_SCRIPT = """
 <script>
-   $( window ).load(function() {
+   window.addEventListener('load', function() {
        var brain%(tx)s = brainsprite({
          canvas: "%(viewer)s",
          sprite: "%(spriteImg)s",
-         nbSlice: { 'Y':218 , 'Z':218 },
+         nbSlice: { 'Y':%(nb_slice_y)s , 'Z':%(nb_slice_z)s },
+         voxelSize: %(voxel_size)s,
+         origin: %(origin)s,
          flagCoordinates: true,
        });
    });
 </script>
 """
 
+# Values for the loader script when the mosaic was made from frames
+# rendered by wb_command: 218x218 tiles, and brainsprite's own defaults
+# for the coordinates. A mosaic sliced from the volume has a .json file
+# next to it with the values to use instead.
+SPRITE_DEFAULT_PARAMS = {
+    'nbSlice'   : { 'Y': 218, 'Z': 218 },
+    'voxelSize' : 1,
+    'origin'    : { 'X': 0, 'Y': 0, 'Z': 0 }
+    }
+
+# The brainsprite canvas for a tiled mosaic (see sprite_tiles.py). The
+# mosaic is drawn, a band at a time, into a hidden canvas of its full size,
+# which brainsprite reads in place of the mosaic image.
+# Needs the following values:
+#    width, viewer, spriteImg, sprite_width, sprite_height.
+TILED_SPRITE_VIEWER_HTML = """
+        <div w3-row w3-hide-small>
+           <canvas id="{viewer}" style="max-width: {width}">
+           <canvas id="{spriteImg}" style="display: none" width="{sprite_width}" height="{sprite_height}"></canvas>
+        </div>
+        """
+
+# The loader script for a tiled mosaic. It starts as soon as the document
+# is parsed, rather than when the window (with all its images) has loaded.
+# Needs the following values:
+#    tx, viewer, spriteImg, nb_slice_y, nb_slice_z, voxel_size, origin,
+#    tiles (the index of the bands, with their paths, as JSON).
+TILED_SPRITE_LOAD_SCRIPT = """
+<script>
+   document.addEventListener('DOMContentLoaded', function() {
+       var brain%(tx)s = load_sprite_tiles({
+         canvas: "%(viewer)s",
+         sprite: "%(spriteImg)s",
+         nbSlice: { 'Y':%(nb_slice_y)s , 'Z':%(nb_slice_z)s },
+         voxelSize: %(voxel_size)s,
+         origin: %(origin)s,
+         flagCoordinates: true,
+       }, %(tiles)s);
+   });
+</script>
+"""
+
+# Loads the bands of a tiled mosaic into its canvas, two at a time, always
+# next fetching the band nearest the sagittal slice being shown. The viewer
+# is made when the first band arrives, and redrawn as each one follows.
+# Include once, with BRAINSPRITE_SCRIPTS.
+TILED_SPRITE_SCRIPTS = """
+<script>
+function load_sprite_tiles(params, tiles) {
+  var sprite = document.getElementById(params.sprite);
+  var context = sprite.getContext('2d');
+  var nbCol = tiles.width / params.nbSlice.Y;
+  var middle = Math.floor(nbCol * (tiles.height / params.nbSlice.Z) / 2);
+  var pending = tiles.bands.map(function(src, band) { return band; });
+  var loading = 0;
+  var loader = { brain: null };
+
+  function nearest_band() {
+    var slice = loader.brain ? loader.brain.numSlice.X : middle;
+    var current = Math.floor(slice / nbCol);
+    var best = 0;
+    for (var i = 1; i < pending.length; i++) {
+      if (Math.abs(pending[i] - current) < Math.abs(pending[best] - current)) { best = i }
+    }
+    return pending.splice(best, 1)[0];
+  }
+
+  function load_band(band) {
+    var img = new Image();
+    loading++;
+    img.onload = function() {
+      context.drawImage(img, 0, band * tiles.bandHeight);
+      if (loader.brain === null) {
+        loader.brain = brainsprite(params);
+      } else {
+        loader.brain.init();
+        loader.brain.drawAll();
+      }
+      loading--;
+      load_more();
+    };
+    img.onerror = function() {
+      console.warn('Could not load ' + tiles.bands[band]);
+      loading--;
+      load_more();
+    };
+    img.src = tiles.bands[band];
+  }
+
+  function load_more() {
+    while (loading < 2 && pending.length > 0) {
+      load_band(nearest_band());
+    }
+  }
+
+  load_more();
+  return loader;
+}
+</script>
+"""
+
 # The rest of this is scripts for brainsprite. Since brainsprite is no
 # longer supported, and since this is working, leave as is!
 # This contant is only needed once (thank goodness) and does not need
@@ -882,8 +1015,174 @@ function brainsprite(params) {
   return brain;
 };
 </script>
-<script src="http://ajax.googleapis.com/ajax/libs/jquery/2.1.1/jquery.min.js"></script>
-<script src="http://ajax.googleapis.com/ajax/libs/jqueryui/1.9.1/jquery-ui.min.js"></script>
 """
 
 
+
+# STUDY INDEX STUFF
+
+# The study index (study_index.py): one row per subject/session, with the
+# previews of its atlas and gray-plot images and a link to its page. The
+# page makes no network requests.
+STUDY_INDEX_START = """<!DOCTYPE html>
+<html>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<style type="text/css">
+    body { margin: 0; font-family: Verdana, Helvetica, Arial, sans-serif; font-size: 14px; }
+    header { padding: 8px 16px; background: #009688; color: #fff; }
+    h1 { font-size: 1.6em; font-weight: normal; margin: 4px 0; }
+    #controls { padding: 8px 16px; }
+    #filter { width: 24em; padding: 4px; font: inherit; }
+    .table-row { display: flex; align-items: center; box-sizing: border-box;
+                 height: 92px; border-bottom: 1px solid #ddd; }
+    .table-row > div { padding: 0 8px; overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
+    .col-subject { width: 14%; } .col-session { width: 10%; } .col-date { width: 12%; }
+    .col-tasks { width: 6%; text-align: right; } .col-atlas, .col-gray { width: 29%; }
+    .col-atlas img, .col-gray img { max-height: 84px; max-width: 100%; }
+    #head { height: 36px; background: #eee; font-weight: bold; cursor: pointer; user-select: none; }
+    #viewport { position: relative; overflow-y: auto; height: calc(100vh - 150px); }
+    #rows { position: relative; }
+    #rows .table-row { position: absolute; left: 0; right: 0; }
+</style>
+<body>
+"""
+
+# Needs the following values:
+#    title, count
+STUDY_INDEX_HEADER = """
+<title>{title}</title>
+<header><h1>{title}</h1></header>
+<div id="controls">
+    <input id="filter" type="search" placeholder="Filter by subject or session">
+    <span id="shown">{count} sessions</span>
+</div>
+<div id="head" class="table-row">
+    <div class="col-subject" data-key="subject">Subject</div>
+    <div class="col-session" data-key="session">Session</div>
+    <div class="col-date" data-key="date">Updated</div>
+    <div class="col-tasks" data-key="tasks">Tasks</div>
+    <div class="col-atlas">Atlas in T1</div>
+    <div class="col-gray">Pre-Regression</div>
+</div>
+<div id="viewport"><div id="rows"></div></div>
+"""
+
+# The sessions, as JSON: a list of objects with subject, session, date,
+# tasks, page, atlas and gray (paths relative to the index page, or null).
+# Needs the following values:
+#    sessions_json
+STUDY_INDEX_DATA = """
+<script type="application/json" id="sessions">%(sessions_json)s</script>
+"""
+
+# Only the rows in view (and a few either side) are in the document: the
+# rows container is as tall as all of them, and on each scroll the rows in
+# view are made again. Sorting and filtering only reorder the list of
+# sessions shown, so they stay quick with tens of thousands of sessions.
+STUDY_INDEX_SCRIPTS = """
+<script>
+(function() {
+    var ROW_HEIGHT = 92, OVERSCAN = 8;
+    var sessions = JSON.parse(document.getElementById('sessions').textContent);
+    var shown = sessions.slice();
+    var sort_key = 'subject', sort_dir = 1;
+    var viewport = document.getElementById('viewport');
+    var rows = document.getElementById('rows');
+    var pending = false;
+
+    function cell(cls, text) {
+        var div = document.createElement('div');
+        div.className = cls;
+        if (text !== null && text !== undefined) { div.textContent = text }
+        return div;
+    }
+
+    function preview(cls, src, page) {
+        var div = cell(cls, null);
+        if (src) {
+            var link = document.createElement('a');
+            link.href = page;
+            var img = document.createElement('img');
+            img.src = src;
+            link.appendChild(img);
+            div.appendChild(link);
+        }
+        return div;
+    }
+
+    function make_row(item, idx) {
+        var row = document.createElement('div');
+        row.className = 'table-row';
+        row.style.top = (idx * ROW_HEIGHT) + 'px';
+
+        var subject = cell('col-subject', null);
+        var link = document.createElement('a');
+        link.href = item.page;
+        link.textContent = item.subject;
+        subject.appendChild(link);
+        row.appendChild(subject);
+        row.appendChild(cell('col-session', item.session || ''));
+        row.appendChild(cell('col-date', item.date));
+        row.appendChild(cell('col-tasks', item.tasks));
+        row.appendChild(preview('col-atlas', item.atlas, item.page));
+        row.appendChild(preview('col-gray', item.gray, item.page));
+        return row;
+    }
+
+    function render() {
+        pending = false;
+        var first = Math.max(0, Math.floor(viewport.scrollTop / ROW_HEIGHT) - OVERSCAN);
+        var last = Math.min(shown.length,
+                Math.ceil((viewport.scrollTop + viewport.clientHeight) / ROW_HEIGHT) + OVERSCAN);
+        var fragment = document.createDocumentFragment();
+        for (var i = first; i < last; i++) {
+            fragment.appendChild(make_row(shown[i], i));
+        }
+        rows.textContent = '';
+        rows.appendChild(fragment);
+    }
+
+    function schedule() {
+        if (!pending) {
+            pending = true;
+            window.requestAnimationFrame(render);
+        }
+    }
+
+    function compare(a, b) {
+        var x = a[sort_key], y = b[sort_key];
+        if (x === y) { return 0 }
+        if (x === null || x === undefined) { return 1 }
+        if (y === null || y === undefined) { return -1 }
+        if (typeof x === 'number' && typeof y === 'number') { return (x - y) * sort_dir }
+        return String(x).localeCompare(String(y), undefined, { numeric: true }) * sort_dir;
+    }
+
+    function update() {
+        var text = document.getElementById('filter').value.toLowerCase();
+        shown = sessions.filter(function(item) {
+            return !text || (item.subject + ' ' + (item.session || '')).toLowerCase().indexOf(text) >= 0;
+        });
+        shown.sort(compare);
+        rows.style.height = (shown.length * ROW_HEIGHT) + 'px';
+        document.getElementById('shown').textContent = shown.length + ' of ' + sessions.length + ' sessions';
+        viewport.scrollTop = 0;
+        render();
+    }
+
+    document.getElementById('head').addEventListener('click', function(e) {
+        var key = e.target.getAttribute('data-key');
+        if (!key) { return }
+        sort_dir = (key === sort_key) ? -sort_dir : 1;
+        sort_key = key;
+        update();
+    });
+    document.getElementById('filter').addEventListener('input', update);
+    viewport.addEventListener('scroll', schedule);
+    window.addEventListener('resize', schedule);
+    update();
+})();
+</script>
+</body>
+</html>
+"""
@@ -3,7 +3,7 @@
 # Note: This file was copied from FNL_preproc_preproc.sh.
 # It performs the steps needed to prep for exec summary. It does NOT call FNL_preproc.sh.
 
-options=`getopt -o i:o:d:s:v:a:b:p:hx -l bids-input:,output-dir:,html-path:,subject-id:,session-id:,atlas:,brainsprite-template:,pngs-template:,help,skip_sprite -n 'executivesummary_preproc.sh' -- $@`
+options=`getopt -o i:o:d:s:v:a:b:p:j:hx -l bids-input:,output-dir:,html-path:,subject-id:,session-id:,atlas:,brainsprite-template:,pngs-template:,sprite-resolution,native-sprite,native-render,incremental,trace-events:,jobs:,help,skip_sprite -n 'executivesummary_preproc.sh' -- $@`
 eval set -- "$options"
 function display_help() {
     echo "Usage: `basename $0` [options...]                                                                             "
@@ -21,6 +21,17 @@ function display_help() {
     echo "      -a|--atlas                Atlas file for generation of rest image. Overrides adult MNI 1mm atlas.       "
     echo "      -b|--brainsprite-template Path to template that has all of the scenes for the brainsprite (usually 169)."
     echo "      -p|--pngs-template        Path to template with scenes for Tx pngs (these are named, so should agree).  "
+    echo "      --sprite-resolution       Render the brainsprite frames at the size of a mosaic tile (218x194) instead  "
+    echo "                                of 900x800.                                                                   "
+    echo "      --native-sprite           Do not render brainsprite frames; the caller slices the volumes for the       "
+    echo "                                mosaics itself.                                                               "
+    echo "      --native-render           Draw the slice rows, subcorticals and BOLD/SBRef previews with                "
+    echo "                                slice_renderer.py instead of slicesdir and slicer.                            "
+    echo "      -j|--jobs                 Number of renders (or tasks) to process at the same time. Default is 1.       "
+    echo "      --incremental             Keep the images from the last run, and only make again the ones whose inputs  "
+    echo "                                have changed since.                                                           "
+    echo "      --trace-events            File to which to append a trace event for each tool run. Default is           "
+    echo "                                \$ES_TRACE_EVENTS, if set (see trace_events.py).                              "
     echo "      -h|--help                 Display this message.                                                         "
     exit $1
 }
@@ -63,6 +74,30 @@ while true ; do
             pngs_template="$2"
             shift 2
             ;;
+        --sprite-resolution)
+            sprite_resolution="tile"
+            shift 1
+            ;;
+        --native-sprite)
+            native_sprite="native"
+            shift 1
+            ;;
+        --native-render)
+            native_render="native"
+            shift 1
+            ;;
+        -j|--jobs)
+            max_jobs="$2"
+            shift 2
+            ;;
+        --incremental)
+            incremental="incremental"
+            shift 1
+            ;;
+        --trace-events)
+            export ES_TRACE_EVENTS="$2"
+            shift 2
+            ;;
         -x|--skip_sprite) # Stealth arg used only for debug.
             skip_sprite="skip"
             shift 1
@@ -89,6 +124,19 @@ echo html-path=${html_path}
 echo bids-input=${bids_input}
 echo session-id=${session_id}
 echo atlas=${atlas}
+echo sprite-resolution=${sprite_resolution}
+echo native-sprite=${native_sprite}
+echo native-render=${native_render}
+echo jobs=${max_jobs}
+echo incremental=${incremental}
+echo trace-events=${ES_TRACE_EVENTS}
+
+if [ -z "${max_jobs}" ] ; then
+    max_jobs=1
+elif ! [[ "${max_jobs}" =~ ^[1-9][0-9]*$ ]] ; then
+    echo "jobs must be a positive integer: ${max_jobs}"
+    display_help 1
+fi
 
 if [ -n "${skip_sprite}" ] ; then
     # This is a 'stealth' arg.
@@ -144,9 +192,11 @@ fi
 # Make the subfolder for the images. All paths in the html are relative to
 # the html folder, so must img must remain a subfolder to the html folder.
 
-# Lose old images.
+# Lose old images (unless they are to be reused).
 images_path=${html_path}/img
-if [ -d ${images_path} ] ; then
+if [ -n "${incremental}" ] ; then
+    echo Keep images from prior runs: only images with changed inputs will be made.
+elif [ -d ${images_path} ] ; then
     echo Remove images from prior runs.
     if [ -n "${skip_sprite}" ] ; then
         # Cheat - keep the mosaics, and don't bother to log each file removed.
@@ -177,11 +227,27 @@ if ! [ -d ${working} ] ; then
     exit 1
 fi
 
+# The inputs each image was made from are kept here, for --incremental.
+manifest_dir=${html_path}/manifest
+mkdir -p ${manifest_dir}
+
 chown -R :${GROUP} ${html_path} || true
 chmod -R 770 ${html_path} || true
 
 
 
+# Size of the frames rendered for the brainsprite. make_mosaic shrinks each
+# frame to fit in a 218 pixel tile, so rendering at the tile size (keeping
+# the 900x800 aspect ratio) skips work that would be thrown away.
+if [ -n "${sprite_resolution}" ] ; then
+    sprite_width=218
+    sprite_height=194
+else
+    sprite_width=900
+    sprite_height=800
+fi
+
+
 ############ HELPER FUNCTIONS ##############
 
     # Prints the error message and the line of code, where the error occurred; then Exits the script.
@@ -193,43 +259,64 @@ chmod -R 770 ${html_path} || true
         if [[ -n "$msg" ]]; then
             echo ${msg} >&2
         fi
+        if [ -n "${scene_dir}" ] ; then
+            rm -rf ${scene_dir}
+        fi
 
         exit ${err_code}
     }
     trap 'print_error' ERR
 
-    #takes the following arguments: t2_path t1_path rp_path lp_path rw_path lw_path
-    build_scene_from_pngs_template(){
-        # Make a copy of the scene template as we will be making modifications.
-        cp ${pngs_template} ${pngs_scene}
-
-        declare -a templates=('T2_IMG' 'T1_IMG' 'RPIAL' 'LPIAL' 'RWHITE' 'LWHITE')
-        declare -a paths=($1 $2 $3 $4 $5 $6)
-
-        for i in `seq 0 5`;
-        do
-            # Replace templated pathnames and filenames in local copy.
-            sed -i "s!${templates[$i]}_PATH!${paths[$i]}!g" ${pngs_scene}
-            filename=$(basename "${paths[$i]}")
-            sed -i "s!${templates[$i]}_NAME!${filename}!g" ${pngs_scene}
-        done
+    # When the run is traced (ES_TRACE_EVENTS names an events file; see
+    # trace_events.py), each run of the tools below is timed and appended to
+    # the file as a trace event, with the command and its exit status. The
+    # tools are replaced by functions that call trace_tool.
+    #takes the following arguments: command [args...]
+    trace_tool() {
+        local start=$( date +%s%6N )
+        local status=0
+        command "$@" || status=$?
+        local end=$( date +%s%6N )
+        local cmd="$*"
+        cmd=${cmd//\\/\\\\}
+        cmd=${cmd//\"/\\\"}
+        printf '{"name": "%s", "cat": "tool", "ph": "X", "ts": %s, "dur": %s, "pid": %s, "tid": %s, "args": {"command": "%s", "status": %s}}\n' \
+            "$( basename $1 )" ${start} $(( end - start )) $$ ${BASHPID} "${cmd}" ${status} >> ${ES_TRACE_EVENTS}
+        return ${status}
     }
 
-    build_scene_from_brainsprite_template(){
-        # Make a copy of the brainsprite_scene template as we will be making modifications.
-        cp ${brainsprite_template} ${brainsprite_scene}
+    if [ -n "${ES_TRACE_EVENTS}" ] ; then
+        printf '{"name": "process_name", "ph": "M", "pid": %s, "args": {"name": "executivesummary_preproc.sh"}}\n' $$ >> ${ES_TRACE_EVENTS}
+        for tool in flirt fslhd fslmaths imcp slicesdir slicer pngappend python ; do
+            eval "${tool}() { trace_tool ${tool} \"\$@\" ; }"
+        done
+        wb_command="trace_tool ${wb_command}"
+    fi
+
+    # The scenes are made from the templates by scene_template.py, which
+    # replaces every placeholder in one pass. They are written to scratch
+    # space on this node, not to the output directory.
+    scene_dir=$( mktemp -d ${TMPDIR:-/tmp}/executivesummary_scenes.XXXXXX )
 
-        declare -a templates=('TX_IMG' 'R_PIAL' 'L_PIAL' 'R_WHITE' 'L_WHITE')
-        declare -a paths=($1 $2 $3 $4 $5)
+    # The scenes to make, as scene_template.py arguments. Add each with
+    # add_*_scene, then make them all with build_scenes: one python process
+    # for the run, which reads each template once.
+    scene_args=()
 
-        for i in `seq 0 4`; do
-            # Replace templated pathnames and filenames in local copy.
-            echo sed -i "s!${templates[$i]}_NAME_and_PATH!${paths[$i]}!g" ${brainsprite_scene}
-            sed -i "s!${templates[$i]}_NAME_and_PATH!${paths[$i]}!g" ${brainsprite_scene}
-            filename=$(basename "${paths[$i]}")
-            echo sed -i "s!${templates[$i]}_NAME!${filename}!g" ${brainsprite_scene}
-            sed -i "s!${templates[$i]}_NAME!${filename}!g" ${brainsprite_scene}
-        done
+    #takes the following arguments: t2_path t1_path rp_path lp_path rw_path lw_path
+    add_pngs_scene(){
+        scene_args+=( --scene ${pngs_template} ${pngs_scene} \
+            T2_IMG=$1 T1_IMG=$2 RPIAL=$3 LPIAL=$4 RWHITE=$5 LWHITE=$6 )
+    }
+
+    #takes the following arguments: scene_path tx_path rp_path lp_path rw_path lw_path
+    add_brainsprite_scene(){
+        scene_args+=( --scene ${brainsprite_template} $1 \
+            TX_IMG=$2 R_PIAL=$3 L_PIAL=$4 R_WHITE=$5 L_WHITE=$6 )
+    }
+
+    build_scenes(){
+        python ${scriptdir}/scene_template.py "${scene_args[@]}"
     }
 
     #takes the following arguments: out_path scenenum
@@ -240,34 +327,81 @@ chmod -R 770 ${html_path} || true
 
     }
 
+    #takes the following arguments: Tx scene
     create_images_from_brainsprite_scene() {
+        # Queues a render for each frame; call wait_for_jobs to finish them.
         Tx=${1}
-        total_frames=$( grep "SceneInfo Index=" ${brainsprite_scene} | wc -l )
+        scene=${2}
+        total_frames=$( grep "SceneInfo Index=" ${scene} | wc -l )
 
         for ((i=1 ; i<=${total_frames} ;  i++)); do
             out=${processed_files}/${Tx}_pngs/P_${Tx}_frame_${i}.png
-            echo $i
-            echo ${wb_command} -show-scene ${brainsprite_scene} ${i} ${out} 900 800
-            ${wb_command} -show-scene ${brainsprite_scene} ${i} ${out} 900 800
+            echo ${wb_command} -show-scene ${scene} ${i} ${out} ${sprite_width} ${sprite_height}
+            run_job "${Tx} frame ${i}" ${wb_command} -show-scene ${scene} ${i} ${out} ${sprite_width} ${sprite_height}
         done
     }
 
+    # A small job pool, so that independent renders can run side by side.
+    # run_job runs a command in the background as soon as fewer than
+    # max_jobs are running. If the command fails, its label is added to the
+    # failures file, so wait_for_jobs can report every job that failed.
+    # (The label is written from an EXIT trap rather than with ||, so that
+    # set -e still stops a function part way through when one of its steps
+    # fails.)
+    job_failures=${working}/job_failures
+    rm -f ${job_failures}
+
+    #takes the following arguments: label command [args...]
+    run_job() {
+        local label=$1
+        shift
+        while (( $( jobs -rp | wc -l ) >= ${max_jobs} )) ; do
+            wait -n || true
+        done
+        (
+            trap '(( $? == 0 )) || echo "${label}" >> ${job_failures}' EXIT
+            "$@"
+        ) &
+    }
+
+    #takes the following arguments: stage
+    wait_for_jobs() {
+        local stage=$1
+        wait
+        if [ -s ${job_failures} ] ; then
+            echo "${stage}: $( wc -l < ${job_failures} ) job(s) failed:" >&2
+            sed 's/^/    /' ${job_failures} >&2
+            rm -f ${job_failures}
+            return 1
+        fi
+        echo "${stage}: all jobs finished."
+    }
+
 
     make_default_slices_row() {
         # This function uses the default slices made by slicesdir (.4, .5, and
         # .6). It calls slicesdir, grabs the output png, and cleans up the
         # subdirectory left by slicesdir (also called slicesdir).
         # Note: everything must be "local" or we get horrible filenames. Also,
-        # this whole process makes a mess. So use the working directory.
+        # this whole process makes a mess. So use the working directory, or
+        # the directory given (so that jobs running at the same time do not
+        # clobber each other's files).
 
         base_img=$1
         out_png=$2
         red_img=$3 # optional
+        work_dir=${4:-${working}} # optional
+
+        if [ -n "${native_render}" ] ; then
+            # Queue the row; slice_renderer.py draws all of them at the end.
+            queue_image row ${base_img} ${out_png} ${red_img}
+            return
+        fi
 
         img_file=$( basename ${base_img} )
         img_png=${img_file/.nii.gz/.png}
 
-        pushd ${working}
+        pushd ${work_dir}
         imcp ${base_img} ./${img_file}
 
         if [ -n "${red_img}" ] ; then
@@ -283,6 +417,206 @@ chmod -R 770 ${html_path} || true
         popd
     }
 
+    # Most runs of a session share a voxel grid, so the brains resampled to
+    # one task image can be reused for the others. The cache is keyed on the
+    # header fields that define the grid. It only lives for this run: markers
+    # left by an earlier run (which may have had other T1/T2 images, or have
+    # been killed) are removed first.
+    resample_cache=${working}/resample_cache
+    resample_log=${resample_cache}/log
+    rm -rf ${resample_cache}
+    mkdir -p ${resample_cache}
+
+    #takes the following arguments: img
+    grid_key() {
+        # Prints a hash of the dimensions, voxel sizes, and sform and qform
+        # of the image.
+        fslhd $1 | grep -E '^(dim[1-3]|pixdim[1-3]|[qs]form_code|[qs]to_xyz:[1-4])[[:space:]]' | md5sum | cut -d' ' -f1
+    }
+
+    #takes the following arguments: in_img ref_img
+    resample_to_grid() {
+        # Sets resampled to the path of in_img resampled to the grid of
+        # ref_img, running flirt only if no other task has done it already.
+        # The first job to create the lock directory runs flirt; any other
+        # job that needs the same image waits for it to finish, or to exit
+        # without finishing.
+        local in_img=$1
+        local ref_img=$2
+        local in_file=$( basename ${in_img} )
+        local key=$( grid_key ${ref_img} )
+        mkdir -p ${resample_cache}/${key}
+        resampled=${resample_cache}/${key}/${in_file/.nii.gz/.2.nii.gz}
+
+        if mkdir ${resampled}.lock 2> /dev/null ; then
+            echo ${BASHPID} > ${resampled}.lock/pid
+            echo "miss ${in_file} ${key}" >> ${resample_log}
+            if flirt -in ${in_img} -ref ${ref_img} -applyxfm -out ${resampled} ; then
+                touch ${resampled}.done
+            else
+                touch ${resampled}.failed
+                return 1
+            fi
+        else
+            echo "hit ${in_file} ${key}" >> ${resample_log}
+            echo Reuse ${resampled}
+            while ! [ -e ${resampled}.done ] ; do
+                if [ -e ${resampled}.failed ] ; then
+                    echo "flirt failed for ${resampled}" >&2
+                    return 1
+                fi
+                local owner=$( cat ${resampled}.lock/pid 2> /dev/null )
+                if [ -n "${owner}" ] && ! kill -0 ${owner} 2> /dev/null && ! [ -e ${resampled}.done ] ; then
+                    echo "job resampling ${resampled} exited without finishing" >&2
+                    return 1
+                fi
+                sleep 1
+            done
+        fi
+    }
+
+    # With --native-render, images are not drawn as they come up. Each one is
+    # added to a queue, and slice_renderer.py draws the whole queue in one
+    # process (loading each volume once) after the tasks are done. The
+    # inputs (including the resample cache) are kept until then.
+    render_queue=${working}/render_queue
+    rm -f ${render_queue}
+
+    #takes the following arguments: kind paths...
+    queue_image() {
+        # One short line per image, so jobs can append at the same time.
+        local IFS=$'\t'
+        echo "$*" >> ${render_queue}
+    }
+
+    # Each image (or set of images made together) has an entry in the
+    # manifest directory, named for its first output, that lists the outputs
+    # and then the inputs they were made from: the path, size and mtime of
+    # each input file, and any other value (renderer, frame size) as it is.
+    # The script itself is an input, so a new version makes everything again.
+    reused_log=${working}/reused
+    rm -f ${reused_log}
+    this_script=${scriptdir}/$( basename $0 )
+    if [ -n "${native_render}" ] ; then
+        renderer=${scriptdir}/slice_renderer.py
+    else
+        renderer="renderer=fsl"
+    fi
+
+    #takes the following arguments: outputs... -- inputs...
+    needs_update() {
+        # Returns true if the outputs have to be made. With --incremental,
+        # that is only if one of them is missing or the inputs differ from
+        # the ones they were made from. If they have to be made, the old
+        # outputs are removed and the inputs are set aside (.pending) for
+        # record_manifest to keep once the outputs exist.
+        local outputs=()
+        while [ "$1" != "--" ] ; do
+            outputs+=( $1 )
+            shift
+        done
+        shift
+        local entry=${manifest_dir}/$( basename ${outputs[0]} )
+        {
+            echo "${outputs[@]}"
+            for item in ${this_script} "$@" ; do
+                if [ -e ${item} ] ; then
+                    stat -L -c '%n %s %Y' ${item}
+                else
+                    echo ${item}
+                fi
+            done
+        } > ${entry}.pending
+
+        if [ -n "${incremental}" ] && cmp -s ${entry}.pending ${entry}.inputs ; then
+            local missing=0
+            for out in ${outputs[@]} ; do
+                [ -e ${out} ] || missing=1
+            done
+            if (( missing == 0 )) ; then
+                rm -f ${entry}.pending
+                echo Reuse ${outputs[@]}
+                echo ${outputs[@]} >> ${reused_log}
+                return 1
+            fi
+        fi
+        rm -rf ${outputs[@]}
+        return 0
+    }
+
+    record_manifest() {
+        # Keeps the inputs of each set of outputs that was made; outputs
+        # that failed are made again next time.
+        for pending in ${manifest_dir}/*.pending ; do
+            [ -e ${pending} ] || continue
+            local made=1
+            for out in $( head -n 1 ${pending} ) ; do
+                [ -e ${out} ] || made=0
+            done
+            if (( made == 1 )) ; then
+                mv ${pending} ${pending%.pending}.inputs
+            else
+                rm -f ${pending}
+            fi
+        done
+    }
+
+    #takes the following arguments: in_img out_png
+    make_preview() {
+        # The middle slices of the (first volume of the) image, as slicer -a
+        # draws them.
+        if needs_update $2 -- $1 ${renderer} ; then
+            if [ -n "${native_render}" ] ; then
+                queue_image preview $1 $2
+            else
+                slicer $1 -u -a $2
+            fi
+        fi
+    }
+
+    #takes the following arguments: task_dir
+    make_task_images() {
+        # Makes the registration images for one task/run. Each task gets its
+        # own working directory and resampled brains, so that tasks can run
+        # side by side in the job pool.
+        fMRIName=$( basename $1 )
+        task_img="${Results}/${fMRIName}/${fMRIName}.nii.gz"
+        fMRI_pre=${images_path}/sub-${subject_id}_${fMRIName}
+        if [[ ${has_t2} -eq 1 ]] ; then
+            if ! needs_update ${fMRI_pre}_desc-T1InTask.gif ${fMRI_pre}_desc-TaskInT1.gif \
+                    ${fMRI_pre}_desc-T2InTask.gif ${fMRI_pre}_desc-TaskInT2.gif \
+                    -- ${task_img} ${t1_brain} ${t2_brain} ${renderer} ; then
+                return
+            fi
+        elif ! needs_update ${fMRI_pre}_desc-T1InTask.gif ${fMRI_pre}_desc-TaskInT1.gif \
+                -- ${task_img} ${t1_brain} ${renderer} ; then
+            return
+        fi
+        echo Make images for ${fMRIName}.
+        task_working=${working}/${fMRIName}
+        mkdir -p ${task_working}
+
+        # Resample the brains to the task image (or reuse the ones already
+        # resampled to the same grid).
+        resample_to_grid ${t1_brain} ${task_img}
+        t1_2_brain=${resampled}
+        echo result of flirt is in ${t1_2_brain}
+        if [[ ${has_t2} -eq 1 ]] ; then
+            resample_to_grid ${t2_brain} ${task_img}
+            t2_2_brain=${resampled}
+            echo result of flirt is in ${t2_2_brain}
+        fi
+
+        make_default_slices_row ${task_img} ${fMRI_pre}_desc-T1InTask.gif ${t1_2_brain} ${task_working}
+        make_default_slices_row ${t1_2_brain} ${fMRI_pre}_desc-TaskInT1.gif ${task_img} ${task_working}
+        if [[ ${has_t2} -eq 1 ]] ; then
+            make_default_slices_row ${task_img} ${fMRI_pre}_desc-T2InTask.gif ${t2_2_brain} ${task_working}
+            make_default_slices_row ${t2_2_brain} ${fMRI_pre}_desc-TaskInT2.gif ${task_img} ${task_working}
+        fi
+
+        rm -rf ${task_working}
+    }
+
 ################## BEGIN #########################
 
 wm_mask_L="L_wm_2mm_${subject_id}_mask.nii.gz"
@@ -313,7 +647,8 @@ if [ -z "${atlas}" ] ; then
 elif [[ ! -e ${atlas} ]] ; then
     echo "Missing ${atlas}"
     echo "Cannot create atlas-in-t1 or t1-in-atlas"
-else
+elif needs_update ${images_pre}_desc-AtlasInT1w.gif ${images_pre}_desc-T1wInAtlas.gif \
+        -- ${t1_mask} ${atlas} ${renderer} ; then
     echo Registering $( basename ${t1_mask} ) and atlas file: ${atlas}
     set -x
     make_default_slices_row ${t1_mask} ${images_pre}_desc-AtlasInT1w.gif ${atlas}
@@ -346,66 +681,96 @@ if [ -z "${pngs_template}" ]; then
     # Use default.
     pngs_template=${templatedir}/image_template_temp.scene
 fi
+if [ -z "${brainsprite_template}" ]; then
+    # Use default.
+    brainsprite_template=${templatedir}/parasagittal_Tx_169_template.scene
+fi
 
-pngs_scene=${processed_files}/pngs_scene.scene
-build_scene_from_pngs_template $t2 $t1 $rp $lp $rw $lw
+# Make every scene of the run at once: the named pngs scene, and the T1 and
+# T2 brainsprite scenes (made from the same template) if there will be
+# frames to render.
+pngs_scene=${scene_dir}/pngs_scene.scene
+t1_bs_scene=${scene_dir}/t1_bs_scene.scene
+t2_bs_scene=${scene_dir}/t2_bs_scene.scene
+add_pngs_scene $t2 $t1 $rp $lp $rw $lw
+if [[ -z "${skip_sprite}" && -z "${native_sprite}" && -e ${brainsprite_template} ]] ; then
+    add_brainsprite_scene ${t1_bs_scene} $t1 $rp $lp $rw $lw
+    if [[ ${has_t2} -eq 1 ]] ; then
+        add_brainsprite_scene ${t2_bs_scene} $t2 $rp $lp $rw $lw
+    fi
+fi
+build_scenes
 declare -a image_names=('T1-Axial-InferiorTemporal-Cerebellum' 'T2-Axial-InferiorTemporal-Cerebellum' 'T1-Axial-BasalGangila-Putamen' 'T2-Axial-BasalGangila-Putamen' 'T1-Axial-SuperiorFrontal' 'T2-Axial-SuperiorFrontal' 'T1-Coronal-PosteriorParietal-Lingual' 'T2-Coronal-PosteriorParietal-Lingual' 'T1-Coronal-Caudate-Amygdala' 'T2-Coronal-Caudate-Amygdala' 'T1-Coronal-OrbitoFrontal' 'T2-Coronal-OrbitoFrontal' 'T1-Sagittal-Insula-FrontoTemporal' 'T2-Sagittal-Insula-FrontoTemporal' 'T1-Sagittal-CorpusCallosum' 'T2-Sagittal-CorpusCallosum' 'T1-Sagittal-Insula-Temporal-HippocampalSulcus' 'T2-Sagittal-Insula-Temporal-HippocampalSulcus')
 ((num_wb_scenes=${#image_names[@]}-1))
 
+# The scenes are independent, so render them in the job pool.
 for i in `seq 0 ${num_wb_scenes}`;
 do
     ((scenenum=(i+1)))
 
     if [[ ${has_t2} -eq 0 && $(( $scenenum % 2 )) -eq 0 ]] ; then
         echo "skip t2 image"
-    else
+    elif needs_update "${images_pre}_${image_names[$i]}.png" -- ${pngs_template} $t2 $t1 $rp $lp $rw $lw ; then
         echo create_image_from_pngs_scene "${images_pre}_${image_names[$i]}.png" $scenenum
-        create_image_from_pngs_scene "${images_pre}_${image_names[$i]}.png" $scenenum
+        run_job "${image_names[$i]}" create_image_from_pngs_scene "${images_pre}_${image_names[$i]}.png" $scenenum
     fi
 done
 
+wait_for_jobs "Named pngs"
 rm -rf ${pngs_scene}
 
 
 # Make pngs to be used for the brainsprite.
-if [ -z "${brainsprite_template}" ]; then
-    # Use default.
-    brainsprite_template=${templatedir}/parasagittal_Tx_169_template.scene
-fi
 if [ -n "${skip_sprite}" ] ; then
     # Skip brainsprite processing.
     echo Skip brainsprite processing per user request.
+elif [ -n "${native_sprite}" ] ; then
+    # The mosaics will be made from the volumes, not from rendered frames.
+    echo Skip brainsprite frames: mosaics will be sliced from the volumes.
 elif [[ ! -e ${brainsprite_template} ]] ; then
     # Cannot do brainsprite processing if there is no template
     echo Missing ${brainsprite_template}
     echo Cannot perform processing needed for brainsprite.
 else
-    mkdir -p ${processed_files}/T1_pngs/
-    chown :${GROUP} ${processed_files}/T1_pngs/ || true
-    chmod 770 ${processed_files}/T1_pngs/ || true
-
-    # Create brainsprite images for T1
-    brainsprite_scene=${processed_files}/t1_bs_scene.scene
-    build_scene_from_brainsprite_template $t1 $rp $lp $rw $lw
-    create_images_from_brainsprite_scene T1
+    # Each set of frames is made again only if its volume, the surfaces, the
+    # template or the frame size has changed.
+    sprite_inputs="${brainsprite_template} $rp $lp $rw $lw size=${sprite_width}x${sprite_height}"
+    if needs_update ${processed_files}/T1_pngs -- $t1 ${sprite_inputs} ; then
+        mkdir -p ${processed_files}/T1_pngs/
+        chown :${GROUP} ${processed_files}/T1_pngs/ || true
+        chmod 770 ${processed_files}/T1_pngs/ || true
+
+        # Create brainsprite images for T1
+        create_images_from_brainsprite_scene T1 ${t1_bs_scene}
+    fi
 
-    if [[ ${has_t2} -eq 1 ]] ; then
+    if [[ ${has_t2} -eq 1 ]] && needs_update ${processed_files}/T2_pngs -- $t2 ${sprite_inputs} ; then
         mkdir -p ${processed_files}/T2_pngs/
         chown :${GROUP} ${processed_files}/T2_pngs/ || true
         chmod 770 ${processed_files}/T2_pngs/ || true
 
-        # Create brainsprite images for T2
-        brainsprite_scene=${processed_files}/t2_bs_scene.scene
-        build_scene_from_brainsprite_template $t2 $rp $lp $rw $lw
-        create_images_from_brainsprite_scene T2
+        # Create brainsprite images for T2. These are queued behind the T1
+        # frames, in the same pool.
+        create_images_from_brainsprite_scene T2 ${t2_bs_scene}
     fi
+
+    wait_for_jobs "Brainsprite frames"
 fi
 
 # Subcorticals
 subcort_sub=${ROIs}/sub2atl_ROI.2.nii.gz
 subcort_atl=${ROIs}/Atlas_ROIs.2.nii.gz
 set -x
-if [ -e ${subcort_sub} ] ; then
+if [ -e ${subcort_sub} ] && [ -e ${subcort_atl} ] && \
+        ! needs_update ${images_pre}_desc-AtlasInSubcort.gif ${images_pre}_desc-SubcortInAtlas.gif \
+        -- ${subcort_sub} ${subcort_atl} ${renderer} ; then
+    echo Subcorticals images are up to date.
+elif [ -e ${subcort_sub} ] && [ -e ${subcort_atl} ] && [ -n "${native_render}" ] ; then
+    # slice_renderer.py loads both volumes once and draws both images.
+    echo Queue subcorticals images.
+    queue_image subcort ${subcort_sub} ${subcort_atl} \
+        ${images_pre}_desc-AtlasInSubcort.gif ${images_pre}_desc-SubcortInAtlas.gif
+elif [ -e ${subcort_sub} ] ; then
     if [ -e ${subcort_atl} ] ; then
         echo Create subcorticals images.
 
@@ -484,47 +849,21 @@ set +x
 ### Tasks
 ############
 
-t1_2_brain=${AtlasSpacePath}/T1w_restore_brain.2.nii.gz
-t2_2_brain=${AtlasSpacePath}/T2w_restore_brain.2.nii.gz
-if [[ ! -e ${t2_2_brain} ]] ; then
-    echo "t2_2_brain not found"
-fi
-
-if [[ -e ${t1_2_brain_img} ]] ; then
-    echo "removing old resampled t1 brain"
-    rm ${t1_2_brain_img}
-fi
-if [[ -e ${t2_2_brain_img} ]] ; then
-    echo "removing old resampled t2 brain"
-    rm ${t2_2_brain_img}
-fi
-
-# Make T1w and T2w task images.
+# Make T1w and T2w task images. Each task is a job in the pool, with its own
+# working directory. The brains resampled to each task's grid are shared
+# through the resample cache.
 
 # ending slash in "*task-*/" is required to ensure ls -d gets only dirnames
+set -x
 for TASK in `ls -d ${Results}/*task-*/` ; do
-    fMRIName=$( basename ${TASK} )
-    echo Make images for ${fMRIName}.
-    task_img="${Results}/${fMRIName}/${fMRIName}.nii.gz"
-
-    # Use the first task image to make the resampled brain.
-    flirt -in ${t1_brain} -ref ${task_img} -applyxfm -out ${t1_2_brain}
-    echo result of flirt is in ${t1_2_brain}
-    if [[ ${has_t2} -eq 1 ]] ; then
-        flirt -in ${t2_brain} -ref ${task_img} -applyxfm -out ${t2_2_brain}
-        echo result of flirt is in ${t2_2_brain}
-    fi
-
-    fMRI_pre=${images_path}/sub-${subject_id}_${fMRIName}
-    set -x
-    make_default_slices_row ${task_img} ${fMRI_pre}_desc-T1InTask.gif ${t1_2_brain}
-    make_default_slices_row ${t1_2_brain} ${fMRI_pre}_desc-TaskInT1.gif ${task_img}
-    if [[ ${has_t2} -eq 1 ]] ; then
-        make_default_slices_row ${task_img} ${fMRI_pre}_desc-T2InTask.gif ${t2_2_brain}
-        make_default_slices_row ${t2_2_brain} ${fMRI_pre}_desc-TaskInT2.gif ${task_img}
-    fi
-    set +x
+    run_job "$( basename ${TASK} )" make_task_images ${TASK}
 done
+wait_for_jobs "Task registrations"
+set +x
+if [ -e ${resample_log} ] ; then
+    echo "Resample cache: $( awk '$1 == "hit"' ${resample_log} | wc -l ) hits," \
+         "$( awk '$1 == "miss"' ${resample_log} | wc -l ) misses."
+fi
 
 set -x
 # If the bids-input was supplied and there are func files, slice
@@ -538,7 +877,7 @@ if [ -n "${bids_input}" ] && [ -d ${bids_input} ] ; then
         png_name=$( basename ${BOLD} )
         png_name=${png_name/.nii.gz/.png}
         png_name=${png_name/.nii/.png}
-        slicer ${BOLD} -u -a ${images_path}/${png_name}
+        make_preview ${BOLD} ${images_path}/${png_name}
     done
 
     # Slice sbref.nii.gz files for tasks into pngs.
@@ -551,14 +890,14 @@ if [ -n "${bids_input}" ] && [ -d ${bids_input} ] ; then
             # Get the task name and number from the parent.
             task_name=$( basename  $( dirname ${SCOUT} ) )
             png_name=sub-${subject_id}_${task_name}_ref.png
-            slicer ${SCOUT} -u -a ${images_path}/${png_name}
+            make_preview ${SCOUT} ${images_path}/${png_name}
         done
     else
         for SBREF in ${sbrefs[@]} ; do
             png_name=$( basename ${SBREF} )
             png_name=${png_name/.nii.gz/.png}
             png_name=${png_name/.nii/.png}
-            slicer ${SBREF} -u -a ${images_path}/${png_name}
+            make_preview ${SBREF} ${images_path}/${png_name}
         done
     fi
 
@@ -569,8 +908,18 @@ shopt -u nullglob
 
 set +x
 
-# cleanup working dir
-rm -rf ${working}
+if [ -s ${render_queue} ] ; then
+    echo Draw $( wc -l < ${render_queue} ) queued images.
+    python ${scriptdir}/slice_renderer.py ${render_queue}
+fi
+
+record_manifest
+if [ -e ${reused_log} ] ; then
+    echo "Incremental: reused $( wc -l < ${reused_log} ) image set(s) from the prior run."
+fi
+
+# cleanup working dir and scenes
+rm -rf ${working} ${scene_dir}
 
 echo "DONE: executive summary prep"
 
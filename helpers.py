@@ -1,5 +1,6 @@
 import os
 from os import path
+import fnmatch
 import glob
 import shutil
 
@@ -30,19 +31,22 @@ def find_and_copy_files(seek_dir, pattern, output_dir):
     :parameter: seek_dir: directory to be searched.
     :parameter: pattern: Unix shell pattern for finding files.
     :parameter: output_dir: directory to which to copy files.
-    :return: list of relative paths of copied files (may be empty).
+    :return: list of paths (output_dir joined to the name) of copied files
+             (may be empty).
     """
-    rel_paths = []
+    out_paths = []
 
     glob_pattern = os.path.join(seek_dir, pattern)
     for found_file in glob.glob(glob_pattern):
         # TODO: change name to BIDS name?
         filename = os.path.basename(found_file)
-        rel_path = os.path.relpath(os.path.join(output_dir, filename), os.getcwd())
-        shutil.copy(found_file, rel_path)
-        rel_paths.append(rel_path)
+        out_path = os.path.join(output_dir, filename)
+        # Keep the mtime, so a copy of an unchanged file looks unchanged
+        # (e.g. to the previews made from it).
+        shutil.copy2(found_file, out_path)
+        out_paths.append(out_path)
 
-    return rel_paths
+    return out_paths
 
 
 def find_and_copy_file(seek_dir, pattern, output_dir):
@@ -53,7 +57,7 @@ def find_and_copy_file(seek_dir, pattern, output_dir):
     :parameter: seek_dir: directory to be searched.
     :parameter: pattern: Unix shell pattern for finding files.
     :parameter: output_dir: directory to which to copy the file.
-    :return: relative path to copied file, or None.
+    :return: path (output_dir joined to the name) to copied file, or None.
     """
 
     found_path = find_one_file(seek_dir, pattern)
@@ -62,9 +66,9 @@ def find_and_copy_file(seek_dir, pattern, output_dir):
         # TODO: change name to BIDS name?
         # Copy the file to output_dir.
         filename = os.path.basename(found_path)
-        rel_path = os.path.relpath(os.path.join(output_dir, filename), os.getcwd())
-        shutil.copyfile(found_path, rel_path)
-        return rel_path
+        out_path = os.path.join(output_dir, filename)
+        shutil.copyfile(found_path, out_path)
+        return out_path
 
     else:
         return None
@@ -89,3 +93,129 @@ def find_one_file(seek_dir, pattern):
     return one_file
 
 
+
+
+class DirectoryIndex(object):
+    """
+    The entries of one directory, read with a single os.scandir, so that
+    any number of glob-style lookups can be answered from memory instead of
+    scanning the directory again. Matches as glob does: a name starting
+    with '.' only matches a pattern starting with '.'. The index does not
+    see files added after it was built.
+
+    The paths found are joined to prefix, if one is given, instead of to
+    seek_dir: e.g. an index of /study/.../executivesummary/img with the
+    prefix 'img' finds paths relative to the page.
+    """
+
+    def __init__ (self, seek_dir, prefix=None):
+        self.seek_dir = seek_dir
+        self.prefix = seek_dir if prefix is None else prefix
+        self.names = []
+        self.dirs = set()
+
+        # Like glob, a directory that cannot be read has no files.
+        try:
+            entries = os.scandir(seek_dir)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                self.names.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        self.dirs.add(entry.name)
+                except OSError:
+                    pass
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def find_files(self, pattern):
+        """
+        Finds all entries that match the glob-style pattern.
+
+        :parameter: pattern: Unix shell pattern for finding files.
+        :return: list of paths (prefix joined to the name; may be empty).
+        """
+        names = self.names
+        if not pattern.startswith('.'):
+            names = [ name for name in names if not name.startswith('.') ]
+        return [ path.join(self.prefix, name) for name in fnmatch.filter(names, pattern) ]
+
+    def find_one_file(self, pattern):
+        """
+        Finds the single entry that matches the pattern.
+
+        :parameter: pattern: Unix shell pattern for finding files.
+        :return: path to the file, or None if there is not exactly one.
+        """
+        filelist = self.find_files(pattern)
+        numfiles = len(filelist)
+        if numfiles == 1:
+            return filelist[0]
+
+        # TODO: Log info in errorfile.
+        print('info: Found %s files with pattern: %s' % (numfiles, path.join(self.seek_dir, pattern)))
+        return None
+
+    def subdirs(self):
+        # Names of the entries that are directories (or links to them).
+        return [ name for name in self.names if name in self.dirs ]
+
+
+def input_signature(outputs, inputs):
+    # The outputs, then the path, size and mtime of each input file (or the
+    # value itself, for inputs that are not files), one per line. This is
+    # the same layout as the manifest entries the preprocessor writes.
+    lines = [ ' '.join(outputs) ]
+    for item in inputs:
+        if path.exists(item):
+            stat = os.stat(item)
+            lines.append('%s %s %s' % (item, stat.st_size, int(stat.st_mtime)))
+        else:
+            lines.append(str(item))
+    return '\n'.join(lines) + '\n'
+
+
+def manifest_entry(manifest_dir, outputs):
+    # Each entry is named for the first of its outputs.
+    return path.join(manifest_dir, path.basename(outputs[0]) + '.inputs')
+
+
+def outputs_are_current(manifest_dir, outputs, inputs):
+    """
+    Checks whether the outputs can be reused: they all exist, and were made
+    from the inputs as they are now.
+
+    :parameter: manifest_dir: directory of the manifest entries.
+    :parameter: outputs: paths of the files made together.
+    :parameter: inputs: paths of the files (and other values) they are made from.
+    :return: True if the outputs are up to date.
+    """
+    if not all(path.exists(output) for output in outputs):
+        return False
+
+    try:
+        with open(manifest_entry(manifest_dir, outputs)) as fd:
+            recorded = fd.read()
+    except (IOError, OSError):
+        return False
+
+    return recorded == input_signature(outputs, inputs)
+
+
+def record_inputs(manifest_dir, outputs, inputs):
+    """
+    Records the inputs the outputs were made from, so a later incremental
+    run can reuse them.
+
+    :parameter: manifest_dir: directory of the manifest entries.
+    :parameter: outputs: paths of the files made together.
+    :parameter: inputs: paths of the files (and other values) they are made from.
+    :return: None
+    """
+    if not path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_entry(manifest_dir, outputs), 'w') as fd:
+        fd.write(input_signature(outputs, inputs))
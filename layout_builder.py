@@ -8,12 +8,72 @@ the DCAN-Labs fMRI pipelines.
 __version__ = "2.0.0"
 
 import os
-from os import (path, getcwd, chmod, listdir)
-import stat
+from os import (path, chmod, listdir)
 import re
+import stat
+import json
 import glob
+import tempfile
 from constants import *
-from helpers import (find_one_file, find_files, find_and_copy_files)
+from helpers import (find_and_copy_files, DirectoryIndex)
+from trace_events import span
+from assets import stylesheet_html
+from sprite_tiles import (tile_mosaic, TILES_DIR)
+from thumbnails import (make_thumbnail, preview_width, PAGE_WIDTH, ROW_SHARE,
+                        HALF_ROW_SHARE, QUARTER_ROW_SHARE)
+
+
+# The process's umask, for the mode of new pages. Read once: reading it
+# means setting it, which would race with pages written in other threads.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class HtmlWriter(object):
+    # Streams a page to a temporary file in the directory of the page, and
+    # renames it into place when it is complete, so the page is never seen
+    # half written (and a failed layout leaves the old page alone).
+    #
+    # Use it in a with statement: the page is put in place if the block
+    # finishes, and the temporary file removed if it raises.
+    #
+    def __init__ (self, filepath):
+        self.filepath = filepath
+        fd, self.temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(filepath),
+                suffix='.tmp', dir=os.path.dirname(filepath))
+        self.fd = os.fdopen(fd, 'w', buffering=1 << 16)
+
+
+    def write(self, html):
+        self.fd.write(html)
+
+
+    def commit(self):
+        # mkstemp makes the file readable by the owner only. Give the page
+        # the mode the old one had, or the one open() would have given it.
+        self.fd.close()
+        if os.path.exists(self.filepath):
+            mode = stat.S_IMODE(os.stat(self.filepath).st_mode)
+        else:
+            mode = 0o666 & ~UMASK
+        chmod(self.temp_path, mode)
+        os.replace(self.temp_path, self.filepath)
+
+
+    def abort(self):
+        self.fd.close()
+        os.remove(self.temp_path)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
 
 
 class ModalContainer(object):
@@ -21,7 +81,7 @@ class ModalContainer(object):
     # creates a button to display the container.
     #
     # A ModalContainer object must be created with these steps:
-    #     1) Instantiate the object with an id and image class.
+    #     1) Instantiate the object with an id.
     #     2) Add the images to be shown in the container.
     #     3) Get the HTML for the container at the point in the
     #        document at which you want to insert the HTML.
@@ -30,19 +90,22 @@ class ModalContainer(object):
     # after all of the images have been added. Else, the images
     # hide the button.
     #
+    # The container holds a single image; the images added to it
+    # are listed in its manifest (see get_scripts), and the shared
+    # SLIDES_SCRIPTS show the chosen one in that image.
+    #
     # The modal id must be unique to this container, so that
     # buttons or clickable images or whatever, can display the
     # correct container.
     #
-    def __init__ (self, modal_id, image_class):
+    is_slider = False
+
+    def __init__ (self, modal_id):
 
         self.modal_id = modal_id
-        self.modal_container = MODAL_START.format(modal_id=self.modal_id)
+        self.images = []
         self.button = ''
 
-        self.image_class = image_class
-        self.image_class_idx = 0
-
         self.scripts = ''
 
         self.state = 'open'
@@ -52,10 +115,6 @@ class ModalContainer(object):
         return self.modal_id
 
 
-    def get_image_class(self):
-        return self.image_class
-
-
     def get_button(self, btn_label):
         # Return HTML to creates a button that displays the modal container.
         self.button += DISPLAY_MODAL_BUTTON.format(modal_id=self.modal_id, btn_label=btn_label)
@@ -63,23 +122,34 @@ class ModalContainer(object):
 
 
     def get_container(self):
-        # Add the close button after all images have been added (so
-        # the button does not get covered by the image).
+        # Return the HTML.
+        fragments = []
+        self.write_container(fragments.append)
+        return ''.join(fragments)
+
+
+    def write_container(self, emit):
+        # Passes the HTML for the container to emit, a piece at a time.
+        # Add the close button after the image (so the button does not
+        # get covered by the image).
         self.state = 'closed'
 
-        # Close up the elements.
-        self.modal_container += MODAL_END.format(modal_id=self.modal_id)
+        emit(MODAL_START.format(modal_id=self.modal_id))
+        emit(SLIDE_IMAGE.format(modal_id=self.modal_id))
 
-        # Return the HTML.
-        return self.modal_container
+        # Close up the elements.
+        emit(MODAL_END.format(modal_id=self.modal_id))
 
 
     def get_scripts(self):
-        # The containter needs the scripts to show the correct
-        # image when the container is opened.
-        self.scripts += MODAL_SCRIPTS % {
+        # The container needs its list of images, so the scripts can
+        # show the correct image when the container is opened.
+        slides_json = json.dumps({ 'slider': self.is_slider, 'slides': self.images })
+
+        # Nothing in the list may end the script element early.
+        self.scripts += SLIDES_MANIFEST % {
                 'modal_id'   : self.modal_id,
-                'image_class': self.image_class }
+                'slides_json': slides_json.replace('</', '<\\/') }
 
         return self.scripts
 
@@ -90,12 +160,12 @@ class ModalContainer(object):
             self.add_image(image_file)
 
         # Return the final index.
-        return self.image_class_idx
+        return len(self.images)
 
 
     def add_image(self, image_file):
 
-        if self.state is not 'open':
+        if self.state != 'open':
             print('ERROR: Cannot add images after the HTML has been written.')
             return 0
 
@@ -103,15 +173,10 @@ class ModalContainer(object):
         # so get the filename by itself.
         display_name = os.path.basename(image_file)
 
-        # Add the image to container, and assign the class.
-        self.modal_container += IMAGE_WITH_CLASS.format(
-                modal_id      = self.modal_id,
-                image_class   = self.image_class,
-                image_file    = image_file,
-                display_name  = display_name)
-
-        self.image_class_idx += 1
-        return self.image_class_idx
+        # Add the image to the container's list, and return its (1-based)
+        # index, for the rows' onclick.
+        self.images.append({ 'src': image_file, 'label': display_name })
+        return len(self.images)
 
 
 class ModalSlider(ModalContainer):
@@ -124,44 +189,64 @@ class ModalSlider(ModalContainer):
     # next buttons in the lower left and right respectively,
     # and a close button in the upper right.
     #
-    # The image class must be unique to this slider so that
-    # the scripts can find the images used by the slider.
-    #
-    def __init__ (self, modal_id, image_class):
-        ModalContainer.__init__(self, modal_id, image_class)
+    is_slider = True
 
+    def __init__ (self, modal_id):
+        ModalContainer.__init__(self, modal_id)
 
-    def get_container(self):
-        # Must add buttons after all images have been added.
-        self.state = 'closed'
 
-        # Add the buttons and close up the elements.
-        self.modal_container += SLIDER_END.format(image_class=self.image_class)
-        self.modal_container += MODAL_END.format(modal_id=self.modal_id)
-        # Return the HTML.
-        return self.modal_container
+    def write_container(self, emit):
+        # Must add buttons after the image.
+        self.state = 'closed'
 
+        emit(MODAL_START.format(modal_id=self.modal_id))
+        emit(SLIDE_IMAGE.format(modal_id=self.modal_id))
 
-    def get_scripts(self):
-        # The slider needs the scripts to go along with the
-        # right and left buttons.
-        self.scripts += SLIDER_SCRIPTS % {
-                'modal_id'   : self.modal_id,
-                'image_class': self.image_class }
-        return self.scripts
+        # Add the buttons and close up the elements.
+        emit(SLIDER_END.format(modal_id=self.modal_id))
+        emit(MODAL_END.format(modal_id=self.modal_id))
 
 
 
 class Section(object):
-    def __init__ (self, img_path='./img', regs_slider=None, img_modal=None, **kwargs):
-        self.section = ''
+    def __init__ (self, img_path='./img', regs_slider=None, img_modal=None, img_index=None, writer=None, html_path='.', page_width=PAGE_WIDTH, **kwargs):
+        self.fragments = []
+        self.writer = writer
         self.scripts = ''
-        self.img_path = img_path
         self.regs_slider = regs_slider
         self.img_modal = img_modal
 
+        # img_path is relative to html_path, the directory of the page: the
+        # page refers to its images by these relative paths, and the files
+        # are found by joining them to html_path (never through the cwd).
+        self.img_path = img_path
+        self.html_path = html_path
+
+        # The rows show previews made for a page this wide (0: the images).
+        self.page_width = page_width
+
+        # All lookups of images go through one index of img_path, so the
+        # directory is only read once. Sections share the layout's index.
+        if img_index is None:
+            img_index = DirectoryIndex(os.path.join(html_path, img_path), prefix=img_path)
+        self.img_index = img_index
+
+    def emit(self, html):
+        # With a writer, the HTML goes to the page as soon as it is made;
+        # otherwise it is kept for get_section.
+        if self.writer is not None:
+            self.writer.write(html)
+        else:
+            self.fragments.append(html)
+
     def get_section(self):
-        return self.section
+        return ''.join(self.fragments)
+
+    def make_preview(self, image_file, share):
+        # The image a row shows, when its image column is share of the page.
+        if not self.page_width:
+            return image_file
+        return make_thumbnail(image_file, preview_width(share, self.page_width), self.html_path)
 
     def get_scripts(self):
         return self.scripts
@@ -169,16 +254,13 @@ class Section(object):
 
 class TxSection(Section):
 
-    def __init__ (self, tx='', **kwargs):
+    def __init__ (self, tx='', tiled_sprite=False, **kwargs):
         Section.__init__(self, **kwargs)
 
         self.tx = tx
 
-        # As the images are added to the HTML, they are given a class. When the
-        # script for the slider is called, it will allow the user to browse all
-        # of the images of that class. Therefore, each slider must have its own
-        # class. Use the same class throughout this instantiation.
-        self.image_class = tx + 'pngs'
+        # With a tiled sprite, the viewer loads the mosaic a band at a time.
+        self.tiled_sprite = tiled_sprite
 
         # The modal container must be identified uniquely so that the correct
         # container is displayed with the correct button. Use this id throughout.
@@ -188,6 +270,18 @@ class TxSection(Section):
         self.run()
 
 
+    def get_sprite_params(self, mosaic_path):
+        # Mosaics sliced from the volume have their own tile size and
+        # coordinates, written next to the mosaic. Otherwise, the mosaic
+        # was made from the wb_command frames, and the defaults are right.
+        params_path = os.path.splitext(mosaic_path)[0] + '.json'
+        if os.path.basename(params_path) not in self.img_index:
+            return SPRITE_DEFAULT_PARAMS
+
+        with open(os.path.join(self.html_path, params_path)) as fd:
+            return json.load(fd)
+
+
     def make_brainsprite_viewer(self):
         # Builds HTML for BrainSprite viewer so users can click through 3d anatomical images.
         spritelabel = ''
@@ -197,19 +291,37 @@ class TxSection(Section):
         # Not all subjects have T1 and/or T2. See if we have data.
         mosaic_name = '%s_mosaic.jpg' % self.tx
         mosaic_path = os.path.join(self.img_path, mosaic_name)
-        if os.path.isfile(mosaic_path):
+        if mosaic_name in self.img_index:
             # Insert the appropriate tx value in the ids, etc.
             spritelabel += '<h6>BrainSprite Viewer: %s</h6>' % self.tx
             viewer = self.tx + '-viewer'
             spriteImg = self.tx + '-spriteImg'
 
-            spriteviewer += SPRITE_VIEWER_HTML.format(viewer=viewer, spriteImg=spriteImg,
-                    mosaic_path=mosaic_path, width='100%')
-
-            spriteloader += SPRITE_LOAD_SCRIPT % {
-                    'tx'       : self.tx,
-                    'viewer'   : viewer,
-                    'spriteImg': spriteImg }
+            sprite_params = self.get_sprite_params(mosaic_path)
+            values = {
+                    'tx'        : self.tx,
+                    'viewer'    : viewer,
+                    'spriteImg' : spriteImg,
+                    'nb_slice_y': sprite_params['nbSlice']['Y'],
+                    'nb_slice_z': sprite_params['nbSlice']['Z'],
+                    'voxel_size': sprite_params['voxelSize'],
+                    'origin'    : json.dumps(sprite_params['origin']) }
+
+            if self.tiled_sprite:
+                # Split the mosaic into a band per row of slices (or reuse
+                # the bands), and give the loader their index, with the
+                # paths of the bands from the page.
+                tiles = dict(tile_mosaic(mosaic_path, sprite_params['nbSlice']['Z'], self.html_path))
+                tiles['bands'] = [ '/'.join([self.img_path, TILES_DIR, band]) for band in tiles['bands'] ]
+
+                spriteviewer += TILED_SPRITE_VIEWER_HTML.format(viewer=viewer, spriteImg=spriteImg,
+                        sprite_width=tiles['width'], sprite_height=tiles['height'], width='100%')
+                values['tiles'] = json.dumps(tiles)
+                spriteloader += TILED_SPRITE_LOAD_SCRIPT % values
+            else:
+                spriteviewer += SPRITE_VIEWER_HTML.format(viewer=viewer, spriteImg=spriteImg,
+                        mosaic_path=mosaic_path, width='100%')
+                spriteloader += SPRITE_LOAD_SCRIPT % values
 
         return spritelabel, spriteviewer, spriteloader
 
@@ -221,24 +333,24 @@ class TxSection(Section):
         # The pngs for the slider are already in the img_path. Get the pngs that start
         # with 'tx' so users can view the higher resolution pngs.
         pngs_glob = '*_' + self.tx + '-*.png'
-        pngs_list = sorted(find_files(self.img_path, pngs_glob))
+        pngs_list = sorted(self.img_index.find_files(pngs_glob))
 
         # Just a sanity check, since we happen to know how many to expect.
         if len(pngs_list) is not 9:
             print('Expected 9 %s pngs but found %s.' % (self.tx, len(pngs_list))) # TODO: log WARNING
 
         # Make a modal container with a slider and add the pngs.
-        pngs_slider = ModalSlider(self.modal_id, self.image_class)
+        pngs_slider = ModalSlider(self.modal_id)
         pngs_slider.add_images(pngs_list)
 
         # Add HTML for the bar with the brainsprite label and pngs button,
         # and for the brainsprite viewer.
         btn_label = 'View %s pngs' % self.tx
-        self.section += TX_SECTION.format(tx=self.tx, brainsprite_label=brainsprite_label,
-                pngs_button=pngs_slider.get_button(btn_label), brainsprite_viewer=brainsprite_viewer)
+        self.emit(TX_SECTION.format(tx=self.tx, brainsprite_label=brainsprite_label,
+                pngs_button=pngs_slider.get_button(btn_label), brainsprite_viewer=brainsprite_viewer))
 
         # HTML for the modal container should be tacked on the end.
-        self.section += pngs_slider.get_container()
+        pngs_slider.write_container(self.emit)
 
         self.scripts = brainsprite_loader + pngs_slider.get_scripts()
 
@@ -246,7 +358,7 @@ class TxSection(Section):
 class AnatSection(Section):
 
     def __init__ (self, img_path='./img', **kwargs):
-        Section.__init__(self, **kwargs)
+        Section.__init__(self, img_path=img_path, **kwargs)
 
         self.img_path = img_path
 
@@ -261,19 +373,19 @@ class AnatSection(Section):
         for key in [ 'atlas_in_t1', 't1_in_atlas', 'atlas_in_subcort', 'subcort_in_atlas' ]:
             values = IMAGE_INFO[key]
             pattern = values['pattern']
-            img_file = find_one_file(self.img_path, pattern)
+            img_file = self.img_index.find_one_file(pattern)
             if img_file is not None:
-                # Add image to data and to slider.
+                # Add the preview to data, and the image to slider.
                 row_data['row_label'] = values['title']
-                row_data['row_img'] = img_file
+                row_data['row_img'] = self.make_preview(img_file, ROW_SHARE)
                 row_data['row_idx'] = self.regs_slider.add_image(img_file)
-                self.section += LAYOUT_ROW.format(**row_data)
+                self.emit(LAYOUT_ROW.format(**row_data))
             else:
-                self.section += PLACEHOLDER_ROW.format( row_label = values['title'] )
+                self.emit(PLACEHOLDER_ROW.format( row_label = values['title'] ))
 
 
     def write_gray_row(self):
-        self.section += GRAY_ROW_START
+        self.emit(GRAY_ROW_START)
 
         # Get gray-ordinates plots.
         gray_data = {}
@@ -281,30 +393,30 @@ class AnatSection(Section):
 
         for key in [ 'concat_pre_reg_gray', 'concat_post_reg_gray' ]:
             values = IMAGE_INFO[key]
-            img_file = find_one_file(self.img_path, values['pattern'])
+            img_file = self.img_index.find_one_file(values['pattern'])
             if img_file is not None:
-                # Add image to data, and to the 'generic' images container.
+                # Add the preview to data, and the image to the 'generic' images container.
                 gray_data['row_label'] = values['title']
-                gray_data['row_img'] = img_file
+                gray_data['row_img'] = self.make_preview(img_file, QUARTER_ROW_SHARE)
                 gray_data['row_idx'] = self.img_modal.add_image(img_file)
-                self.section += LAYOUT_QUARTER_ROW.format(**gray_data)
+                self.emit(LAYOUT_QUARTER_ROW.format(**gray_data))
             else:
-                self.section += PLACEHOLDER_QUARTER_ROW.format( row_label = values['title'] )
+                self.emit(PLACEHOLDER_QUARTER_ROW.format( row_label = values['title'] ))
 
-        self.section += GRAY_ROW_END
+        self.emit(GRAY_ROW_END)
 
     def run(self):
         # Write the HTML for the section.
-        self.section += ANAT_SECTION_START
+        self.emit(ANAT_SECTION_START)
         self.write_atlas_rows()
         self.write_gray_row()
-        self.section += ANAT_SECTION_END
+        self.emit(ANAT_SECTION_END)
 
 
 class TasksSection(Section):
 
     def __init__ (self, tasks=[], img_path='./img', **kwargs):
-        Section.__init__(self, **kwargs)
+        Section.__init__(self, img_path=img_path, **kwargs)
 
         self.img_path = img_path
 
@@ -313,7 +425,7 @@ class TasksSection(Section):
     def write_T1_reg_rows(self, task_name, task_num):
 
         # Write the header for the next few rows.
-        self.section += TASK_LABEL_ROW.format( task_name = task_name, task_num = task_num )
+        self.emit(TASK_LABEL_ROW.format( task_name = task_name, task_num = task_num ))
 
         row_data = {}
         row_data['row_modal'] = self.regs_slider.get_modal_id()
@@ -328,15 +440,15 @@ class TasksSection(Section):
         for key in [ 'task_in_t1', 't1_in_task' ]:
             values = IMAGE_INFO[key]
             pattern = values['pattern'] % task_pattern
-            task_file = find_one_file(self.img_path, pattern)
+            task_file = self.img_index.find_one_file(pattern)
             if task_file:
-                # Add image to data and to slider.
+                # Add the preview to data, and the image to slider.
                 row_data['row_label'] = values['title']
-                row_data['row_img'] = task_file
+                row_data['row_img'] = self.make_preview(task_file, ROW_SHARE)
                 row_data['row_idx'] = self.regs_slider.add_image(task_file)
-                self.section += LAYOUT_ROW.format(**row_data)
+                self.emit(LAYOUT_ROW.format(**row_data))
             else:
-                self.section += PLACEHOLDER_ROW.format( row_label=values['title'] )
+                self.emit(PLACEHOLDER_ROW.format( row_label=values['title'] ))
 
 
     def write_bold_gray_row(self, task_name, task_num):
@@ -348,50 +460,50 @@ class TasksSection(Section):
         task_pattern = task_name + '*' + task_num
 
         # Make the first half of the row - bold and ref data.
-        self.section += BOLD_GRAY_START
+        self.emit(BOLD_GRAY_START)
 
         # For bold and ref files, may include run number or not.
         for key in [ 'bold', 'ref' ]:
             values = IMAGE_INFO[key]
             pattern = values['pattern'] % task_pattern
-            task_file = find_one_file(self.img_path, pattern)
+            task_file = self.img_index.find_one_file(pattern)
             if task_file:
-                # Add image to data, and to the 'generic' images container.
+                # Add the preview to data, and the image to the 'generic' images container.
                 bold_data['row_label'] = values['title']
-                bold_data['row_img'] = task_file
+                bold_data['row_img'] = self.make_preview(task_file, HALF_ROW_SHARE)
                 bold_data['row_idx'] = self.img_modal.add_image(task_file)
-                self.section += LAYOUT_HALF_ROW.format(**bold_data)
+                self.emit(LAYOUT_HALF_ROW.format(**bold_data))
             else:
                 # File was not found with both task name and run number.
                 # Try again with task name only (no run number).
                 pattern = values['pattern'] % task_name
-                task_file = find_one_file(self.img_path, pattern)
+                task_file = self.img_index.find_one_file(pattern)
                 if task_file:
-                    # Add image to data, and to the 'generic' images container.
+                    # Add the preview to data, and the image to the 'generic' images container.
                     bold_data['row_label'] = values['title']
-                    bold_data['row_img'] = task_file
+                    bold_data['row_img'] = self.make_preview(task_file, HALF_ROW_SHARE)
                     bold_data['row_idx'] = self.img_modal.add_image(task_file)
-                    self.section += LAYOUT_HALF_ROW.format(**bold_data)
+                    self.emit(LAYOUT_HALF_ROW.format(**bold_data))
                 else:
-                    self.section += PLACEHOLDER_HALF_ROW.format( row_label = values['title'] )
+                    self.emit(PLACEHOLDER_HALF_ROW.format( row_label = values['title'] ))
 
-        self.section += BOLD_GRAY_SPLIT
+        self.emit(BOLD_GRAY_SPLIT)
 
         # For each gray-plot, there is only one name to look for.
         for key in [ 'task_pre_reg_gray', 'task_post_reg_gray' ]:
             values = IMAGE_INFO[key]
             pattern = values['pattern'] % task_pattern
-            task_file = find_one_file(self.img_path, pattern)
+            task_file = self.img_index.find_one_file(pattern)
             if task_file:
-                # Add image to data, and to the 'generic' images container.
+                # Add the preview to data, and the image to the 'generic' images container.
                 bold_data['row_label'] = values['title']
-                bold_data['row_img'] = task_file
+                bold_data['row_img'] = self.make_preview(task_file, QUARTER_ROW_SHARE)
                 bold_data['row_idx'] = self.img_modal.add_image(task_file)
-                self.section += LAYOUT_QUARTER_ROW.format(**bold_data)
+                self.emit(LAYOUT_QUARTER_ROW.format(**bold_data))
             else:
-                self.section += PLACEHOLDER_QUARTER_ROW.format( row_label = values['title'] )
+                self.emit(PLACEHOLDER_QUARTER_ROW.format( row_label = values['title'] ))
 
-        self.section += BOLD_GRAY_END
+        self.emit(BOLD_GRAY_END)
 
 
     def run(self, tasks):
@@ -400,7 +512,7 @@ class TasksSection(Section):
             return
 
         # Write the column headings.
-        self.section += TASKS_SECTION_START
+        self.emit(TASKS_SECTION_START)
 
         # Each entry in task_entries is a tuple of the task-name (without
         # task-) and run number (without run-).
@@ -409,18 +521,19 @@ class TasksSection(Section):
             self.write_bold_gray_row(task_name, task_num)
 
         # Add the end of the tasks section.
-        self.section += TASKS_SECTION_END
+        self.emit(TASKS_SECTION_END)
 
 
 class layout_builder(object):
 
-    def __init__ (self, files_path, summary_path, html_path, images_path, subject_id, session_id=None):
-
-        self.working_dir = os.getcwd()
+    def __init__ (self, files_path, summary_path, html_path, images_path, subject_id, session_id=None, offline=False, assets_dir=None, tiled_sprite=False, page_width=PAGE_WIDTH):
 
-        self.files_path = files_path
-        self.summary_path = summary_path
-        self.html_path = html_path
+        # Every path is made absolute (or, for the page, relative to
+        # html_path), so the layout does not depend on the cwd, and layouts
+        # can be built side by side in threads.
+        self.files_path = os.path.abspath(files_path)
+        self.summary_path = os.path.abspath(summary_path)
+        self.html_path = os.path.abspath(html_path)
         self.subject_id = 'sub-' + subject_id
         if session_id:
             self.session_id = 'ses-' + session_id
@@ -432,21 +545,23 @@ class layout_builder(object):
         # using the relative path.
         self.images_path = os.path.relpath(images_path, html_path)
 
-        self.setup()
-        self.run()
-        self.teardown()
+        # Where the page gets its stylesheets: the CDNs, the page itself
+        # (offline), or a directory of assets shared by the pages.
+        self.offline = offline
+        if assets_dir is not None:
+            assets_dir = os.path.abspath(assets_dir)
+        self.assets_dir = assets_dir
 
+        # Load the BrainSprite mosaics a band at a time.
+        self.tiled_sprite = tiled_sprite
 
-    def setup(self):
-        # As we write the HTML, we use the relative paths to the image files that
-        # the HTML will reference. Therefore, best to be in the directory to which
-        # the HTML will be written.
-        os.chdir(self.html_path)
+        # Width of the page the row previews are made for (0: no previews).
+        self.page_width = page_width
 
+        # Path of the page, once it has been written.
+        self.page_path = None
 
-    def teardown(self):
-        # Go back to the path where we started.
-        os.chdir(self.working_dir)
+        self.run()
 
 
     def get_list_of_tasks(self):
@@ -464,112 +579,122 @@ class layout_builder(object):
             use_path = self.files_path
             print('\nProcessed tasks will be found in path:\n\t%s' % use_path)
 
-        for name in os.listdir(use_path):
+        # Only deal with subdirectories. (One scandir tells which they are.)
+        for name in DirectoryIndex(use_path).subdirs():
 
-            # Only deal with subdirectories.
-            pathname = os.path.join(use_path, name)
-            if stat.S_ISDIR(os.stat(pathname).st_mode):
+            # The name must match task- something. Ignore anything else.
+            # The name may contain other information  and it may or may not
+            # have '_run-' in it. For example:
+            #      ses-TWO_task-rest_run-01
+            #      task-rest01
+            # We want to capture the name of the task (word after 'task-'),
+            # lose anything between that name and the digits, and capture
+            # all of the digits:
 
-                # The name must match task- something. Ignore anything else.
-                # The name may contain other information  and it may or may not
-                # have '_run-' in it. For example:
-                #      ses-TWO_task-rest_run-01
-                #      task-rest01
-                # We want to capture the name of the task (word after 'task-'),
-                # lose anything between that name and the digits, and capture
-                # all of the digits:
+            task_re = re.compile('task-([^_\d]+)\D*(\d+).*')
+            match = task_re.search(name)
 
-                task_re = re.compile('task-([^_\d]+)\D*(\d+).*')
-                match = task_re.search(name)
-
-                if match is not None:
-                    # Add this tuple to the set of tasks.
-                    taskset.add(match.group(1,2))
+            if match is not None:
+                # Add this tuple to the set of tasks.
+                taskset.add(match.group(1,2))
 
         return sorted(taskset)
 
 
-    def write_html(self, document, filename):
-        """
-        Writes an html document to a filename.
+    def run(self):
 
-        :parameter: document: html document.
-        :parameter: filename: name of html file.
-        :return: None
-        """
-        filepath = os.path.join(os.getcwd(), filename)
+        # Copy gray plot pngs, generated by DCAN-BOLD processing, to the
+        # directory of images used by the HTML.
+        with span('copy gray plots', 'layout'):
+            find_and_copy_files(self.summary_path, '*DVARS_and_FD*.png',
+                                os.path.join(self.html_path, self.images_path))
+
+        if self.session_id is None:
+            filename = 'executive_summary_%s.html' % (self.subject_id)
+        else:
+            filename = 'executive_summary_%s_%s.html' % (self.subject_id, self.session_id)
+        filepath = os.path.join(self.html_path, filename)
+
+        # The page is written as it is made: each section sends its HTML to
+        # the writer as it goes, so nothing holds the whole document.
         try:
-            fd = open(filepath, 'w')
+            writer = HtmlWriter(filepath)
         except OSError as err:
             print('Unable to open %s for write.\n' % filepath)
             print('Error: {0}'.format(err))
+            return
 
-        fd.writelines(document)
-        print('\nExecutive summary can be found in path:\n\t%s/%s' % (os.getcwd(), filename))
-        fd.close()
-
+        with writer:
+            self.write_page(writer)
+        self.page_path = filepath
+        print('\nExecutive summary can be found in path:\n\t%s' % filepath)
 
 
-    def run(self):
+    def write_page(self, writer):
 
-        # Copy gray plot pngs, generated by DCAN-BOLD processing, to the
-        # directory of images used by the HTML.
-        find_and_copy_files(self.summary_path, '*DVARS_and_FD*.png', self.images_path)
-
-        # Start building the HTML document, and put the subject and session
-        # into the title and page header.
-        head = HTML_START
+        # Start the HTML document, and put the subject and session into the
+        # title and page header.
+        writer.write(HTML_START)
+        writer.write(stylesheet_html(self.html_path, self.offline, self.assets_dir))
+        writer.write(PAGE_STYLE)
         if self.session_id is None:
-            head += TITLE.format(subject=self.subject_id, sep='' , session='')
+            writer.write(TITLE.format(subject=self.subject_id, sep='' , session=''))
         else:
-            head += TITLE.format(subject=self.subject_id, sep=': ', session=self.session_id)
-        body = ''
+            writer.write(TITLE.format(subject=self.subject_id, sep=': ', session=self.session_id))
 
         # Images included in the Registrations slider and the Images container
         # are found in multiple sections. Create the objects now and add the files
         # as we get them.
-        regs_slider = ModalSlider('regs_modal', 'Registrations')
+        regs_slider = ModalSlider('regs_modal')
 
         # Any image that is not shown in the sliders will be shown in a modal
         # container when clicked. Create that container now.
-        img_modal = ModalContainer('img_modal', 'Images')
+        img_modal = ModalContainer('img_modal')
+
+        # Read the directory of images once (now that the gray plots are
+        # in it); every section looks up its images in this index.
+        img_index = DirectoryIndex(os.path.join(self.html_path, self.images_path), prefix=self.images_path)
 
         # Some sections require more args, but most will need these:
         kwargs = { 'img_path'     : self.images_path,
+                   'html_path'    : self.html_path,
                    'regs_slider'  : regs_slider,
-                   'img_modal'    : img_modal }
+                   'img_modal'    : img_modal,
+                   'img_index'    : img_index,
+                   'page_width'   : self.page_width,
+                   'writer'       : writer }
 
         # Make sections for 'T1' and 'T2' images. Include pngs slider and
         # BrainSprite for each.
-        t1_section = TxSection(tx='T1', **kwargs)
-        t2_section = TxSection(tx='T2', **kwargs)
-        body += t1_section.get_section() + t2_section.get_section()
+        with span('Tx sections', 'layout'):
+            t1_section = TxSection(tx='T1', tiled_sprite=self.tiled_sprite, **kwargs)
+            t2_section = TxSection(tx='T2', tiled_sprite=self.tiled_sprite, **kwargs)
 
         # Data for this subject/session: i.e., concatenated gray plots and atlas
         # images. (The atlas images will be added to the Registrations slider.)
-        anat_section = AnatSection(**kwargs)
-        body += anat_section.get_section()
+        with span('anat section', 'layout'):
+            anat_section = AnatSection(**kwargs)
 
         # Tasks section: data specific to each task/run. Get a list of tasks processed
         # for this subject. (The <task>-in-T1 and T1-in-<task> images will be added to
         # the Registrations slider.)
-        tasks_list = self.get_list_of_tasks()
-        tasks_section = TasksSection(tasks=tasks_list, **kwargs)
-        body += tasks_section.get_section()
-
-        # Close up the Registrations elements and get the HTML.
-        body += img_modal.get_container() + regs_slider.get_container()
-
-        # There are a bunch of scripts used in this page. Keep their HTML together.
-        scripts = BRAINSPRITE_SCRIPTS + t1_section.get_scripts() + t2_section.get_scripts()
-        scripts += img_modal.get_scripts() + regs_slider.get_scripts()
-
-        # Assemble and write the document.
-        html_doc = head + body + scripts + HTML_END
-        if self.session_id is None:
-            self.write_html(html_doc, 'executive_summary_%s.html' % (self.subject_id))
-        else:
-            self.write_html(html_doc, 'executive_summary_%s_%s.html' % (self.subject_id, self.session_id))
-
-
-
+        with span('tasks section', 'layout'):
+            tasks_list = self.get_list_of_tasks()
+            tasks_section = TasksSection(tasks=tasks_list, **kwargs)
+
+        with span('write html', 'layout'):
+            # Close up the Registrations elements.
+            img_modal.write_container(writer.write)
+            regs_slider.write_container(writer.write)
+
+            # There are a bunch of scripts used in this page. Keep their HTML together.
+            writer.write(BRAINSPRITE_SCRIPTS)
+            if self.tiled_sprite:
+                writer.write(TILED_SPRITE_SCRIPTS)
+            writer.write(LAZY_IMAGE_SCRIPTS)
+            writer.write(SLIDES_SCRIPTS)
+            writer.write(t1_section.get_scripts())
+            writer.write(t2_section.get_scripts())
+            writer.write(img_modal.get_scripts())
+            writer.write(regs_slider.get_scripts())
+            writer.write(HTML_END)
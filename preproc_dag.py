@@ -0,0 +1,522 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Runs the image preprocessing for the executive summary as a graph of tasks,
+instead of as executivesummary_preproc.sh. Each image (or set of images made
+together) is a node, with the nodes it needs listed as its dependencies: the
+brainsprite frames need their scene, the mosaic needs its frames, a task's
+registration rows need the brains resampled to its grid, and so on. Nodes
+run in a bounded pool of processes as soon as their dependencies are done,
+so independent branches overlap. A node that fails does not stop the others;
+only the nodes that depend on it are skipped. Every node's status is
+reported at the end.
+
+The tools are found as the preprocessor finds them: FSL on the PATH, and
+wb_command in $CARET7DIR (or at $wb_command).
+"""
+
+import os
+import glob
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from helpers import outputs_are_current, record_inputs
+from trace_events import span
+from scene_template import instantiate, scratch_dir
+
+
+IMAGE_NAMES = [ 'T1-Axial-InferiorTemporal-Cerebellum', 'T2-Axial-InferiorTemporal-Cerebellum',
+                'T1-Axial-BasalGangila-Putamen', 'T2-Axial-BasalGangila-Putamen',
+                'T1-Axial-SuperiorFrontal', 'T2-Axial-SuperiorFrontal',
+                'T1-Coronal-PosteriorParietal-Lingual', 'T2-Coronal-PosteriorParietal-Lingual',
+                'T1-Coronal-Caudate-Amygdala', 'T2-Coronal-Caudate-Amygdala',
+                'T1-Coronal-OrbitoFrontal', 'T2-Coronal-OrbitoFrontal',
+                'T1-Sagittal-Insula-FrontoTemporal', 'T2-Sagittal-Insula-FrontoTemporal',
+                'T1-Sagittal-CorpusCallosum', 'T2-Sagittal-CorpusCallosum',
+                'T1-Sagittal-Insula-Temporal-HippocampalSulcus', 'T2-Sagittal-Insula-Temporal-HippocampalSulcus' ]
+
+# The slicer arguments for the nine subcortical slices.
+SUBCORT_SLICER = [ ('-x', 36), ('-x', 45), ('-x', 52),
+                   ('-y', 43), ('-y', 54), ('-y', 65),
+                   ('-z', 23), ('-z', 33), ('-z', 39) ]
+
+# Statuses of a node whose outputs can be used.
+FINISHED = ('done', 'reused')
+
+
+class Node(object):
+
+    def __init__(self, name, func, args, deps, outputs, inputs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.outputs = outputs
+        self.inputs = inputs
+        self.status = 'waiting'
+        self.error = None
+        self.started = None
+        self.seconds = None
+
+
+class TaskGraph(object):
+    """
+    A graph of nodes, each a function to run in the pool once the nodes it
+    depends on are done. Nodes must be added after their dependencies, so
+    the order they are added in is a valid order to run them in (and, among
+    the nodes that are ready, the order in which they start).
+    """
+
+    def __init__(self, manifest_dir=None):
+        self.nodes = {}
+        self.manifest_dir = manifest_dir
+
+    def add(self, name, func, *args, deps=(), outputs=(), inputs=(), reused=False):
+        """
+        Adds a node to the graph.
+
+        :parameter: name: unique name of the node, used in the report.
+        :parameter: func: module-level function to run, or None for a node
+                    that only joins its dependencies.
+        :parameter: args: arguments for func.
+        :parameter: deps: names of the nodes that must be done first.
+        :parameter: outputs: files the node makes; with inputs, recorded in
+                    the manifest when the node is done.
+        :parameter: inputs: files (and other values) the outputs are made from.
+        :parameter: reused: the outputs are up to date; do not run the node.
+        :return: name, for use in deps.
+        """
+        if name in self.nodes:
+            raise ValueError('duplicate node: %s' % name)
+        for dep in deps:
+            if dep not in self.nodes:
+                raise ValueError('%s depends on unknown node: %s' % (name, dep))
+
+        node = Node(name, func, args, list(deps), list(outputs), list(inputs))
+        if reused:
+            node.status = 'reused'
+        self.nodes[name] = node
+        return name
+
+    def run(self, workers=1):
+        """
+        Runs the nodes in a pool of worker processes.
+
+        :parameter: workers: most nodes to run at the same time.
+        :return: dict of node name to status: done, reused, failed or skipped.
+        """
+        pending = [ node for node in self.nodes.values() if node.status == 'waiting' ]
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                # Nodes are in dependency order, so one pass sees the effect
+                # of any node it has just skipped or joined.
+                for node in list(pending):
+                    blocked = [ dep for dep in node.deps
+                                if self.nodes[dep].status in ('failed', 'skipped') ]
+                    if blocked:
+                        node.status = 'skipped'
+                        node.error = 'needs %s' % ', '.join(blocked)
+                        pending.remove(node)
+                    elif all(self.nodes[dep].status in FINISHED for dep in node.deps):
+                        if node.func is None:
+                            pending.remove(node)
+                            self._finish(node)
+                        elif len(running) < workers:
+                            pending.remove(node)
+                            node.started = time.time()
+                            running[executor.submit(node.func, *node.args)] = node
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    node.seconds = time.time() - node.started
+                    try:
+                        future.result()
+                    except Exception as err:
+                        node.status = 'failed'
+                        node.error = str(err) or repr(err)
+                        print('FAILED: %s: %s' % (node.name, node.error))
+                    else:
+                        self._finish(node)
+
+        return dict((name, node.status) for name, node in self.nodes.items())
+
+    def _finish(self, node):
+        node.status = 'done'
+        if node.outputs and self.manifest_dir is not None:
+            record_inputs(self.manifest_dir, node.outputs, node.inputs)
+
+    def report(self):
+        # Counts the nodes by status, and lists the ones that did not finish.
+        counts = {}
+        for node in self.nodes.values():
+            counts[node.status] = counts.get(node.status, 0) + 1
+        print('Preprocessing: %s' % ', '.join(
+                '%s %s' % (counts[status], status) for status in sorted(counts)))
+        for node in self.nodes.values():
+            if node.status not in FINISHED:
+                print('    %-8s %s: %s' % (node.status, node.name, node.error))
+
+
+def wb_command_path():
+    # Where setup_env.sh points wb_command.
+    if os.environ.get('wb_command'):
+        return os.environ['wb_command']
+    return os.path.join(os.environ.get('CARET7DIR', ''), 'wb_command')
+
+
+def run_tool(*cmd, cwd=None):
+    # Runs one external program, raising CalledProcessError (which names
+    # the command) if it fails.
+    cmd = [ str(arg) for arg in cmd ]
+    print(' '.join(cmd))
+    with span(os.path.basename(cmd[0]), 'tool', command=' '.join(cmd)):
+        subprocess.run(cmd, cwd=cwd, check=True)
+
+
+def count_scenes(scene_path):
+    # Number of scenes (frames) in a scene file.
+    with open(scene_path) as fd:
+        return fd.read().count('SceneInfo Index=')
+
+
+def start_frames(template, scene_path, values, frames_dir):
+    # Builds the brainsprite scene for one volume, and empties the directory
+    # for its frames, so no frames from an older run are left in the mosaic.
+    instantiate(template, values, scene_path)
+    if os.path.isdir(frames_dir):
+        shutil.rmtree(frames_dir)
+    os.makedirs(frames_dir)
+
+
+def show_scene(scene_path, scene_num, out_png, width, height):
+    run_tool(wb_command_path(), '-show-scene', scene_path, scene_num, out_png, width, height)
+
+
+def grid_key(img):
+    # A hash of the dimensions, voxel sizes, and sform and qform of the
+    # image, from fslhd (as in the preprocessor).
+    fields = ('dim1', 'dim2', 'dim3', 'pixdim1', 'pixdim2', 'pixdim3',
+              'qform_code', 'sform_code')
+    header = subprocess.run(['fslhd', img], stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True).stdout
+    lines = [ line for line in header.splitlines()
+              if line.split() and (line.split()[0] in fields or
+                  line.split()[0][:-2] in ('qto_xyz', 'sto_xyz')) ]
+    return hashlib.md5('\n'.join(lines).encode()).hexdigest()
+
+
+def resample(in_img, ref_img, out_img):
+    # The volume resampled to the grid of ref_img.
+    out_dir = os.path.dirname(out_img)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    run_tool('flirt', '-in', in_img, '-ref', ref_img, '-applyxfm', '-out', out_img)
+
+
+def slices_row(base_img, out_png, red_img=None, work_dir=None, native_render=False):
+    # The default slices of base_img in a row, with the edges of red_img in
+    # red, as slicesdir draws them. slicesdir writes into the directory it
+    # is run in, so each row gets its own.
+    if native_render:
+        from slice_renderer import render_default_slices_row
+        render_default_slices_row(base_img, out_png, red_img)
+        return
+
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        img_file = os.path.basename(base_img)
+        run_tool('imcp', base_img, os.path.join(tmp_dir, img_file))
+        if red_img:
+            red_file = os.path.basename(red_img)
+            run_tool('imcp', red_img, os.path.join(tmp_dir, red_file))
+            run_tool('slicesdir', '-p', red_file, img_file, cwd=tmp_dir)
+        else:
+            run_tool('slicesdir', img_file, cwd=tmp_dir)
+        img_png = img_file.replace('.nii.gz', '.png')
+        shutil.move(os.path.join(tmp_dir, 'slicesdir', img_png), out_png)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def task_rows(rows, work_dir=None, native_render=False):
+    # The registration rows of one task: (base, out, red) for each.
+    for base_img, out_png, red_img in rows:
+        slices_row(base_img, out_png, red_img, work_dir, native_render)
+
+
+def subcortical_pair(sub_img, atl_img, atlas_in_subcort, subcort_in_atlas,
+                     work_dir=None, native_render=False):
+    # Each ROI volume at the nine subcortical slices, with the outline of
+    # the other (binarized) volume in red.
+    if native_render:
+        from slice_renderer import render_subcortical_pair
+        render_subcortical_pair(sub_img, atl_img, atlas_in_subcort, subcort_in_atlas)
+        return
+
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        run_tool('imcp', sub_img, os.path.join(tmp_dir, 'subcort_sub.nii.gz'))
+        run_tool('imcp', atl_img, os.path.join(tmp_dir, 'subcort_atl.nii.gz'))
+        for base, red, out in [ ('subcort_sub.nii.gz', 'subcort_atl.nii.gz', atlas_in_subcort),
+                                ('subcort_atl.nii.gz', 'subcort_sub.nii.gz', subcort_in_atlas) ]:
+            bin_red = 'bin_' + red
+            run_tool('fslmaths', red, '-bin', bin_red, cwd=tmp_dir)
+            pngs = []
+            for num, (axis, index) in enumerate(SUBCORT_SLICER):
+                png = 'slice_%s.png' % chr(ord('a') + num)
+                run_tool('slicer', base, bin_red, axis, -index, png, '-u', '-L', cwd=tmp_dir)
+                pngs.append(png)
+            args = []
+            for png in pngs:
+                args += [ '+', png ]
+            run_tool('pngappend', *(args[1:] + [ out ]), cwd=tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def preview(in_img, out_png, native_render=False):
+    # The middle slices of the (first volume of the) image, as slicer -a
+    # draws them.
+    if native_render:
+        from slice_renderer import render_ortho_preview
+        render_ortho_preview(in_img, out_png)
+    else:
+        run_tool('slicer', in_img, '-u', '-a', out_png)
+
+
+def tx_mosaic(tx, files_path, images_path, mosaic_backend='pil', native_sprite=False, incremental=False):
+    # The BrainSprite mosaic, made as interface() makes it (and reused on
+    # the same terms). Its own frames are the parallel part, so one worker.
+    from ExecutiveSummary import preprocess_tx
+    preprocess_tx(tx, files_path, images_path, 1, mosaic_backend, native_sprite, incremental)
+
+
+def png_name(img_path):
+    name = os.path.basename(img_path)
+    return name.replace('.nii.gz', '.png').replace('.nii', '.png')
+
+
+def build_graph(files_path, html_path, subject_id, session_id=None, func_path=None,
+                atlas=None, brainsprite_template=None, pngs_template=None,
+                sprite_resolution=False, native_sprite=False, native_render=False,
+                mosaic_backend='pil', incremental=False):
+    """
+    Makes the graph of everything executivesummary_preproc.sh makes.
+
+    :parameter: files_path: path to the processed files, ending at files.
+    :parameter: html_path: the executivesummary directory.
+    :parameter: subject_id: subject ID without sub- prefix.
+    :parameter: session_id: session ID without ses- prefix, or None.
+    :parameter: func_path: path to the bids func directory, or None.
+    :parameter: atlas: atlas for the atlas rows; default: the MNI 1mm brain.
+    :parameter: brainsprite_template, pngs_template: scene templates; default:
+                the ones in templates.
+    :parameter: the rest as for interface().
+    :return: the graph, and the scratch directories its nodes use.
+    """
+    program_dir = os.path.dirname(os.path.abspath(__file__))
+    templatedir = os.path.join(program_dir, 'templates')
+    images_path = os.path.join(html_path, 'img')
+    working = os.path.join(html_path, 'temp_files')
+    manifest_dir = os.path.join(html_path, 'manifest')
+    for directory in (images_path, working, manifest_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    # The scenes go to scratch space on this node, not to files.
+    scene_dir = tempfile.mkdtemp(prefix='executivesummary_scenes.', dir=scratch_dir())
+
+    graph = TaskGraph(manifest_dir)
+    this_module = os.path.abspath(__file__)
+    if native_render:
+        renderer = os.path.join(program_dir, 'slice_renderer.py')
+    else:
+        renderer = 'renderer=fsl'
+
+    def stale(outputs, inputs):
+        # True if the outputs have to be made.
+        return not (incremental and outputs_are_current(manifest_dir, outputs, [ this_module ] + inputs))
+
+    def add(name, func, *args, deps=(), outputs=(), inputs=()):
+        # Adds the node, or marks it reused if its outputs are up to date.
+        inputs = [ this_module ] + list(inputs)
+        reused = bool(outputs) and incremental and outputs_are_current(manifest_dir, outputs, inputs)
+        if reused:
+            print('Reuse %s' % ' '.join(outputs))
+        return graph.add(name, func, *args, deps=deps, outputs=outputs, inputs=inputs, reused=reused)
+
+    atlas_space = os.path.join(files_path, 'MNINonLinear')
+    results = os.path.join(atlas_space, 'Results')
+    rois = os.path.join(atlas_space, 'ROIs')
+    images_pre = os.path.join(images_path, 'sub-%s' % subject_id)
+    if session_id is not None:
+        images_pre += '_ses-%s' % session_id
+
+    t1 = os.path.join(atlas_space, 'T1w_restore.nii.gz')
+    t2 = os.path.join(atlas_space, 'T2w_restore.nii.gz')
+    has_t2 = os.path.exists(t2)
+    if not has_t2:
+        print('t2 not found; using t1')
+        t2 = t1
+    t1_brain = os.path.join(atlas_space, 'T1w_restore_brain.nii.gz')
+    t2_brain = os.path.join(atlas_space, 'T2w_restore_brain.nii.gz')
+    surf_pre = os.path.join(atlas_space, 'fsaverage_LR32k', subject_id)
+    rp, lp = surf_pre + '.R.pial.32k_fs_LR.surf.gii', surf_pre + '.L.pial.32k_fs_LR.surf.gii'
+    rw, lw = surf_pre + '.R.white.32k_fs_LR.surf.gii', surf_pre + '.L.white.32k_fs_LR.surf.gii'
+
+    # Tasks first: the resampling makes them the longest chains.
+    resampled = {}
+    for task_dir in sorted(glob.glob(os.path.join(results, '*task-*/'))):
+        fmri_name = os.path.basename(os.path.normpath(task_dir))
+        task_img = os.path.join(results, fmri_name, fmri_name + '.nii.gz')
+        fmri_pre = os.path.join(images_path, 'sub-%s_%s' % (subject_id, fmri_name))
+        brains = [ ('T1', t1_brain) ] + ([ ('T2', t2_brain) ] if has_t2 else [])
+        outputs = []
+        for tx, brain in brains:
+            outputs += [ '%s_desc-%sInTask.gif' % (fmri_pre, tx), '%s_desc-TaskIn%s.gif' % (fmri_pre, tx) ]
+        inputs = [ task_img ] + [ brain for tx, brain in brains ] + [ renderer ]
+        if not stale(outputs, inputs):
+            add('task %s' % fmri_name, None, outputs=outputs, inputs=inputs)
+            continue
+
+        # Brains resampled to one grid are shared by every task on it.
+        try:
+            key = grid_key(task_img)
+        except (OSError, subprocess.CalledProcessError):
+            key = fmri_name
+        deps = []
+        rows = []
+        for tx, brain in brains:
+            brain_2 = os.path.join(working, 'resample_cache', key,
+                                   os.path.basename(brain).replace('.nii.gz', '.2.nii.gz'))
+            if brain_2 not in resampled:
+                resampled[brain_2] = graph.add('resample %s %s' % (os.path.basename(brain), key[:8]),
+                                               resample, brain, task_img, brain_2)
+            deps.append(resampled[brain_2])
+            rows += [ (task_img, '%s_desc-%sInTask.gif' % (fmri_pre, tx), brain_2),
+                      (brain_2, '%s_desc-TaskIn%s.gif' % (fmri_pre, tx), task_img) ]
+        add('task %s' % fmri_name, task_rows, rows, working, native_render,
+            deps=deps, outputs=outputs, inputs=inputs)
+
+    # Atlas rows.
+    if atlas is None:
+        atlas = os.path.join(templatedir, 'MNI152_T1_1mm_brain.nii.gz')
+    if os.path.exists(atlas):
+        add('atlas rows', task_rows,
+            [ (t1_brain, images_pre + '_desc-AtlasInT1w.gif', atlas),
+              (atlas, images_pre + '_desc-T1wInAtlas.gif', t1_brain) ],
+            working, native_render,
+            outputs=[ images_pre + '_desc-AtlasInT1w.gif', images_pre + '_desc-T1wInAtlas.gif' ],
+            inputs=[ t1_brain, atlas, renderer ])
+    else:
+        print('Missing %s\nCannot create atlas-in-t1 or t1-in-atlas' % atlas)
+
+    # Subcorticals.
+    subcort_sub = os.path.join(rois, 'sub2atl_ROI.2.nii.gz')
+    subcort_atl = os.path.join(rois, 'Atlas_ROIs.2.nii.gz')
+    if os.path.exists(subcort_sub) and os.path.exists(subcort_atl):
+        outputs = [ images_pre + '_desc-AtlasInSubcort.gif', images_pre + '_desc-SubcortInAtlas.gif' ]
+        add('subcorticals', subcortical_pair, subcort_sub, subcort_atl,
+            outputs[0], outputs[1], working, native_render,
+            outputs=outputs, inputs=[ subcort_sub, subcort_atl, renderer ])
+    else:
+        print('Missing subcorticals. No subcorticals will be included.')
+
+    # BOLD and SBRef (or Scout) previews.
+    if func_path is not None and os.path.isdir(func_path):
+        refs = sorted(glob.glob(os.path.join(func_path, '*task-*_sbref*.nii*')))
+        previews = [ (bold, png_name(bold)) for bold in
+                     sorted(glob.glob(os.path.join(func_path, '*task-*_bold*.nii*'))) ]
+        if refs:
+            previews += [ (ref, png_name(ref)) for ref in refs ]
+        else:
+            for scout in sorted(glob.glob(os.path.join(files_path, '*task-*', 'Scout_orig.nii.gz'))):
+                task_name = os.path.basename(os.path.dirname(scout))
+                previews.append((scout, 'sub-%s_%s_ref.png' % (subject_id, task_name)))
+        for in_img, name in previews:
+            out_png = os.path.join(images_path, name)
+            add('preview %s' % name, preview, in_img, out_png, native_render,
+                outputs=[ out_png ], inputs=[ in_img, renderer ])
+    else:
+        print('No func files. Neither BOLD nor SBREF will be shown.')
+
+    # Named pngs.
+    if pngs_template is None:
+        pngs_template = os.path.join(templatedir, 'image_template_temp.scene')
+    surfaces = [ rp, lp, rw, lw ]
+    pngs_scene = os.path.join(scene_dir, 'pngs_scene.scene')
+    scene_node = None
+    for scene_num, image_name in enumerate(IMAGE_NAMES, 1):
+        if not has_t2 and scene_num % 2 == 0:
+            continue
+        out_png = '%s_%s.png' % (images_pre, image_name)
+        inputs = [ pngs_template, t2, t1 ] + surfaces
+        if not stale([ out_png ], inputs):
+            add('png %s' % image_name, None, outputs=[ out_png ], inputs=inputs)
+            continue
+        if scene_node is None:
+            values = dict(zip([ 'T2_IMG', 'T1_IMG', 'RPIAL', 'LPIAL', 'RWHITE', 'LWHITE' ],
+                              [ t2, t1 ] + surfaces))
+            scene_node = graph.add('pngs scene', instantiate, pngs_template, values, pngs_scene)
+        add('png %s' % image_name, show_scene, pngs_scene, scene_num, out_png, 900, 800,
+            deps=[ scene_node ], outputs=[ out_png ], inputs=inputs)
+
+    # Brainsprite frames and mosaics.
+    if brainsprite_template is None:
+        brainsprite_template = os.path.join(templatedir, 'parasagittal_Tx_169_template.scene')
+    if sprite_resolution:
+        width, height = 218, 194
+    else:
+        width, height = 900, 800
+    for tx, volume in [ ('T1', t1) ] + ([ ('T2', t2) ] if has_t2 else []):
+        deps = []
+        if not native_sprite and os.path.exists(brainsprite_template):
+            frames_dir = os.path.join(files_path, '%s_pngs' % tx)
+            inputs = [ volume, brainsprite_template, rp, lp, rw, lw, 'size=%sx%s' % (width, height) ]
+            if stale([ frames_dir ], inputs):
+                scene = os.path.join(scene_dir, '%s_bs_scene.scene' % tx.lower())
+                values = dict(zip([ 'TX_IMG', 'R_PIAL', 'L_PIAL', 'R_WHITE', 'L_WHITE' ],
+                                  [ volume, rp, lp, rw, lw ]))
+                start = graph.add('%s scene' % tx, start_frames, brainsprite_template,
+                                  scene, values, frames_dir)
+                frames = []
+                for num in range(1, count_scenes(brainsprite_template) + 1):
+                    out_png = os.path.join(frames_dir, 'P_%s_frame_%s.png' % (tx, num))
+                    frames.append(graph.add('%s frame %s' % (tx, num), show_scene,
+                                            scene, num, out_png, width, height, deps=[ start ]))
+                deps = [ add('%s frames' % tx, None, deps=frames,
+                             outputs=[ frames_dir ], inputs=inputs) ]
+            else:
+                deps = [ add('%s frames' % tx, None, outputs=[ frames_dir ], inputs=inputs) ]
+        add('%s mosaic' % tx, tx_mosaic, tx, files_path, images_path,
+            mosaic_backend, native_sprite, incremental, deps=deps)
+
+    return graph, [ working, scene_dir ]
+
+
+def run_preproc(jobs=1, **kwargs):
+    """
+    Makes the images for the executive summary.
+
+    :parameter: jobs: most nodes to run at the same time.
+    :parameter: kwargs: as for build_graph.
+    :return: dict of node name to status: done, reused, failed or skipped.
+    """
+    print('START: executive summary image preprocessing (task graph)')
+    graph, scratch = build_graph(**kwargs)
+    try:
+        statuses = graph.run(max(1, jobs))
+    finally:
+        for directory in scratch:
+            shutil.rmtree(directory, ignore_errors=True)
+    graph.report()
+    print('DONE: executive summary prep')
+    return statuses
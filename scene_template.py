@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Makes wb_command scene files from the scene templates, replacing each
+placeholder with the file it stands for:
+
+    <KEY>_NAME_and_PATH  and  <KEY>_PATH   the path to the file
+    <KEY>_NAME                             the name of the file
+
+e.g. T1_IMG_PATH and T1_IMG_NAME, or TX_IMG_NAME_and_PATH. Each template is
+read and split at its placeholders once per process; making a scene from it
+only joins the pieces, so every placeholder is replaced in one pass. Paths
+are made absolute, since the scenes are written to scratch space (TMPDIR),
+away from the files they name.
+
+Give every scene of a run to one call, each with its own --scene, so that a
+template used for several scenes (e.g. the T1 and T2 brainsprite scenes) is
+read only once:
+
+    scene_template.py --scene TEMPLATE SCENE KEY=PATH ... --scene ...
+"""
+
+import os
+import argparse
+import re
+import tempfile
+from functools import lru_cache
+
+
+KINDS = ('NAME_and_PATH', 'PATH', 'NAME')
+
+
+@lru_cache(maxsize=8)
+def parse_template(template_path, mtime, keys):
+    # Splits the template into a list of text and (key, kind) placeholders.
+    # Cached on the mtime too, so a template edited while a process runs is
+    # read again.
+    with open(template_path) as fd:
+        text = fd.read()
+
+    # Longer keys first, so that no key matches the start of another.
+    pattern = re.compile('(%s)_(%s)' % (
+            '|'.join(re.escape(key) for key in sorted(keys, key=len, reverse=True)),
+            '|'.join(KINDS)))
+
+    pieces = []
+    last = 0
+    for match in pattern.finditer(text):
+        pieces.append(text[last:match.start()])
+        pieces.append((match.group(1), match.group(2)))
+        last = match.end()
+    pieces.append(text[last:])
+    return pieces
+
+
+def scratch_dir():
+    # Node-local scratch: $TMPDIR, or the system's temporary directory.
+    return tempfile.gettempdir()
+
+
+def instantiate(template_path, values, scene_path=None):
+    """
+    Makes a scene from a template.
+
+    :parameter: template_path: path to the .scene template.
+    :parameter: values: dict of placeholder key (e.g. 'T1_IMG') to the path
+                of the file it stands for.
+    :parameter: scene_path: path of the scene to write. Default: a new file
+                in scratch_dir().
+    :return: path of the scene.
+    """
+    paths = dict((key, os.path.abspath(value)) for key, value in values.items())
+    pieces = parse_template(template_path, os.path.getmtime(template_path),
+                            tuple(sorted(paths)))
+
+    parts = []
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            key, kind = piece
+            if kind == 'NAME':
+                parts.append(os.path.basename(paths[key]))
+            else:
+                parts.append(paths[key])
+        else:
+            parts.append(piece)
+
+    if scene_path is None:
+        fd, scene_path = tempfile.mkstemp(suffix='.scene', dir=scratch_dir())
+        os.close(fd)
+    with open(scene_path, 'w') as fd:
+        fd.write(''.join(parts))
+
+    return scene_path
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='scene_template',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('--scene', dest='scenes', action='append', nargs='+', required=True,
+            metavar='ARG',
+            help='a scene to make: the path to its template, the path of the '
+            'scene to write, then each placeholder key and the path of the '
+            'file it stands for, e.g. T1_IMG=MNINonLinear/T1w_restore.nii.gz. '
+            'Give once per scene.')
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    # Check every scene before making any.
+    scenes = []
+    for scene_args in args.scenes:
+        if len(scene_args) < 3:
+            parser.error('--scene needs TEMPLATE_PATH SCENE_PATH KEY=PATH ...: %s'
+                         % ' '.join(scene_args))
+        template_path, scene_path = scene_args[:2]
+
+        values = {}
+        for value in scene_args[2:]:
+            key, sep, file_path = value.partition('=')
+            if not sep:
+                parser.error('expected KEY=PATH: %s' % value)
+            values[key] = file_path
+        scenes.append((template_path, values, scene_path))
+
+    for template_path, values, scene_path in scenes:
+        instantiate(template_path, values, scene_path)
+
+
+if __name__ == '__main__':
+
+    _cli()
@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Draws the slice images for the executive summary in Python, instead of with
+slicesdir and slicer. Reads a queue file written by the preprocessor, with
+one image per line (fields separated by tabs):
+
+    row     <base_img>  <out_img>  [<red_img>]
+
+    subcort <sub_img>   <atl_img>  <atlas_in_subcort_img>  <subcort_in_atlas_img>
+    preview <in_img>    <out_img>
+
+'row' draws the default slices (0.4, 0.5 and 0.6 of the way through x, y
+and z) of base_img in a row, with the edges of red_img in red, like
+slicesdir -p. 'subcort' draws the nine fixed subcortical slices of each ROI
+volume with the outline of the other (binarized) volume in red, like the
+slicer and pngappend calls it replaces. 'preview' draws the middle sagittal,
+coronal and axial slices of the first volume of a 3D or 4D image, like
+slicer -a, reading no more of the file than it needs. Each volume is loaded
+only once, however many lines use it.
+"""
+
+import argparse
+from functools import lru_cache
+import numpy as np
+import nibabel as nib
+from PIL import Image
+from volume_sprite import scale_to_uint8
+
+
+DEFAULT_SLICES = (0.4, 0.5, 0.6)
+
+# Voxel (x, y, z) slices for the subcortical images: three sagittal, three
+# coronal and three axial, in the voxel order of the ROI files.
+SUBCORT_SLICES = [ (0, 36), (0, 45), (0, 52),
+                   (1, 43), (1, 54), (1, 65),
+                   (2, 23), (2, 33), (2, 39) ]
+RED = (255, 0, 0)
+
+
+def load_one_volume(nifti_path, volume=0):
+    # Reads a single volume of a (possibly 4D) image, without loading the
+    # rest. nibabel reads the voxels through the (gzip) stream up to the end
+    # of the volume it needs and no further, so the first volume of a
+    # multi-GB run costs about as much as a 3D image. Returns it as a RAS
+    # image.
+    img = nib.load(nifti_path, mmap=True)
+    if len(img.shape) > 3:
+        data = img.dataobj[..., volume]
+    else:
+        data = np.asanyarray(img.dataobj)
+    return nib.as_closest_canonical(nib.Nifti1Image(data, img.affine))
+
+
+@lru_cache(maxsize=16)
+def load_volume(nifti_path):
+    # Returns the RAS image of the (first) volume, its voxels scaled to 0-255
+    # for display, and its voxels as they are (for finding edges). Cached, so
+    # each volume is only read and decompressed once per run. Only the first
+    # volume of a 4D run is read, so the cache holds 3D volumes alone.
+    img = load_one_volume(nifti_path)
+    data = np.asanyarray(img.dataobj)
+    return img, scale_to_uint8(data), data
+
+
+def slice_index(fraction, length):
+    # The slice that is fraction of the way through an axis, as slicer picks it.
+    return min(length - 1, int(round(fraction * (length - 1))))
+
+
+def orient_slice(slice_2d, axis):
+    # Turns a slice of a RAS volume into an image (rows, columns, ...):
+    # superior (or anterior, for axial slices) at the top, and the subject's
+    # right on the left of coronal and axial slices, as FSL shows them.
+    image = np.swapaxes(slice_2d, 0, 1)[::-1]
+    if axis == 0:
+        # Sagittal: z down, y across.
+        return image
+    # Coronal: z down; axial: y down. Both have x across (radiological).
+    return image[:, ::-1]
+
+
+def take_slice(data, axis, index):
+    return np.take(data, index, axis=axis)
+
+
+def resample_slice(base_img, axis, index, other_img, other_data):
+    # Samples other_data (nearest neighbor) at the voxels of one slice of
+    # base_img, using the affines, so the two volumes need not share a grid.
+    shape = list(base_img.shape[:3])
+
+    # Index only the voxels of the slice: a grid over the two axes in the
+    # plane, with the sliced axis fixed at index.
+    plane = [ np.arange(n) for i, n in enumerate(shape) if i != axis ]
+    grid = list(np.meshgrid(*plane, indexing='ij'))
+    grid.insert(axis, np.full(grid[0].shape, index))
+    ijk = np.stack(grid, axis=-1)
+
+    vox_to_vox = np.linalg.inv(other_img.affine).dot(base_img.affine)
+    other_ijk = ijk.dot(vox_to_vox[:3, :3].T) + vox_to_vox[:3, 3]
+    other_ijk = np.rint(other_ijk).astype(np.intp)
+
+    inside = np.all((other_ijk >= 0) & (other_ijk < other_data.shape[:3]), axis=-1)
+    other_ijk = np.clip(other_ijk, 0, np.array(other_data.shape[:3]) - 1)
+    values = other_data[other_ijk[..., 0], other_ijk[..., 1], other_ijk[..., 2]]
+    return np.where(inside, values, 0)
+
+
+def edges_of(slice_2d):
+    # The outline of the non-background part of a slice: voxels at or above a
+    # small threshold that have a 4-neighbor below it.
+    nonzero = slice_2d[slice_2d != 0]
+    if nonzero.size == 0:
+        return np.zeros(slice_2d.shape, dtype=bool)
+    mask = slice_2d >= np.percentile(nonzero, 10)
+    padded = np.pad(mask, 1, mode='constant')
+    interior = (padded[:-2, 1:-1] & padded[2:, 1:-1] &
+                padded[1:-1, :-2] & padded[1:-1, 2:])
+    return mask & ~interior
+
+
+def canonical_slice(nifti_path, axis, index):
+    # Slice numbers like slicer's count voxels in the order they are stored.
+    # Returns the same slice as (axis, index) of the RAS volume.
+    ornt = nib.orientations.io_orientation(nib.load(nifti_path).affine)
+    ras_axis = int(ornt[axis, 0])
+    if ornt[axis, 1] < 0:
+        index = nib.load(nifti_path).shape[axis] - 1 - index
+    return ras_axis, index
+
+
+def draw_slice(base_path, axis, index, red_path=None, binarize_red=False):
+    # One slice of the base volume as an RGB array, with the edges of the red
+    # volume (or, with binarize_red, of its non-zero voxels) drawn over it.
+    base_img, base_scaled, _ = load_volume(base_path)
+    gray = take_slice(base_scaled, axis, index)
+    rgb = np.repeat(gray[:, :, np.newaxis], 3, axis=2)
+
+    if red_path is not None:
+        red_img, _, red_data = load_volume(red_path)
+        if red_img.shape[:3] == base_img.shape[:3] and np.allclose(red_img.affine, base_img.affine):
+            red_slice = take_slice(red_data, axis, index)
+        else:
+            red_slice = resample_slice(base_img, axis, index, red_img, red_data)
+        if binarize_red:
+            red_slice = (red_slice != 0).astype(np.uint8)
+        rgb[edges_of(red_slice)] = RED
+
+    return orient_slice(rgb, axis)
+
+
+def append_images(images):
+    # Lays the images out left to right, centered vertically on black, like
+    # pngappend with '+'.
+    height = max(image.shape[0] for image in images)
+    width = sum(image.shape[1] for image in images)
+    row = np.zeros((height, width, 3), dtype=np.uint8)
+    x = 0
+    for image in images:
+        h, w = image.shape[:2]
+        y = (height - h) // 2
+        row[y:y + h, x:x + w] = image
+        x += w
+    return row
+
+
+def render_default_slices_row(base_path, out_path, red_path=None):
+    """
+    Draws the default slices of a volume in a row, as slicesdir does.
+
+    :parameter: base_path: path to the volume to slice.
+    :parameter: out_path: image to write (format from the extension).
+    :parameter: red_path: optional volume whose edges are drawn in red.
+    :return: None
+    """
+    base_img = load_volume(base_path)[0]
+    slices = []
+    for axis in range(3):
+        for fraction in DEFAULT_SLICES:
+            slices.append((axis, slice_index(fraction, base_img.shape[axis])))
+
+    render_slices_row(base_path, out_path, slices, red_path)
+
+
+def render_slices_row(base_path, out_path, slices, red_path=None, binarize_red=False):
+    # Draws the (axis, index) slices of the RAS volume in a row and writes it.
+    images = [ draw_slice(base_path, axis, index, red_path, binarize_red)
+               for axis, index in slices ]
+    Image.fromarray(append_images(images), 'RGB').save(out_path)
+
+
+def render_subcortical_pair(sub_path, atl_path, atlas_in_subcort_path, subcort_in_atlas_path):
+    """
+    Draws the subject's subcorticals with the outline of the atlas ROIs, and
+    the atlas ROIs with the outline of the subject's subcorticals.
+
+    :parameter: sub_path: subject's ROI volume (sub2atl_ROI.2.nii.gz).
+    :parameter: atl_path: atlas ROI volume (Atlas_ROIs.2.nii.gz).
+    :parameter: atlas_in_subcort_path: image to write, subject in the back.
+    :parameter: subcort_in_atlas_path: image to write, atlas in the back.
+    :return: None
+    """
+    for base_path, red_path, out_path in [
+            (sub_path, atl_path, atlas_in_subcort_path),
+            (atl_path, sub_path, subcort_in_atlas_path) ]:
+        slices = [ canonical_slice(base_path, axis, index) for axis, index in SUBCORT_SLICES ]
+        render_slices_row(base_path, out_path, slices, red_path, binarize_red=True)
+
+
+def render_ortho_preview(in_path, out_path):
+    """
+    Draws the middle sagittal, coronal and axial slices of the first volume
+    of an image in a row, as slicer -a does.
+
+    :parameter: in_path: path to the image, e.g. a *_bold.nii.gz.
+    :parameter: out_path: image to write (format from the extension).
+    :return: None
+    """
+    img = load_one_volume(in_path)
+    scaled = scale_to_uint8(np.asanyarray(img.dataobj))
+
+    images = []
+    for axis in range(3):
+        index = slice_index(0.5, scaled.shape[axis])
+        gray = take_slice(scaled, axis, index)
+        images.append(orient_slice(np.repeat(gray[:, :, np.newaxis], 3, axis=2), axis))
+
+    Image.fromarray(append_images(images), 'RGB').save(out_path)
+
+
+def run_queue(queue_path):
+    # Draws every image in the queue file. Returns the number that failed;
+    # one bad line does not stop the others.
+    failures = 0
+    with open(queue_path) as fd:
+        lines = [ line.rstrip('\n').split('\t') for line in fd if line.strip() ]
+
+    for fields in lines:
+        kind, args = fields[0], fields[1:]
+        try:
+            if kind == 'row':
+                render_default_slices_row(*args)
+            elif kind == 'subcort':
+                render_subcortical_pair(*args)
+            elif kind == 'preview':
+                render_ortho_preview(*args)
+            else:
+                raise ValueError('unknown kind of image: %s' % kind)
+            print('Drew %s' % ' '.join(fields))
+        except Exception as err:
+            failures += 1
+            print('ERROR: could not draw %s: %s' % (' '.join(fields), err))
+
+    return failures
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='slice_renderer',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('queue', metavar='QUEUE_PATH',
+            help='path to the file listing the images to draw.')
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    failures = run_queue(args.queue)
+    if failures:
+        raise SystemExit('%s image(s) could not be drawn.' % failures)
+
+
+if __name__ == '__main__':
+
+    _cli()
@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Splits a BrainSprite mosaic into row bands, so the viewer can draw the
+sagittal slices it is showing as soon as their band has loaded, instead of
+waiting for the whole mosaic (about 2800x2800 pixels).
+
+Each band is one row of slices of the mosaic, written to img/tiles with an
+index (img/tiles/<mosaic>.json) of the size of the mosaic, the height of a
+band and the names of the bands, top to bottom. The index is given the
+mtime of its mosaic, and the bands are made again only if the mosaic has
+changed.
+"""
+
+import os
+import argparse
+import json
+from PIL import Image
+
+
+TILES_DIR = 'tiles'
+
+
+def tiles_index_path(mosaic_path):
+    # img/T1_mosaic.jpg -> img/tiles/T1_mosaic.json
+    img_dir, name = os.path.split(mosaic_path)
+    return os.path.join(img_dir, TILES_DIR, os.path.splitext(name)[0] + '.json')
+
+
+def band_name(mosaic_path, band):
+    # T1_mosaic.jpg -> T1_mosaic.band00.jpg
+    return '%s.band%02d.jpg' % (os.path.splitext(os.path.basename(mosaic_path))[0], band)
+
+
+def read_tiles_index(mosaic_path, band_height):
+    # The index of the bands, if they were made from this mosaic with bands
+    # of this height; else None.
+    index_path = tiles_index_path(mosaic_path)
+    try:
+        if os.stat(index_path).st_mtime_ns != os.stat(mosaic_path).st_mtime_ns:
+            return None
+        with open(index_path) as fd:
+            index = json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+    if index.get('bandHeight') != band_height:
+        return None
+    return index
+
+
+def tile_mosaic(mosaic_path, band_height, base_dir=None, quality=95):
+    """
+    Makes (or reuses) the row bands of a mosaic.
+
+    :parameter: mosaic_path: path to the BrainSprite mosaic.
+    :parameter: band_height: height of a row of slices, in pixels (the
+                number of Z slices).
+    :parameter: base_dir: directory that mosaic_path is relative to (e.g.
+                that of the page), if not the cwd.
+    :parameter: quality: JPEG quality of the bands.
+    :return: the index: dict of width, height, bandHeight, and bands (the
+             names of the bands, in img/tiles, top to bottom).
+    """
+    if base_dir is not None:
+        mosaic_path = os.path.join(base_dir, mosaic_path)
+
+    index = read_tiles_index(mosaic_path, band_height)
+    if index is not None:
+        return index
+
+    tiles_dir = os.path.dirname(tiles_index_path(mosaic_path))
+    os.makedirs(tiles_dir, exist_ok=True)
+
+    bands = []
+    with Image.open(mosaic_path) as mosaic:
+        width, height = mosaic.size
+        for top in range(0, height, band_height):
+            name = band_name(mosaic_path, len(bands))
+            band = mosaic.crop((0, top, width, min(top + band_height, height)))
+            band.save(os.path.join(tiles_dir, name), 'JPEG', quality=quality)
+            bands.append(name)
+
+    index = { 'width': width, 'height': height, 'bandHeight': band_height, 'bands': bands }
+    index_path = tiles_index_path(mosaic_path)
+    with open(index_path, 'w') as fd:
+        json.dump(index, fd)
+
+    stat = os.stat(mosaic_path)
+    os.utime(index_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return index
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='sprite_tiles',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('mosaic', metavar='MOSAIC_PATH',
+            help='path to the mosaic, e.g. img/T1_mosaic.jpg.')
+    parser.add_argument('--band-height', dest='band_height', type=int, default=218,
+            help='height of a row of slices, in pixels. Default: 218.')
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    index = tile_mosaic(args.mosaic, args.band_height)
+    print('%s bands in %s' % (len(index['bands']), os.path.dirname(tiles_index_path(args.mosaic))))
+
+
+if __name__ == '__main__':
+
+    _cli()
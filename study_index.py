@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Writes the index page of a study: one row per subject/session, with small
+previews of its atlas and gray-plot images and a link to its executive
+summary. The rows can be sorted and filtered, and only the rows in view are
+drawn, so the page stays quick with tens of thousands of sessions.
+
+The sessions are sub-<label>/ses-<label> (or sub-<label>) directories of the
+study root, each with an executivesummary directory under files (or under
+files/<summary dir>). What was found is kept in a manifest next to the page,
+with the mtime of every directory that was listed. An update lists only the
+directories whose mtime has changed, and checks each known page with one
+stat; a session is read again only when its page has changed.
+"""
+
+import os
+import argparse
+import glob
+import json
+import time
+from datetime import datetime
+from constants import (IMAGE_INFO, STUDY_INDEX_START, STUDY_INDEX_HEADER,
+                       STUDY_INDEX_DATA, STUDY_INDEX_SCRIPTS)
+from helpers import DirectoryIndex
+from layout_builder import HtmlWriter
+from thumbnails import make_thumbnail
+
+
+MANIFEST_VERSION = 1
+
+# Widest preview in the index, in pixels.
+INDEX_THUMB_WIDTH = 320
+
+# Where a session's pages may be, relative to the session directory.
+PAGE_GLOBS = [ os.path.join('files', 'executivesummary', 'executive_summary_*.html'),
+               os.path.join('files', '*', 'executivesummary', 'executive_summary_*.html') ]
+
+
+def manifest_path(index_path):
+    # study_index.html -> study_index.manifest.json
+    return os.path.splitext(index_path)[0] + '.manifest.json'
+
+
+def load_manifest(path, root):
+    # The manifest of the last update, or an empty one if there is none, it
+    # cannot be read, or it is for another root.
+    empty = { 'version': MANIFEST_VERSION, 'root': root, 'dirs': {}, 'sessions': {} }
+    try:
+        with open(path) as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError):
+        return empty
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('root') != root:
+        return empty
+    return manifest
+
+
+def save_manifest(manifest, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fd:
+        json.dump(manifest, fd)
+    os.replace(tmp_path, path)
+
+
+def session_key(rel_path):
+    """
+    Gets the session directory that a path under the study root is in.
+
+    :parameter: rel_path: path relative to the study root, e.g.
+                sub-01/ses-A/files/executivesummary/executive_summary_sub-01_ses-A.html
+    :return: sub-01/ses-A (or sub-01 for a study without sessions), or None.
+    """
+    parts = rel_path.replace(os.sep, '/').split('/')
+    if not parts[0].startswith('sub-'):
+        return None
+    if len(parts) > 1 and parts[1].startswith('ses-'):
+        return '/'.join(parts[:2])
+    return parts[0]
+
+
+def list_subdirs(dir_path, prefix):
+    # Names of the subdirectories that start with prefix.
+    return [ name for name in DirectoryIndex(dir_path).subdirs() if name.startswith(prefix) ]
+
+
+def find_sessions(root, manifest, full=False):
+    """
+    Finds the session directories of the study, listing only the
+    directories that changed since the manifest was written.
+
+    :parameter: root: the study root.
+    :parameter: manifest: the manifest of the last update; its dirs are
+                replaced with the mtimes of the directories seen now.
+    :parameter: full: list every directory again.
+    :return: sorted list of session keys (e.g. sub-01/ses-A).
+    """
+    old_dirs = {} if full else manifest['dirs']
+    new_dirs = {}
+
+    # The sessions found before, by subject.
+    old_sessions = {}
+    for key in manifest['sessions']:
+        old_sessions.setdefault(key.split('/')[0], []).append(key)
+
+    def changed(rel_dir):
+        # Records the directory's mtime; True if it must be listed again.
+        try:
+            mtime = os.stat(os.path.join(root, rel_dir)).st_mtime_ns
+        except OSError:
+            return None
+        new_dirs[rel_dir] = mtime
+        return old_dirs.get(rel_dir) != mtime
+
+    if changed('.') is not False:
+        subjects = list_subdirs(root, 'sub-')
+    else:
+        subjects = sorted(set(key.split('/')[0] for key in old_dirs if key != '.'))
+
+    sessions = []
+    for subject in subjects:
+        sub_changed = changed(subject)
+        if sub_changed is None:
+            # It has gone.
+            continue
+        if sub_changed:
+            ses_dirs = list_subdirs(os.path.join(root, subject), 'ses-')
+            if ses_dirs:
+                sessions += [ subject + '/' + ses_dir for ses_dir in ses_dirs ]
+            else:
+                sessions.append(subject)
+        else:
+            sessions += old_sessions.get(subject, [])
+
+    manifest['dirs'] = new_dirs
+    return sorted(sessions)
+
+
+def find_page(root, key):
+    # The session's executive summary page, relative to the root, or None.
+    for page_glob in PAGE_GLOBS:
+        pages = sorted(glob.glob(os.path.join(root, key, page_glob)))
+        if pages:
+            return os.path.relpath(pages[0], root)
+    return None
+
+
+def read_session(root, key, page, index_dir):
+    """
+    Gets the row of a session from its page and images.
+
+    :parameter: root: the study root.
+    :parameter: key: the session directory, e.g. sub-01/ses-A.
+    :parameter: page: the session's page, relative to the root, or None.
+    :parameter: index_dir: directory of the index page.
+    :return: dict of subject, session, page, page_mtime, date, tasks, atlas
+             and gray (paths relative to index_dir, or None).
+    """
+    parts = key.split('/')
+    row = { 'subject': parts[0][len('sub-'):],
+            'session': parts[1][len('ses-'):] if len(parts) > 1 else None,
+            'page': None, 'page_mtime': None, 'date': None, 'tasks': 0,
+            'atlas': None, 'gray': None }
+    if page is None:
+        return row
+
+    page_path = os.path.join(root, page)
+    mtime_ns = os.stat(page_path).st_mtime_ns
+    page_dir = os.path.dirname(page_path)
+    row['page'] = os.path.relpath(page_path, index_dir)
+    row['page_mtime'] = mtime_ns
+    row['date'] = datetime.fromtimestamp(mtime_ns / 1e9).strftime('%Y-%m-%d %H:%M')
+
+    # The images are in img, next to the page.
+    img_index = DirectoryIndex(os.path.join(page_dir, 'img'), prefix='img')
+    row['tasks'] = len(img_index.find_files(IMAGE_INFO['task_in_t1']['pattern'] % ''))
+    for column, key in [ ('atlas', 'atlas_in_t1'), ('gray', 'concat_pre_reg_gray') ]:
+        found = sorted(img_index.find_files(IMAGE_INFO[key]['pattern']))
+        if found:
+            preview = make_thumbnail(found[0], INDEX_THUMB_WIDTH, page_dir)
+            row[column] = os.path.relpath(os.path.join(page_dir, preview), index_dir)
+
+    return row
+
+
+def update_index(root, index_path=None, pages=None, full=False):
+    """
+    Updates the index page of a study, and its manifest.
+
+    :parameter: root: the study root.
+    :parameter: index_path: the index page. Default: study_index.html in
+                the root.
+    :parameter: pages: paths of pages just written (e.g. by a batch). Only
+                their sessions are read; the directories are not listed
+                (unless there is no manifest yet).
+    :parameter: full: list every directory and read every session again.
+    :return: number of sessions (with a page) in the index.
+    """
+    root = os.path.abspath(root)
+    if index_path is None:
+        index_path = os.path.join(root, 'study_index.html')
+    index_path = os.path.abspath(index_path)
+    index_dir = os.path.dirname(index_path)
+
+    manifest = load_manifest(manifest_path(index_path), root)
+    old_sessions = {} if full else manifest['sessions']
+
+    if pages is not None and manifest['dirs'] and not full:
+        # Just the given pages' sessions are new or changed.
+        sessions = dict(old_sessions)
+        for page in pages:
+            page = os.path.relpath(os.path.abspath(page), root)
+            key = session_key(page)
+            if key is not None:
+                sessions[key] = read_session(root, key, page, index_dir)
+    else:
+        sessions = {}
+        for key in find_sessions(root, manifest, full):
+            row = old_sessions.get(key)
+            if row is not None and row['page'] is not None:
+                # One stat tells whether the known page has changed.
+                page = os.path.relpath(os.path.join(index_dir, row['page']), root)
+                try:
+                    if os.stat(os.path.join(root, page)).st_mtime_ns == row['page_mtime']:
+                        sessions[key] = row
+                        continue
+                except OSError:
+                    page = find_page(root, key)
+            else:
+                page = find_page(root, key)
+            sessions[key] = read_session(root, key, page, index_dir)
+
+    manifest['sessions'] = sessions
+    count = write_index(sessions, index_path, os.path.basename(root))
+    save_manifest(manifest, manifest_path(index_path))
+    return count
+
+
+def write_index(sessions, index_path, title):
+    # Writes the page, with the sessions that have a page. Returns how many.
+    rows = [ dict((column, row[column]) for column in
+                  ('subject', 'session', 'date', 'tasks', 'page', 'atlas', 'gray'))
+             for key, row in sorted(sessions.items()) if row['page'] is not None ]
+    for row in rows:
+        for column in ('page', 'atlas', 'gray'):
+            if row[column] is not None:
+                row[column] = row[column].replace(os.sep, '/')
+
+    sessions_json = json.dumps(rows, separators=(',', ':')).replace('</', '<\\/')
+    with HtmlWriter(index_path) as writer:
+        writer.write(STUDY_INDEX_START)
+        writer.write(STUDY_INDEX_HEADER.format(title='Executive Summaries: %s' % title, count=len(rows)))
+        writer.write(STUDY_INDEX_DATA % { 'sessions_json': sessions_json })
+        writer.write(STUDY_INDEX_SCRIPTS)
+
+    return len(rows)
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='study_index',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('root', metavar='STUDY_ROOT',
+            help='directory with a sub-<label> directory per subject.')
+    parser.add_argument('--output', '-o', dest='output', metavar='INDEX_PATH',
+            help='path of the index page. Its manifest is written next to '
+            'it. Default: STUDY_ROOT/study_index.html.')
+    parser.add_argument('--full', dest='full', action='store_true',
+            help='list every directory and read every session again, '
+            'instead of only what changed since the last update.')
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    start = time.time()
+    count = update_index(args.root, args.output, full=args.full)
+    print('Indexed %s sessions in %.1fs.' % (count, time.time() - start))
+
+
+if __name__ == '__main__':
+
+    _cli()
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Checks that layouts built side by side in threads are the same as layouts
+built one at a time: the pages, and the previews they show, must be byte for
+byte the same. Builds small synthetic sessions (images only; no
+preprocessing), so it needs neither FSL nor workbench.
+
+Run from the top of the repository with
+    python -m pytest tests
+or
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import io
+import contextlib
+import random
+import shutil
+import tempfile
+import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from layout_builder import layout_builder
+from batch_summary import run_batch
+
+
+SUMMARY_DIR = 'summary_DCANBOLDProc_v4.0.0'
+
+SESSIONS = [ ('01', 'A'), ('01', 'B'), ('02', 'A'), ('03', None), ('04', 'A'), ('05', 'A') ]
+
+TASKS = [ 'rest01', 'rest02', 'nback01' ]
+
+
+def write_image(image_path, size, seed, color=True):
+    # Random grays, blended smoothly from one to the next, so every file
+    # (and its preview) differs.
+    rng = random.Random(seed)
+    width, height = size
+    img = Image.new('L', (width // 8, height // 8))
+    img.putdata([ rng.randrange(256) for _ in range(img.size[0] * img.size[1]) ])
+    img = img.resize(size, resample=Image.BILINEAR)
+    if color:
+        img = Image.merge('RGB', (img, img.point(lambda v: v // 2), img.point(lambda v: 255 - v)))
+    if image_path.endswith('.gif'):
+        img = img.quantize(256, dither=Image.NONE) if color else img
+    img.save(image_path)
+
+
+def make_session(study_root, subject_id, session_id):
+    # Lays out a session as the preprocessor would leave it: the task
+    # directories, the summary data, and the images. Returns files_path.
+    files_path = os.path.join(study_root, 'sub-' + subject_id)
+    if session_id is not None:
+        files_path = os.path.join(files_path, 'ses-' + session_id)
+    files_path = os.path.join(files_path, 'files')
+    summary_path = os.path.join(files_path, SUMMARY_DIR)
+    images_path = os.path.join(summary_path, 'executivesummary', 'img')
+    os.makedirs(images_path)
+
+    prefix = 'sub-%s' % subject_id
+    if session_id is not None:
+        prefix += '_ses-%s' % session_id
+    seed = zlib.crc32(prefix.encode('utf-8'))
+
+    for task in TASKS:
+        os.makedirs(os.path.join(files_path, 'MNINonLinear', 'Results', 'task-' + task))
+
+    # The gray plots are copied into img by the layout.
+    for name in [ 'DVARS_and_FD_CONCA_task-rest.png', 'DVARS_and_FD_CONCP_task-rest.png' ]:
+        seed += 1
+        write_image(os.path.join(summary_path, name), (320, 80), seed)
+    for task in TASKS:
+        for name in [ 'DVARS_and_FD_task-%s.png', 'postreg_DVARS_and_FD_task-%s.png' ]:
+            seed += 1
+            write_image(os.path.join(summary_path, name % task), (320, 80), seed)
+
+    # Rows wider than the previews, so that previews are made.
+    names = [ '%s_desc-%s.gif' % (prefix, desc) for desc in
+              [ 'AtlasInT1w', 'T1wInAtlas', 'AtlasInSubcort', 'SubcortInAtlas' ] ]
+    for task in TASKS:
+        names += [ '%s_task-%s_desc-TaskInT1.gif' % (prefix, task),
+                   '%s_task-%s_desc-T1InTask.gif' % (prefix, task) ]
+    for name in names:
+        seed += 1
+        write_image(os.path.join(images_path, name), (2000, 40), seed)
+
+    for task in TASKS:
+        for kind in [ 'bold', 'ref' ]:
+            seed += 1
+            write_image(os.path.join(images_path, '%s_task-%s_%s.png' % (prefix, task, kind)),
+                        (800, 60), seed, color=False)
+
+    for tx in [ 'T1', 'T2' ]:
+        for idx in range(1, 10):
+            seed += 1
+            write_image(os.path.join(images_path, '%s_%s-%s.png' % (prefix, tx, idx)), (40, 40), seed)
+
+    return files_path
+
+
+def build_layout(files_path, subject_id, session_id):
+    # The layout of one session, as ExecutiveSummary.py --layout-only does
+    # it. Returns the path of the page.
+    summary_path = os.path.join(files_path, SUMMARY_DIR)
+    html_path = os.path.join(summary_path, 'executivesummary')
+    with contextlib.redirect_stdout(io.StringIO()):
+        builder = layout_builder(files_path, summary_path, html_path,
+                                 os.path.join(html_path, 'img'), subject_id, session_id)
+    return builder.page_path
+
+
+def read_outputs(page_path):
+    # The page, and every preview, by path. (Not the previews' records,
+    # which hold the mtimes of the images.)
+    outputs = {}
+    with open(page_path, 'rb') as fd:
+        outputs[page_path] = fd.read()
+    thumbs_dir = os.path.join(os.path.dirname(page_path), 'img', 'thumbs')
+    for name in sorted(os.listdir(thumbs_dir)):
+        if name.endswith('.json'):
+            continue
+        with open(os.path.join(thumbs_dir, name), 'rb') as fd:
+            outputs[os.path.join(thumbs_dir, name)] = fd.read()
+    return outputs
+
+
+def remove_outputs(page_path):
+    # So the next build makes the page and previews again.
+    os.remove(page_path)
+    shutil.rmtree(os.path.join(os.path.dirname(page_path), 'img', 'thumbs'))
+
+
+class TestConcurrentLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.study_root = tempfile.mkdtemp(prefix='test_concurrent_layout_')
+        self.sessions = [ (subject_id, session_id, make_session(self.study_root, subject_id, session_id))
+                          for subject_id, session_id in SESSIONS ]
+
+        # The serial build is the reference.
+        self.expected = {}
+        self.pages = []
+        for subject_id, session_id, files_path in self.sessions:
+            page_path = build_layout(files_path, subject_id, session_id)
+            self.assertIsNotNone(page_path)
+            self.pages.append(page_path)
+            self.expected.update(read_outputs(page_path))
+
+        # Previews were made, so building them is part of what is compared.
+        self.assertTrue(any(os.sep + 'thumbs' + os.sep in path for path in self.expected))
+
+        for page_path in self.pages:
+            remove_outputs(page_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.study_root)
+
+    def check_outputs(self, pages):
+        self.assertEqual(sorted(pages), sorted(self.pages))
+        built = {}
+        for page_path in pages:
+            built.update(read_outputs(page_path))
+        self.assertEqual(sorted(built), sorted(self.expected))
+        for path in sorted(self.expected):
+            self.assertEqual(built[path], self.expected[path], 'differs: %s' % path)
+
+    def test_thread_pool(self):
+        # Every session at once, each layout in its own thread.
+        with ThreadPoolExecutor(max_workers=len(self.sessions)) as executor:
+            pages = list(executor.map(lambda session: build_layout(session[2], session[0], session[1]),
+                                      self.sessions))
+        self.check_outputs(pages)
+
+    def test_run_batch_threads(self):
+        # The same, through batch_summary.py --layout-only --threads.
+        log_dir = os.path.join(self.study_root, 'logs')
+        options = { 'summary_dir': SUMMARY_DIR, 'layout_only': True }
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = run_batch(self.sessions, options, log_dir, workers=4, threads=True)
+        for result in results:
+            self.assertEqual(result['status'], 'ok', result['error'])
+        self.check_outputs([ result['page'] for result in results ])
+
+
+if __name__ == '__main__':
+
+    unittest.main()
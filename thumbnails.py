@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Makes the small previews of the images shown in the rows of the executive
+summary, in img/thumbs. The rows show the previews; the modal containers and
+sliders still show the images at full size.
+
+A preview keeps the kind of image it was made from: a grayscale image (e.g.
+a BOLD or reference preview) becomes a JPEG, and anything with color (the
+slicesdir rows, with their red edges, and the gray plots) a PNG with a
+palette of at most 256 colors, like the GIFs it replaces. If the preview is
+not smaller than its image, the row shows the image.
+
+Each preview has a record (img/thumbs/<name>.w<width>.json) of the size and
+mtime of the image it was made from, and of what the row shows. A preview is
+made again only if its image has changed, so a later layout (e.g. with
+--layout-only) reuses every one whose image has the same size and mtime.
+"""
+
+import os
+import argparse
+import json
+from PIL import Image, ImageChops
+
+
+THUMBS_DIR = 'thumbs'
+
+# Width of the page, in pixels, that the previews are made for: a full HD
+# screen. The rows stretch each image to the width of its column, so a
+# preview is made as wide as its column is on a page this wide, and is not
+# scaled up in any narrower window.
+PAGE_WIDTH = 1920
+
+# The share of the page's width taken by the image column of each kind of
+# row, in the wide layout: w3-col l11; w3-col l9 in a w3-half; w3-quarter.
+ROW_SHARE = 11 / 12.0
+HALF_ROW_SHARE = 9 / 12.0 / 2
+QUARTER_ROW_SHARE = 1 / 4.0
+
+JPEG_QUALITY = 85
+
+
+def preview_width(share, page_width=PAGE_WIDTH):
+    # Widest preview for a row whose image column is share of the page.
+    return int(page_width * share)
+
+
+def thumbnail_path(image_file, max_width, ext):
+    # img/name.gif -> img/thumbs/name.w1760.png (ext '.png'), or the
+    # preview's record (ext '.json').
+    img_dir, name = os.path.split(image_file)
+    return os.path.join(img_dir, THUMBS_DIR, '%s.w%s%s' % (os.path.splitext(name)[0], max_width, ext))
+
+
+def source_stamp(source_file):
+    # What the record keeps of the image, to tell whether it has changed.
+    stat = os.stat(source_file)
+    return { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+
+
+def read_record(record_file, stamp):
+    # What the row shows (the preview, or the image itself: None), if the
+    # record was made from an image with this stamp; else False.
+    try:
+        with open(record_file) as fd:
+            record = json.load(fd)
+    except (OSError, ValueError):
+        return False
+    if record.get('source') != stamp:
+        return False
+    return record.get('preview')
+
+
+def is_grayscale(img):
+    # True if every pixel of an RGB image is gray.
+    red, green, blue = img.split()
+    return (ImageChops.difference(red, green).getbbox() is None and
+            ImageChops.difference(green, blue).getbbox() is None)
+
+
+def write_preview(img, max_width, image_file, base_dir):
+    # Shrinks img to max_width and saves it. Returns the path of the
+    # preview, relative as image_file is, or None if it is not smaller
+    # than the image.
+    # Scale in RGB so the edges stay smooth.
+    thumb = img.convert('RGB')
+    thumb.thumbnail((max_width, img.size[1]), resample=Image.LANCZOS)
+
+    if is_grayscale(thumb):
+        preview = thumbnail_path(image_file, max_width, '.jpg')
+        thumb, kwargs = thumb.convert('L'), { 'format': 'JPEG', 'quality': JPEG_QUALITY, 'optimize': True }
+    else:
+        # Back to a palette, without dithering, which would only make the
+        # PNG bigger.
+        preview = thumbnail_path(image_file, max_width, '.png')
+        thumb, kwargs = thumb.quantize(256, dither=Image.NONE), { 'format': 'PNG', 'optimize': True }
+
+    thumb_file = preview if base_dir is None else os.path.join(base_dir, preview)
+    source_file = image_file if base_dir is None else os.path.join(base_dir, image_file)
+    os.makedirs(os.path.dirname(thumb_file), exist_ok=True)
+    thumb.save(thumb_file, **kwargs)
+
+    if os.path.getsize(thumb_file) >= os.path.getsize(source_file):
+        os.remove(thumb_file)
+        return None
+    return preview
+
+
+def make_thumbnail(image_file, max_width, base_dir=None):
+    """
+    Makes (or reuses) the preview of an image.
+
+    :parameter: image_file: path to the full-size image.
+    :parameter: max_width: widest the preview may be, in pixels.
+    :parameter: base_dir: directory that image_file is relative to (e.g. that
+                of the page), if not the cwd.
+    :return: path to the preview, or to the image itself if it is already
+             no wider than max_width, its preview would not be smaller, or
+             it cannot be read; relative to base_dir as image_file is.
+    """
+    record = thumbnail_path(image_file, max_width, '.json')
+    if base_dir is not None:
+        source_file = os.path.join(base_dir, image_file)
+        record_file = os.path.join(base_dir, record)
+    else:
+        source_file = image_file
+        record_file = record
+
+    try:
+        stamp = source_stamp(source_file)
+    except OSError as err:
+        print('Cannot make a preview of %s: %s' % (source_file, err))
+        return image_file
+
+    preview = read_record(record_file, stamp)
+    if preview is not False:
+        return preview or image_file
+
+    try:
+        with Image.open(source_file) as img:
+            if img.size[0] <= max_width:
+                return image_file
+            preview = write_preview(img, max_width, image_file, base_dir)
+    except (IOError, OSError) as err:
+        print('Cannot make a preview of %s: %s' % (source_file, err))
+        return image_file
+
+    # Write the record last, so that a preview is only reused once it is
+    # complete.
+    with open(record_file, 'w') as fd:
+        json.dump({ 'source': stamp, 'preview': preview }, fd)
+
+    return preview or image_file
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='thumbnails',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('images', metavar='IMAGE_PATH', nargs='+',
+            help='path to a full-size image, e.g. img/sub-01_desc-AtlasInT1w.gif.')
+    parser.add_argument('--max-width', dest='max_width', type=int, default=preview_width(ROW_SHARE),
+            help='widest the previews may be, in pixels. Default: %s (a full '
+            'row on a page %s pixels wide).' % (preview_width(ROW_SHARE), PAGE_WIDTH))
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    for image_file in args.images:
+        print(make_thumbnail(image_file, args.max_width))
+
+
+if __name__ == '__main__':
+
+    _cli()
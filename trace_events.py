@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Records how long each step of a run takes, as Chrome trace events that can
+be loaded in chrome://tracing or https://ui.perfetto.dev.
+
+While a run is traced, ES_TRACE_EVENTS names a file of events, one JSON
+object per line. Python code (in any process) and executivesummary_preproc.sh
+append 'complete' events to it as steps finish; appending one short line at
+a time keeps lines from different processes whole. When the run is done,
+finalize gathers the lines into the trace file itself. The events file can
+also be finalized from the command line.
+"""
+
+import os
+import argparse
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+TRACE_ENV = 'ES_TRACE_EVENTS'
+
+
+def events_path():
+    # The events file of the run being traced, or None.
+    return os.environ.get(TRACE_ENV) or None
+
+
+def now_us():
+    # Trace timestamps are in microseconds.
+    return int(time.time() * 1000000)
+
+
+def add_event(name, cat, start_us, end_us, args=None):
+    """
+    Appends a complete ('X') event to the events file, if the run is traced.
+
+    :parameter: name: name of the step, e.g. the tool or function.
+    :parameter: cat: category, to group or filter on in the viewer.
+    :parameter: start_us: start time, in microseconds since the epoch.
+    :parameter: end_us: end time, in microseconds since the epoch.
+    :parameter: args: dict of anything else to show for the event.
+    :return: None
+    """
+    path = events_path()
+    if path is None:
+        return
+
+    event = { 'name': name, 'cat': cat, 'ph': 'X',
+              'ts': start_us, 'dur': max(0, end_us - start_us),
+              'pid': os.getpid(), 'tid': threading.get_ident() % 100000,
+              'args': args or {} }
+    with open(path, 'a') as fd:
+        fd.write(json.dumps(event) + '\n')
+
+
+@contextmanager
+def span(name, cat='python', **args):
+    """
+    Records the time spent in the with block as one event, and whether it
+    finished or raised.
+
+    :parameter: name: name of the step.
+    :parameter: cat: category of the step.
+    :parameter: args: anything else to show for the event.
+    """
+    if events_path() is None:
+        yield
+        return
+
+    start = now_us()
+    try:
+        yield
+    except BaseException as err:
+        args['status'] = 'error: %s' % (str(err) or repr(err))
+        add_event(name, cat, start, now_us(), args)
+        raise
+    args['status'] = 'ok'
+    add_event(name, cat, start, now_us(), args)
+
+
+def start_trace(trace_path):
+    # Starts tracing this process (and the processes it starts) into an
+    # events file next to trace_path. Returns the events file.
+    path = os.path.abspath(trace_path) + '.events'
+    open(path, 'w').close()
+    os.environ[TRACE_ENV] = path
+    return path
+
+
+def finalize(events_file, trace_path):
+    """
+    Gathers the events into a trace file, in the JSON object format.
+
+    :parameter: events_file: file of events, one per line.
+    :parameter: trace_path: trace file to write.
+    :return: number of events written.
+    """
+    events = []
+    with open(events_file) as fd:
+        for line in fd:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # A process killed part way through a write.
+                print('Skipped a bad trace event: %s' % line)
+
+    events.sort(key=lambda event: event.get('ts', 0))
+    with open(trace_path, 'w') as fd:
+        json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, fd)
+
+    return len(events)
+
+
+def stop_trace(trace_path):
+    # Writes the trace for the events recorded since start_trace, and stops
+    # tracing.
+    path = os.environ.pop(TRACE_ENV, None)
+    if path is None or not os.path.exists(path):
+        return
+    count = finalize(path, trace_path)
+    os.remove(path)
+    print('Wrote %s trace events to %s' % (count, trace_path))
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='trace_events',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('events', metavar='EVENTS_PATH',
+            help='path to the file of events, one per line.')
+    parser.add_argument('trace', metavar='TRACE_PATH',
+            help='path of the trace file to write.')
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    count = finalize(args.events, args.trace)
+    print('Wrote %s trace events to %s' % (count, args.trace))
+
+
+if __name__ == '__main__':
+
+    _cli()
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Makes the mosaic for a BrainSprite viewer directly from a NIfTI volume, by
+slicing the volume sagittally in numpy, instead of from the frames rendered
+by wb_command. The mosaic has no surface outlines.
+"""
+
+import os
+import argparse
+import json
+from math import ceil, sqrt
+import numpy as np
+import nibabel as nib
+from PIL import Image
+
+
+def load_canonical(nifti_path):
+    # Loads the volume and reorients it to RAS, so that the first axis runs
+    # left to right, the second posterior to anterior and the third inferior
+    # to superior. The voxels are read lazily (and memory-mapped, for
+    # uncompressed files) until the reorientation needs them.
+    img = nib.load(nifti_path, mmap=True)
+    return nib.as_closest_canonical(img)
+
+
+def scale_to_uint8(data, low_pct=2, high_pct=98):
+    # Maps the intensities to 0-255, clipping at percentiles of the non-zero
+    # voxels (much like slicer does) so a few bright voxels do not wash out
+    # the brain.
+    nonzero = data[data != 0]
+    if nonzero.size == 0:
+        return np.zeros(data.shape, dtype=np.uint8)
+    low, high = np.percentile(nonzero, [low_pct, high_pct])
+    if high <= low:
+        high = low + 1
+    scaled = (data - low) * (255.0 / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def volume_to_sprite(data):
+    # Lays the sagittal slices of a RAS volume out as tiles, left to right
+    # and top to bottom, the way brainsprite expects: each tile is one x
+    # slice, with y across and z (superior at the top) down.
+    nx, ny, nz = data.shape
+    nb_rows = int(ceil(sqrt(nx)))
+    nb_cols = int(ceil(nx / float(nb_rows)))
+
+    tiles = np.zeros((nb_rows * nb_cols, nz, ny), dtype=data.dtype)
+    tiles[:nx] = data.transpose(0, 2, 1)[:, ::-1, :]
+
+    # (row, col, z, y) -> (row, z, col, y) is the sprite layout.
+    sprite = tiles.reshape(nb_rows, nb_cols, nz, ny).transpose(0, 2, 1, 3)
+    return sprite.reshape(nb_rows * nz, nb_cols * ny)
+
+
+def sprite_params(img):
+    # The values the brainsprite loader needs to read the sprite and to show
+    # world coordinates for the slices.
+    nx, ny, nz = img.shape[:3]
+    affine = img.affine
+    return {
+        'nbSlice'   : { 'Y': int(ny), 'Z': int(nz) },
+        'voxelSize' : float(img.header.get_zooms()[0]),
+        'origin'    : { 'X': float(-affine[0, 3]),
+                        'Y': float(-affine[1, 3]),
+                        'Z': float(-affine[2, 3]) }
+        }
+
+
+def sprite_params_path(mosaic_path):
+    # The loader parameters are written next to the mosaic:
+    # T1_mosaic.jpg -> T1_mosaic.json.
+    return os.path.splitext(mosaic_path)[0] + '.json'
+
+
+def make_sprite_from_volume(nifti_path, mosaic_path):
+    """
+    Makes a BrainSprite mosaic from a 3D NIfTI volume, and writes the
+    parameters the viewer needs to read it next to the mosaic.
+
+    :parameter: nifti_path: path to the volume, e.g. T1w_restore.nii.gz.
+    :parameter: mosaic_path: path of the mosaic (JPEG) to write.
+    :return: path of the parameters file.
+    """
+    img = load_canonical(nifti_path)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data[..., 0]
+
+    sprite = volume_to_sprite(scale_to_uint8(data))
+
+    quality_val = 95
+    Image.fromarray(sprite, 'L').save(mosaic_path, 'JPEG', quality=quality_val)
+
+    params_path = sprite_params_path(mosaic_path)
+    with open(params_path, 'w') as fd:
+        json.dump(sprite_params(img), fd)
+
+    return params_path
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+            prog='volume_sprite',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+    parser.add_argument('volume', metavar='NIFTI_PATH',
+            help='path to the volume, e.g. MNINonLinear/T1w_restore.nii.gz.')
+    parser.add_argument('mosaic', metavar='MOSAIC_PATH',
+            help='path of the mosaic to write, e.g. img/T1_mosaic.jpg.')
+
+    return parser
+
+
+def _cli():
+    # Command line interface
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    make_sprite_from_volume(args.volume, args.mosaic)
+
+
+if __name__ == '__main__':
+
+    _cli()